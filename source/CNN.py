@@ -14,17 +14,22 @@ from source import RESULTS_PATH
 matplotlib.use('Agg')
 from matplotlib import pyplot as plt
 
+from batch_loader import BatchLoader
 from data_generator import DataGenerator
 from data_generator_config import DataGeneratorConfig
 from evaluator import Evaluator
+from normalisation import check_input_normalisation
+from normalisation import input_normalisation
+from normalisation import input_normalisation_layers
+from normalisation import set_input_statistics
 RESULTS_DIR = os.path.join(RESULTS_PATH, 'session5')
 
 class CNN(object):
     def __init__(self, logger, train_path, validation_path, test_path,
-                 model_fname='my_first_mlp.h5'):
+                 model_fname='my_first_mlp.h5', uint8_input=False):
 
         # Default hyper-parameters (used if no `set_*` is called)
-        self.model = self._default_model()
+        self.model = self._default_model(uint8_input)
         self.optimizer = optimizers.Adadelta(lr=0.1)
         self.batch_size = 32
         self.loss = 'categorical_crossentropy'
@@ -36,6 +41,10 @@ class CNN(object):
         self.test_path = test_path
         self.model_fname = model_fname
         self.logger = logger
+        self.workers = 1
+        self.use_multiprocessing = False
+        self.loader_workers = 2
+        self.max_queue_size = 10
         self.logger.info('Creating object')
 
         # Parameters set on-the-fly
@@ -53,6 +62,19 @@ class CNN(object):
     def set_batch_size(self, batch_size=32):
         self.batch_size = batch_size
 
+    def set_workers(self, workers=1, use_multiprocessing=False):
+        """ Workers (threads or processes) preparing the batches """
+        self.workers = workers
+        self.use_multiprocessing = use_multiprocessing
+
+    def set_loader(self, workers=2, max_queue_size=10):
+        """ Processes preparing the train batches in shared memory
+
+        See `BatchLoader`, `workers=0` lets `fit_generator` read the batches
+        """
+        self.loader_workers = workers
+        self.max_queue_size = max_queue_size
+
     def set_loss_function(self, name='categorical_crossentropy'):
         self.loss = name
 
@@ -76,25 +98,35 @@ class CNN(object):
         image_width, image_height = \
             self.model.input_shape[1], self.model.input_shape[2]
 
+        # Models with an InputNormalisation layer are fed uint8 images
+        uint8 = bool(input_normalisation_layers(self.model))
+
         # create data generator objects
         data_gen_train = DataGenerator(image_width,
                                        image_height,
                                        self.batch_size,
-                                       self.train_path)
+                                       self.train_path,
+                                       uint8=uint8)
 
+        # Validation and test are normalised with the train statistics
         data_gen_vali = DataGenerator(image_width,
                                       image_height,
                                       self.batch_size,
-                                      self.validation_path)
+                                      self.train_path,
+                                      uint8=uint8)
 
         data_gen_test = DataGenerator(image_width,
                                       image_height,
                                       self.batch_size,
-                                      self.test_path)
+                                      self.train_path,
+                                      uint8=uint8)
 
         data_gen_train.configure(DataGeneratorConfig.NORM_AND_TRANSFORM)
         data_gen_vali.configure(DataGeneratorConfig.NORMALISE)
         data_gen_test.configure(DataGeneratorConfig.NORMALISE)
+        set_input_statistics(self.model, data_gen_train.data_generator)
+        check_input_normalisation(self.model, data_gen_vali.data_generator)
+        check_input_normalisation(self.model, data_gen_test.data_generator)
 
         self.train_generator = \
             data_gen_train.get_single(path=self.train_path)
@@ -105,11 +137,18 @@ class CNN(object):
                                      shuffle=False)
 
     @staticmethod
-    def _default_model():
-        main_input = Input(
-            shape=(256, 256, 3), dtype='float32', name='main_input')
-
-        x = Conv2D(32, (3, 3), activation='relu', name='conv1')(main_input)
+    def _default_model(uint8_input=False):
+        """ With `uint8_input` the model normalises its uint8 images """
+        if uint8_input:
+            main_input = Input(
+                shape=(256, 256, 3), dtype='uint8', name='main_input')
+            x = input_normalisation()(main_input)
+        else:
+            main_input = Input(
+                shape=(256, 256, 3), dtype='float32', name='main_input')
+            x = main_input
+
+        x = Conv2D(32, (3, 3), activation='relu', name='conv1')(x)
         x = Conv2D(32, (3, 3), activation='relu', name='conv2')(x)
         x = MaxPooling2D(pool_size=(4, 4), padding='valid', name='pool')(x)
         x = Flatten()(x)
@@ -150,13 +189,16 @@ class CNN(object):
     def train_CNN_model(self,
                         n_epochs,
                         steps_per_epoch_multiplier=10,
-                        validation_steps_multiplier=5):
+                        validation_steps_multiplier=5,
+                        callbacks=None):
         """ Train a CNN Model.
 
         Args:
             n_epochs: number of epochs
-            steps_per_epoch_multiplier: a proportion to "1881 // batch_size"
+            steps_per_epoch_multiplier: a proportion to "train images //
+                batch_size"
             validation_steps_multiplier: a propportion to "320 // batch_size"
+            callbacks: Keras callbacks of the training
 
         """
         # train the CNN model
@@ -172,12 +214,30 @@ class CNN(object):
         # The dataset validationCNN contains 487 images (18%)
         # The dataset testCNN contains 320 images (12%)
 
-        self.history = self.model.fit_generator(
-            generator=self.train_generator,
-            steps_per_epoch=steps_per_epoch_multiplier * 1881 // self.batch_size,
-            epochs=n_epochs,
-            validation_data=self.validation_generator,
-            validation_steps=validation_steps_multiplier * 320 // self.batch_size)
+        # The train batches are decoded and augmented by the loader workers,
+        # a batch must stay valid while it waits in the fit_generator queue
+        # (a generator, so fit_generator reads it from a single thread)
+        train_generator = self.train_generator
+        workers, use_multiprocessing = self.workers, self.use_multiprocessing
+        if self.loader_workers > 0:
+            train_generator = BatchLoader(self.train_generator,
+                                          workers=self.loader_workers,
+                                          hold=self.max_queue_size + 1)
+            workers, use_multiprocessing = 1, False
+        try:
+            self.history = self.model.fit_generator(
+                generator=train_generator,
+                steps_per_epoch=steps_per_epoch_multiplier * self.train_generator.samples // self.batch_size,
+                epochs=n_epochs,
+                validation_data=self.validation_generator,
+                validation_steps=validation_steps_multiplier * 320 // self.batch_size,
+                callbacks=callbacks,
+                max_queue_size=self.max_queue_size,
+                workers=workers,
+                use_multiprocessing=use_multiprocessing)
+        finally:
+            if self.loader_workers > 0:
+                train_generator.close()
 
         self.logger.info('Done!')
         self.logger.info('Saving the model into {}'.format(self.model_fname))
@@ -263,7 +323,9 @@ class CNN(object):
         test_labels = self.test_generator.classes
 
         # Predict test images
-        predictions_raw = self.model.predict_generator(self.test_generator)
+        predictions_raw = self.model.predict_generator(
+            self.test_generator, workers=self.workers,
+            use_multiprocessing=self.use_multiprocessing)
         predictions = []
         for prediction in predictions_raw:
             predictions.append(np.argmax(prediction))
@@ -272,7 +334,9 @@ class CNN(object):
                               label_list=list([0, 1, 2, 3, 4, 5, 6, 7]))
 
         #
-        scores = self.model.evaluate_generator(self.test_generator)
+        scores = self.model.evaluate_generator(
+            self.test_generator, workers=self.workers,
+            use_multiprocessing=self.use_multiprocessing)
         self.logger.info(
             'Evaluator \n'
             'Acc (model) {}\n'
@@ -19,6 +19,8 @@ from sklearn.preprocessing import StandardScaler
 
 from bag_of_visual_words import BoVW
 from evaluator import Evaluator
+from image_sequence import ImageSequence
+from image_sequence import Manifest
 from utils import Color, colorprint
 
 
@@ -30,6 +32,9 @@ class multi_layer_perceptron(object):
         LAST = 'fc3'
         LABELS = 'fc4'
 
+    CLASSES = ['coast', 'forest', 'highway', 'inside_city', 'mountain',
+               'Opencountry', 'street', 'tallbuilding']
+
     def __init__(self, img_size=32, batch_size=16,
                  dataset_dir='/home/datasets/scenes/MIT_split',
                  model_fname='my_first_mlp.h5'):
@@ -44,6 +49,16 @@ class multi_layer_perceptron(object):
             colorprint(Color.RED,
                        'ERROR: dataset directory ' + self.DATASET_DIR + ' do not exists!\n')
 
+    def _sequence(self, image_set, image_data_generator, shuffle=True):
+        """ Batches of a split ('train', 'test'...) of the dataset """
+        manifest = Manifest.load(os.path.join(self.DATASET_DIR, image_set),
+                                 classes=self.CLASSES)
+        return ImageSequence(manifest,
+                             target_size=(self.IMG_SIZE, self.IMG_SIZE),
+                             batch_size=self.BATCH_SIZE,
+                             shuffle=shuffle,
+                             image_data_generator=image_data_generator)
+
     def build_MLP_model(self):
         # Build MLP model
         init = time.time()
@@ -140,25 +155,13 @@ class multi_layer_perceptron(object):
         # this is a generator that will read pictures found in
         # subfolers of 'data/train', and indefinitely generate
         # batches of augmented image data
-        train_generator = train_datagen.flow_from_directory(
-            self.DATASET_DIR + '/train',  # this is the target directory
-            target_size=(self.IMG_SIZE, self.IMG_SIZE),
-            # all images will be resized to IMG_SIZExIMG_SIZE
-            batch_size=self.BATCH_SIZE,
-            classes=['coast', 'forest', 'highway', 'inside_city', 'mountain',
-                     'Opencountry', 'street', 'tallbuilding'],
-            class_mode='categorical')  # since we use binary_crossentropy loss, we need categorical labels
+        # all images will be resized to IMG_SIZExIMG_SIZE
+        train_generator = self._sequence('train', train_datagen)
 
         # this is a generator that will read pictures found in
         # subfolers of 'data/test', and indefinitely generate
         # batches of augmented image data
-        validation_generator = test_datagen.flow_from_directory(
-            self.DATASET_DIR + '/test',
-            target_size=(self.IMG_SIZE, self.IMG_SIZE),
-            batch_size=self.BATCH_SIZE,
-            classes=['coast', 'forest', 'highway', 'inside_city', 'mountain',
-                     'Opencountry', 'street', 'tallbuilding'],
-            class_mode='categorical')
+        validation_generator = self._sequence('test', test_datagen)
 
         self.history = self.model.fit_generator(
             train_generator,
@@ -208,14 +211,7 @@ class multi_layer_perceptron(object):
         # this is a generator that will read pictures found in
         # subfolers of 'data/test', and indefinitely generate
         # batches of augmented image data
-        generator = datagen.flow_from_directory(
-            self.DATASET_DIR + '/' + image_set,
-            target_size=(self.IMG_SIZE, self.IMG_SIZE),
-            batch_size=self.BATCH_SIZE,
-            classes=['coast', 'forest', 'highway', 'inside_city', 'mountain',
-                     'Opencountry', 'street', 'tallbuilding'],
-            class_mode='categorical',
-            shuffle=False)
+        generator = self._sequence(image_set, datagen, shuffle=False)
 
         labels = generator.classes
 
@@ -262,14 +258,7 @@ class multi_layer_perceptron(object):
         # subfolers of 'data/test', and indefinitely generate
         # batches of augmented image data
 
-        test_generator = test_datagen.flow_from_directory(
-            self.DATASET_DIR + '/test',
-            target_size=(self.IMG_SIZE, self.IMG_SIZE),
-            batch_size=self.BATCH_SIZE,
-            classes=['coast', 'forest', 'highway', 'inside_city', 'mountain',
-                     'Opencountry', 'street', 'tallbuilding'],
-            class_mode='categorical',
-            shuffle=False)
+        test_generator = self._sequence('test', test_datagen, shuffle=False)
         # Get ground truth
         test_labels = test_generator.classes
 
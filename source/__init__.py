@@ -21,6 +21,7 @@ SMALL_TRAIN_PATH = os.path.join(DATA_PATH, 'train_small')
 TOY_TRAIN_PATH = os.path.join(DATA_PATH, 'train_toy')
 
 RESULTS_PATH = os.path.join(ROOT_PATH, 'results')
+CACHE_PATH = os.path.join(ROOT_PATH, 'cache')
 
 # REMOVE THIS LINE!!
 # TRAIN_PATH = os.path.join(DATA_PATH, 'train_toy')
@@ -11,8 +11,15 @@ from sklearn.mixture import gaussian_mixture
 from sklearn.model_selection import GridSearchCV
 from sklearn.model_selection import StratifiedKFold
 from sklearn.preprocessing import StandardScaler
+from typing import Iterator
+from typing import List
 
+from descriptor_set import DescriptorSet
+from descriptor_set import keypoint_coordinates
+from descriptor_transform import DescriptorTransform
 from evaluator import Evaluator
+from sampling import StratifiedReservoirSampler
+from sampling import sample_descriptor_set
 from source import TEST_PATH, TRAIN_PATH
 
 
@@ -31,11 +38,19 @@ def histogram_intersection(X, Y):
 
 class BoVW(object):
     def __init__(self, k=512, spatial_pyramid=False,
-                 histogram_intersection=False):
-        # type: (int) -> None
+                 histogram_intersection=False, transform=None):
+        # type: (int, bool, bool, DescriptorTransform) -> None
+        """
+        :param transform: optional DescriptorTransform (PCA, whitening,
+            RootSIFT) applied to the descriptors before the codebook. It is
+            fitted with the codebook and saved with it
+        """
         # FIXME: remove number_of_features if they are not explicity needed
         self.k = k
         self.codebook = self.build_codebook(k)
+        self.transform = transform
+        # Pyramid cells of shared key-point arrays, see ``pyramid_cells``
+        self._pyramid_cells = dict()
 
         self.spatial_pyramid = spatial_pyramid
         self.histogram_intersection = histogram_intersection
@@ -47,77 +62,176 @@ class BoVW(object):
                                        reassignment_ratio=10 ** -4,
                                        random_state=42)
 
+    def compress(self, descriptors):
+        # type: (np.array) -> np.array
+        """ Descriptors in the space of the codebook (after the transform)
+
+        Descriptors already transformed (e.g. loaded from a cache of reduced
+        vectors, see ``Database.load_descriptor_set_in_memory``) are only
+        converted back to float32, see ``DescriptorTransform.compress``.
+        """
+        if self.transform is None:
+            return descriptors
+        return self.transform.compress(descriptors)
+
+    def words(self, descriptors):
+        # type: (np.array) -> np.array
+        """ Visual word of every descriptor """
+        return self.codebook.predict(self.compress(descriptors))
+
+    def save_codebook(self, path='codebook.dat'):
+        # type: (str) -> None
+        """ Pickles the codebook followed by the descriptor transform """
+        with open(path, 'wb') as codebook_file:
+            cPickle.dump(self.codebook, codebook_file,
+                         cPickle.HIGHEST_PROTOCOL)
+            cPickle.dump(self.transform, codebook_file,
+                         cPickle.HIGHEST_PROTOCOL)
+
+    def load_codebook(self, path='codebook.dat'):
+        # type: (str) -> None
+        """ Loads a codebook saved by ``save_codebook`` (or a bare codebook)
+        """
+        with open(path, 'rb') as codebook_file:
+            self.codebook = cPickle.load(codebook_file)
+            try:
+                self.transform = cPickle.load(codebook_file)
+            except EOFError:
+                self.transform = None
+
+    def _fit_transform(self, D):
+        # type: (np.array) -> np.array
+        """ Fits the transform (once) on D and returns D transformed """
+        if self.transform is None:
+            return D
+        if not self.transform.fitted:
+            print('Fitting the descriptor transform...')
+            self.transform.fit(D)
+        return self.compress(D)
+
     def spatial_pyramid_histogram(self, descriptors, keypoints, w=256, h=256):
         # compute spatial pyramid histogram
 
-        words = self.codebook.predict(descriptors)
+        words = self.words(descriptors)
+        return self._spatial_pyramid(words, keypoints, w, h)
+
+    @staticmethod
+    def _cells(x, y, w=256, h=256):
+        # type: (np.array, np.array, int, int) -> np.array
+        """ Cell (0 to 15) of the 4x4 grid of the finest pyramid level """
         width = int(w / 4)
         height = int(h / 4)
+        return np.minimum(x // width, 3).astype(np.intp) + \
+               np.minimum(y // height, 3).astype(np.intp) * 4
 
-        level_zero = np.zeros((16, self.k))
-        for i in range(len(descriptors)):
-            x = keypoints[i].pt[0]
-            y = keypoints[i].pt[1]
-            spatial_index = int(x / width) + int(y / height) * 4
-            level_zero[spatial_index][words[i]] += 1
-
-        level_one = np.zeros((4, self.k))
-        level_one[0] = level_zero[0] + level_zero[1] + level_zero[4] + \
-                       level_zero[5]
-        level_one[1] = level_zero[2] + level_zero[3] + level_zero[6] + \
-                       level_zero[7]
-        level_one[2] = level_zero[8] + level_zero[9] + level_zero[12] + \
-                       level_zero[13]
-        level_one[3] = level_zero[10] + level_zero[11] + level_zero[14] + \
-                       level_zero[15]
-
-        level_two = level_one[0] + level_one[1] + level_one[2] + level_one[3]
-
-        aux_two = level_two.flatten() * 0.25
-        aux_one = level_one.flatten() * 0.25
-        aux_zero = level_zero.flatten() * 0.5
-        result = np.concatenate((aux_two, aux_one, aux_zero))
-        return result
+    def pyramid_cells(self, keypoints, w=256, h=256):
+        # type: (np.array, int, int) -> np.array
+        """ Pyramid cell of every key-point
 
-    def extract_descriptors(self, feature_extractor, train_images_filenames,
-                            train_labels):
-        # extract SIFT keypoints and descriptors
-        # store descriptors in a python list of numpy arrays
-        Train_descriptors = []
-        Keypoints = []
-        Train_label_per_descriptor = []
-        for i in range(len(train_images_filenames)):
-            filename = train_images_filenames[i]
-            filename_path = os.path.join(TRAIN_PATH, filename)
+        Dense extractors return the same key-point array for all the images
+        of a shape, so its cells are computed only once.
+        """
+        key = (id(keypoints), w, h)
+        cached = self._pyramid_cells.get(key)
+        if cached is not None and cached[0] is keypoints:
+            return cached[1]
+        cells = self._cells(*keypoint_coordinates(keypoints), w=w, h=h)
+        if isinstance(keypoints, np.ndarray) and \
+                not keypoints.flags.writeable:
+            self._pyramid_cells[key] = keypoints, cells
+        return cells
+
+    def _pyramid(self, level_zero):
+        # type: (np.array) -> np.array
+        """ Spatial pyramid (n, 21 k) given the (n, 16, k) finest level """
+        n = len(level_zero)
+        # Cell = row * 4 + column, group rows and columns in 2x2 blocks
+        blocks = level_zero.reshape(n, 2, 2, 2, 2, self.k)
+        level_one = blocks.sum(axis=(2, 4)).reshape(n, 4, self.k)
+        level_two = level_one.sum(axis=1)
+        return np.hstack((level_two * 0.25,
+                          level_one.reshape(n, -1) * 0.25,
+                          level_zero.reshape(n, -1) * 0.5))
+
+    def _spatial_pyramid(self, words, keypoints, w=256, h=256):
+        """ Spatial pyramid histogram given the visual words of an image """
+        spatial_index = self.pyramid_cells(keypoints, w, h)
+        level_zero = np.bincount(spatial_index * self.k + words,
+                                 minlength=16 * self.k)
+        level_zero = level_zero.reshape(1, 16, self.k).astype(np.float64)
+        return self._pyramid(level_zero)[0]
+
+    def extract_descriptor_set(self, feature_extractor, images_filenames,
+                               labels, path=TRAIN_PATH):
+        # type: (BaseFeatureExtractor, List, List, str) -> DescriptorSet
+        """ Extract the descriptors and key-points of every image
+
+        Extractors with a ``compute_list`` method describe all the images in
+        batches.
+        """
+        if hasattr(feature_extractor, 'compute_list'):
+            keypoints_per_image, descriptors_per_image = \
+                feature_extractor.compute_list(
+                    [cv2.imread(os.path.join(path, filename))
+                     for filename in images_filenames])
+            return DescriptorSet.from_images(descriptors_per_image, labels,
+                                             keypoints_per_image)
+
+        descriptors_per_image = []
+        keypoints_per_image = []
+        for filename in images_filenames:
+            filename_path = os.path.join(path, filename)
             print('Reading image ' + filename_path)
             ima = cv2.imread(filename_path)
             kpt, des = feature_extractor.detectAndCompute(ima)
-            Train_descriptors.append(des)
-            Keypoints.append(kpt)
-            Train_label_per_descriptor.append(train_labels[i])
+            descriptors_per_image.append(des)
+            keypoints_per_image.append(kpt)
             print(str(len(kpt)) + ' extracted keypoints and descriptors')
 
-        # Transform everything to numpy arrays
-        size_descriptors = Train_descriptors[0].shape[1]
-        D = np.zeros(
-            (np.sum([len(p) for p in Train_descriptors]), size_descriptors),
-            dtype=np.uint8)
-        startingpoint = 0
-        for i in range(len(Train_descriptors)):
-            D[startingpoint:startingpoint + len(Train_descriptors[i])] = \
-                Train_descriptors[i]
-            startingpoint += len(Train_descriptors[i])
-        return D, Train_descriptors, Keypoints
+        return DescriptorSet.from_images(descriptors_per_image, labels,
+                                         keypoints_per_image)
+
+    def extract_descriptors(self, feature_extractor, train_images_filenames,
+                            train_labels, codebook_budget=None):
+        # extract SIFT keypoints and descriptors
+        # store descriptors in a python list of numpy arrays
+        """
+        :param codebook_budget: if given, D is a stratified sample of at most
+            this number of descriptors (see ``sample_descriptor_set``)
+        """
+        descriptor_set = self.extract_descriptor_set(
+            feature_extractor, train_images_filenames, train_labels)
+        Keypoints = [descriptor_set.keypoints(i)
+                     for i in range(len(descriptor_set))]
+        D = descriptor_set.descriptors
+        if codebook_budget is not None:
+            D = sample_descriptor_set(descriptor_set, codebook_budget)
+        return D, descriptor_set.split(), Keypoints
+
+    def sample_descriptors(self, feature_extractor, images_filenames, labels,
+                           budget=100000, path=TRAIN_PATH):
+        # type: (BaseFeatureExtractor, List, List, int, str) -> np.array
+        """ Stratified sample of descriptors to compute the codebook
+
+        The images are described one at a time and only the sample is kept,
+        see ``StratifiedReservoirSampler``.
+        """
+        sampler = StratifiedReservoirSampler(labels, budget)
+        for image_id, _, descriptors in feature_extractor.iter_descriptors(
+                images_filenames, prefetch=8, path=path):
+            sampler.add(descriptors, labels[image_id])
+        return sampler.descriptors()
 
     def compute_codebook_partial(self, D, only_save=False):
         print('Computing kmeans with ' + str(self.k) + ' centroids')
         init = time.time()
 
         if only_save:
-            cPickle.dump(self.codebook, open("codebook.dat", "wb"))
+            self.save_codebook()
             return
 
-        self.codebook.partial_fit(D)
+        # The transform is fitted on the first batch only
+        self.codebook.partial_fit(self._fit_transform(D))
 
         end = time.time()
         print('Done in ' + str(end - init) + ' secs.')
@@ -127,8 +241,38 @@ class BoVW(object):
         # compute the codebook
         print('Computing kmeans with ' + str(self.k) + ' centroids')
         init = time.time()
-        self.codebook.fit(D)
-        cPickle.dump(self.codebook, open("codebook.dat", "wb"))
+        self.codebook.fit(self._fit_transform(D))
+        self.save_codebook()
+        end = time.time()
+        print('Done in ' + str(end - init) + ' secs.')
+
+    def compute_codebook_iter(self, items, batch_size=None):
+        # type: (Iterator, int) -> None
+        """ Computes the codebook from a stream of images, by batches
+
+        :param items: (image id, key-points, descriptors) of every image, see
+            ``BaseFeatureExtractor.iter_descriptors``
+        :param batch_size: descriptors given at once to ``partial_fit``
+            (``20 k`` by default). The transform, if any, is fitted on the
+            first batch
+        """
+        print('Computing kmeans with ' + str(self.k) + ' centroids')
+        init = time.time()
+        batch_size = batch_size or self.k * 20
+        batch, size = [], 0
+        for _, _, descriptors in items:
+            if descriptors is None or not len(descriptors):
+                continue
+            batch.append(descriptors)
+            size += len(descriptors)
+            if size >= batch_size:
+                self.codebook.partial_fit(
+                    self._fit_transform(np.concatenate(batch)))
+                batch, size = [], 0
+        if size >= self.k:
+            self.codebook.partial_fit(
+                self._fit_transform(np.concatenate(batch)))
+        self.save_codebook()
         end = time.time()
         print('Done in ' + str(end - init) + ' secs.')
 
@@ -144,7 +288,7 @@ class BoVW(object):
             visual_words = np.zeros((len(Train_descriptors), self.k),
                                     dtype=np.float32)
             for i in xrange(len(Train_descriptors)):
-                words = self.codebook.predict(Train_descriptors[i])
+                words = self.words(Train_descriptors[i])
                 visual_words[i, :] = np.bincount(words, minlength=self.k)
                 # spatial pyramid algorithm
         else:
@@ -158,6 +302,63 @@ class BoVW(object):
         print('Done in ' + str(end - init) + ' secs.')
         return visual_words
 
+    def encode(self, descriptor_set):
+        # type: (DescriptorSet) -> np.array
+        """ Visual words of every image of a DescriptorSet
+
+        The codebook assigns all the descriptors at once.
+        """
+        print('Getting BoVW representation')
+        init = time.time()
+        words = self.words(descriptor_set.descriptors)
+        if self.spatial_pyramid is False:
+            image_ids = descriptor_set.descriptor_image_ids()
+            visual_words = np.bincount(image_ids * self.k + words,
+                                       minlength=len(descriptor_set) * self.k)
+            visual_words = visual_words.reshape(len(descriptor_set), self.k)
+        else:
+            # Histogram of every (image, cell, word) at once
+            cells = self._cells(descriptor_set.x, descriptor_set.y)
+            image_ids = descriptor_set.descriptor_image_ids()
+            level_zero = np.bincount(
+                (image_ids * 16 + cells) * self.k + words,
+                minlength=len(descriptor_set) * 16 * self.k)
+            visual_words = self._pyramid(
+                level_zero.reshape(len(descriptor_set), 16, self.k))
+
+        end = time.time()
+        print('Done in ' + str(end - init) + ' secs.')
+        return visual_words.astype(np.float32)
+
+    def _encode_image(self, descriptors, keypoints):
+        # type: (np.array, np.array) -> np.array
+        """ Visual words of a single image """
+        if self.spatial_pyramid is False:
+            return np.bincount(self.words(descriptors), minlength=self.k)
+        return self.spatial_pyramid_histogram(descriptors, keypoints)
+
+    def encode_iter(self, items, n_images):
+        # type: (Iterator, int) -> np.array
+        """ Visual words of every image of a stream of images
+
+        Only an image is in memory at a time.
+
+        :param items: (image id, key-points, descriptors) of every image, see
+            ``BaseFeatureExtractor.iter_descriptors``
+        :param n_images: number of images of the stream
+        """
+        print('Getting BoVW representation')
+        init = time.time()
+        dimension = self.k if self.spatial_pyramid is False else self.k * 21
+        visual_words = np.zeros((n_images, dimension), dtype=np.float32)
+        for image_id, keypoints, descriptors in items:
+            if descriptors is not None and len(descriptors):
+                visual_words[image_id] = self._encode_image(descriptors,
+                                                            keypoints)
+        end = time.time()
+        print('Done in ' + str(end - init) + ' secs.')
+        return visual_words
+
     def cross_validate(self, visual_words, train_labels):
         """ cross_validate classifier with k stratified folds """
         # Train an SVM classifier with RBF kernel
@@ -221,7 +422,7 @@ class BoVW(object):
             ima = cv2.imread(filename_path)
             kpt, des = feature_extractor.detectAndCompute(ima)
             if self.spatial_pyramid == False:
-                words = self.codebook.predict(des)
+                words = self.words(des)
                 visual_words_test[i, :] = np.bincount(words, minlength=self.k)
             else:
                 visual_words_test[i, :] = self.spatial_pyramid_histogram(des,
@@ -272,11 +473,14 @@ class ExtendedBoVW(BoVW):
     # PyCharm has reference to a GMM for the codebook (without this method it
     # thinks is a kminibatch
     def __init__(self, k, spatial_pyramid=False,
-                 histogram_intersection=False):
-        # type: (int) -> None
+                 histogram_intersection=False, transform=None):
+        # type: (int, bool, bool, DescriptorTransform) -> None
         # FIXME: remove number_of_features if they are not explicity needed
         self.k = k
         self.codebook = self.build_codebook(k)
+        self.transform = transform
+        # Pyramid cells of shared key-point arrays, see ``pyramid_cells``
+        self._pyramid_cells = dict()
 
         self.spatial_pyramid = spatial_pyramid
         self.histogram_intersection = histogram_intersection
@@ -294,9 +498,9 @@ class ExtendedBoVW(BoVW):
         # compute the codebook
         print('Computing GMM with ' + str(self.k) + ' centroids')
         init = time.time()
-        self.codebook.fit(D)
+        self.codebook.fit(self._fit_transform(D))
         # fv = fisher_vector(D, self.codebook)
-        cPickle.dump(self.codebook, open("codebook.dat", "wb"))
+        self.save_codebook()
         end = time.time()
         print('Done in ' + str(end - init) + ' secs.')
 
@@ -314,7 +518,7 @@ class ExtendedBoVW(BoVW):
             for i in xrange(len(Train_descriptors)):
                 # words = self.codebook.predict(Train_descriptors[i])
                 visual_words[i, :] = self.codebook.predict_proba(
-                    Train_descriptors[i])
+                    self.compress(Train_descriptors[i]))
                 # visual_words[i, :] = np.bincount(words, minlength=self.k)
                 # spatial pyramid algorithm
         else:
@@ -328,6 +532,146 @@ class ExtendedBoVW(BoVW):
         print('Done in ' + str(end - init) + ' secs.')
         return visual_words
 
+    def _encode_image(self, descriptors, keypoints):
+        # type: (np.array, np.array) -> np.array
+        if self.spatial_pyramid is not False:
+            return super(ExtendedBoVW, self)._encode_image(descriptors,
+                                                           keypoints)
+        return self.codebook.predict_proba(self.compress(descriptors)).sum(
+            axis=0)
+
+    def encode(self, descriptor_set):
+        # type: (DescriptorSet) -> np.array
+        """ Sum of the GMM posteriors of the descriptors of every image """
+        if self.spatial_pyramid is not False:
+            return super(ExtendedBoVW, self).encode(descriptor_set)
+
+        print('Getting BoVW representation')
+        init = time.time()
+        posteriors = self.codebook.predict_proba(
+            self.compress(descriptor_set.descriptors))
+        cumulative = np.vstack((np.zeros((1, self.k)),
+                                np.cumsum(posteriors, axis=0)))
+        offsets = descriptor_set.offsets
+        visual_words = cumulative[offsets[1:]] - cumulative[offsets[:-1]]
+
+        end = time.time()
+        print('Done in ' + str(end - init) + ' secs.')
+        return visual_words.astype(np.float32)
+
+
+# Number of bits set of every byte value
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def hamming_distances(X, Y):
+    # type: (np.array, np.array) -> np.array
+    """ Hamming distances between two sets of packed binary descriptors
+
+    :param X: (n, bytes) uint8 array
+    :param Y: (m, bytes) uint8 array
+    :return: (n, m) distances
+    """
+    xor = np.bitwise_xor(X[:, np.newaxis, :], Y[np.newaxis, :, :])
+    return POPCOUNT[xor].sum(axis=2, dtype=np.uint16)
+
+
+class HammingKMajority(object):
+    """ k-majority clustering of binary descriptors in Hamming space
+
+    Descriptors are assigned to the centre at the smallest Hamming distance
+    (popcount of the xor) and every bit of a centre is the majority vote of
+    that bit among its descriptors. It follows the interface of the sklearn
+    clustering used as codebooks (``fit``, ``partial_fit``, ``predict``).
+    """
+
+    def __init__(self, n_clusters=512, max_iter=10, batch_size=1024,
+                 random_state=42):
+        # type: (int, int, int, int) -> None
+        self.n_clusters = n_clusters
+        self.max_iter = max_iter
+        self.batch_size = batch_size
+        self.random_state = random_state
+        self.cluster_centers_ = None
+        self.bit_counts = None
+        self.counts = None
+        # Seeded by fit or the first partial_fit, as in sklearn
+        self.random_state_ = None
+
+    def _init_centres(self, D, rng):
+        # type: (np.array, np.random.RandomState) -> None
+        indices = rng.choice(len(D), self.n_clusters,
+                             replace=len(D) < self.n_clusters)
+        self.cluster_centers_ = D[indices].copy()
+        self.bit_counts = np.zeros(
+            (self.n_clusters, D.shape[1] * 8), dtype=np.int64)
+        self.counts = np.zeros(self.n_clusters, dtype=np.int64)
+
+    def predict(self, D):
+        # type: (np.array) -> np.array
+        """ Closest centre of every descriptor """
+        D = np.asarray(D, dtype=np.uint8)
+        words = np.empty(len(D), dtype=np.int64)
+        for start in range(0, len(D), self.batch_size):
+            batch = D[start:start + self.batch_size]
+            words[start:start + len(batch)] = np.argmin(
+                hamming_distances(batch, self.cluster_centers_), axis=1)
+        return words
+
+    def _accumulate(self, D, words):
+        """ Adds the bits of the descriptors to the votes of their centres """
+        bits = np.unpackbits(D, axis=1)
+        np.add.at(self.bit_counts, words, bits)
+        self.counts += np.bincount(words, minlength=self.n_clusters)
+
+    def _update_centres(self, D, rng):
+        """ Majority vote of every bit, empty centres are re-seeded """
+        majority = self.bit_counts * 2 > self.counts[:, np.newaxis]
+        centres = np.packbits(majority.astype(np.uint8), axis=1)
+        empty = self.counts == 0
+        centres[empty] = D[rng.choice(len(D), empty.sum())]
+        self.cluster_centers_ = centres
+
+    def fit(self, D):
+        # type: (np.array) -> HammingKMajority
+        D = np.asarray(D, dtype=np.uint8)
+        rng = self.random_state_ = np.random.RandomState(self.random_state)
+        self._init_centres(D, rng)
+
+        words = None
+        for iteration in range(self.max_iter):
+            new_words = self.predict(D)
+            if words is not None and np.array_equal(words, new_words):
+                break
+            words = new_words
+            self.bit_counts[:] = 0
+            self.counts[:] = 0
+            self._accumulate(D, words)
+            self._update_centres(D, rng)
+        return self
+
+    def partial_fit(self, D):
+        # type: (np.array) -> HammingKMajority
+        """ Online update: the votes of the batch add to the previous ones """
+        D = np.asarray(D, dtype=np.uint8)
+        if self.cluster_centers_ is None:
+            self.random_state_ = np.random.RandomState(self.random_state)
+            self._init_centres(D, self.random_state_)
+        self._accumulate(D, self.predict(D))
+        self._update_centres(D, self.random_state_)
+        return self
+
+
+class BinaryBoVW(BoVW):
+    """ Implements BoVW for binary descriptors with a Hamming codebook
+
+    Use it with a ``feature_extractor.BinaryDescriptor`` extractor.
+    """
+
+    def build_codebook(self, k):
+        print('Building a Hamming k-majority codebook of {} words'.format(k))
+        return HammingKMajority(n_clusters=k, random_state=42)
+
 
 def fisher_vector(xx, gmm):
     """Computes the Fisher vector on a set of descriptors.
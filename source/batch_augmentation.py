@@ -0,0 +1,293 @@
+import warnings
+
+import numpy as np
+
+from preprocess import VGG16_MEAN_BGR
+from preprocess import preprocess_input
+
+FILL_MODES = ('constant', 'nearest', 'reflect', 'wrap')
+INTERPOLATIONS = ('nearest', 'bilinear')
+
+
+class BatchAugmenter(object):
+    """ Random affine transformations and normalisation of uint8 batches
+
+    Takes the options of ``ImageDataGenerator`` (see ``DataGeneratorConfig``)
+    but works on a whole (n, height, width, 3) uint8 batch at once instead of
+    one image at a time with ``scipy.ndimage``: the rotation, shift, shear,
+    zoom and flips of every image are composed in a 3x3 matrix and all the
+    output pixels are read from the batch with a single gather.
+
+    When ``preprocessing_function`` is ``preprocess_input``, its channel swap
+    and mean subtraction are done while the float32 output is written, not in
+    another pass. With ``uint8_output`` the batches are only transformed and
+    kept as uint8, the model normalises them (see ``InputNormalisation``).
+    Images are channels last.
+    """
+    channel_axis = 3
+
+    def __init__(self, featurewise_center=False, samplewise_center=False,
+                 featurewise_std_normalization=False,
+                 samplewise_std_normalization=False, zca_whitening=False,
+                 rotation_range=0., width_shift_range=0.,
+                 height_shift_range=0., shear_range=0., zoom_range=0.,
+                 channel_shift_range=0., fill_mode='nearest', cval=0.,
+                 horizontal_flip=False, vertical_flip=False, rescale=None,
+                 preprocessing_function=None, interpolation='nearest',
+                 uint8_output=False):
+        """
+        :param interpolation: 'nearest' (as ``ImageDataGenerator``) or
+            'bilinear'
+        :param uint8_output: return the transformed uint8 RGB images, without
+            pre-processing nor normalisation
+        """
+        if zca_whitening:
+            raise ValueError('ZCA whitening is not supported')
+        if fill_mode not in FILL_MODES:
+            raise ValueError('Unknown fill mode: {}'.format(fill_mode))
+        if interpolation not in INTERPOLATIONS:
+            raise ValueError('Unknown interpolation: {}'.format(
+                interpolation))
+        if np.isscalar(zoom_range):
+            zoom_range = (1 - zoom_range, 1 + zoom_range)
+
+        self.featurewise_center = featurewise_center
+        self.samplewise_center = samplewise_center
+        self.featurewise_std_normalization = featurewise_std_normalization
+        self.samplewise_std_normalization = samplewise_std_normalization
+        self.zca_whitening = zca_whitening
+        self.rotation_range = rotation_range
+        self.width_shift_range = width_shift_range
+        self.height_shift_range = height_shift_range
+        self.shear_range = shear_range
+        self.zoom_range = tuple(zoom_range)
+        self.channel_shift_range = channel_shift_range
+        self.fill_mode = fill_mode
+        self.cval = cval
+        self.horizontal_flip = horizontal_flip
+        self.vertical_flip = vertical_flip
+        self.rescale = rescale
+        self.interpolation = interpolation
+        self.uint8_output = uint8_output
+
+        # Featurewise statistics, set as in ImageDataGenerator.fit
+        self.mean = None
+        self.std = None
+
+        self.vgg_preprocessing = preprocessing_function is preprocess_input
+        self.preprocessing_function = None if self.vgg_preprocessing \
+            else preprocessing_function
+        if uint8_output and self.preprocessing_function is not None:
+            raise ValueError('Only preprocess_input can be done by the model')
+
+        # Channel order and mean pixel of the fused pre-processing
+        self.channels = slice(None)
+        self.mean_pixel = np.zeros(3, dtype=np.float32)
+        if self.vgg_preprocessing and not uint8_output:
+            self.channels = slice(None, None, -1)
+            self.mean_pixel = np.array(VGG16_MEAN_BGR, dtype=np.float32)
+
+    def has_transform(self):
+        # type: () -> bool
+        return bool(self.rotation_range or self.width_shift_range or
+                    self.height_shift_range or self.shear_range or
+                    self.zoom_range != (1, 1) or self.horizontal_flip or
+                    self.vertical_flip)
+
+    def random_matrices(self, n, height, width, rng=np.random):
+        # type: (int, int, int, np.random.RandomState) -> np.array
+        """ (n, 3, 3) random transformations of a batch
+
+        Every matrix maps the (row, column) coordinates of an output pixel to
+        the coordinates of the input pixel it is read from, composed as in
+        ``ImageDataGenerator.random_transform``: rotation, shift, shear and
+        zoom about the image centre, then the flips.
+        """
+        theta = np.deg2rad(rng.uniform(-self.rotation_range,
+                                       self.rotation_range, n))
+        tx = rng.uniform(-self.height_shift_range, self.height_shift_range,
+                         n) * height
+        ty = rng.uniform(-self.width_shift_range, self.width_shift_range,
+                         n) * width
+        shear = rng.uniform(-self.shear_range, self.shear_range, n)
+        if self.zoom_range == (1, 1):
+            zx, zy = np.ones(n), np.ones(n)
+        else:
+            zx, zy = rng.uniform(self.zoom_range[0], self.zoom_range[1],
+                                 (2, n))
+
+        def _matrices(a, b, c, d, e, f):
+            matrices = np.zeros((n, 3, 3))
+            matrices[:, 0, 0], matrices[:, 0, 1], matrices[:, 0, 2] = a, b, c
+            matrices[:, 1, 0], matrices[:, 1, 1], matrices[:, 1, 2] = d, e, f
+            matrices[:, 2, 2] = 1
+            return matrices
+
+        cos, sin = np.cos(theta), np.sin(theta)
+        transform = _matrices(cos, -sin, 0, sin, cos, 0)
+        transform = np.matmul(transform, _matrices(1, 0, tx, 0, 1, ty))
+        transform = np.matmul(transform, _matrices(
+            1, -np.sin(shear), 0, 0, np.cos(shear), 0))
+        transform = np.matmul(transform, _matrices(zx, 0, 0, 0, zy, 0))
+
+        o_x, o_y = height / 2. + 0.5, width / 2. + 0.5
+        transform = np.matmul(np.matmul(_matrices(1, 0, o_x, 0, 1, o_y),
+                                        transform),
+                              _matrices(1, 0, -o_x, 0, 1, -o_y))
+
+        # A flip of the output reads the mirrored output coordinates
+        ones = np.ones(n)
+        if self.vertical_flip:
+            flip = rng.uniform(size=n) < 0.5
+            transform = np.matmul(transform, _matrices(
+                np.where(flip, -1, 1), 0, np.where(flip, height - 1, 0),
+                0, ones, 0))
+        if self.horizontal_flip:
+            flip = rng.uniform(size=n) < 0.5
+            transform = np.matmul(transform, _matrices(
+                ones, 0, 0,
+                0, np.where(flip, -1, 1), np.where(flip, width - 1, 0)))
+        return transform
+
+    def _fill(self, index, size):
+        # type: (np.array, int) -> np.array
+        """ Maps integer coordinates outside the image as ``fill_mode`` """
+        if self.fill_mode == 'nearest':
+            return np.clip(index, 0, size - 1)
+        if self.fill_mode == 'reflect':
+            index = np.mod(index, 2 * size)
+            return np.where(index < size, index, 2 * size - 1 - index)
+        if self.fill_mode == 'wrap':
+            return np.mod(index, size)
+        return index
+
+    def _sample(self, pixels, shape, rows, cols):
+        # type: (np.array, tuple, np.array, np.array) -> (np.array, np.array)
+        """ Pixels of the batch at integer (n, height, width) coordinates
+
+        :param pixels: (n * height * width, channels) pixels of the batch
+        :return: the (n, height, width, channels) pixels, and a mask of the
+            coordinates inside the images for the 'constant' fill mode (None
+            for the other modes)
+        """
+        n, height, width = shape[:3]
+        rows = self._fill(rows.astype(np.int64), height)
+        cols = self._fill(cols.astype(np.int64), width)
+        inside = None
+        if self.fill_mode == 'constant':
+            inside = (rows >= 0) & (rows < height) & (cols >= 0) & \
+                     (cols < width)
+            rows = np.clip(rows, 0, height - 1)
+            cols = np.clip(cols, 0, width - 1)
+        rows += (np.arange(n) * height).reshape(-1, 1, 1)
+        values = np.take(pixels, (rows * width + cols).ravel(), axis=0)
+        return values.reshape(rows.shape + (-1,)), inside
+
+    def warp(self, batch, matrices):
+        # type: (np.array, np.array) -> np.array
+        """ Transforms a uint8 batch into a float32 one
+
+        The channels are reordered and the mean pixel subtracted as
+        ``preprocess_input`` in the same pass. The result is uint8 with
+        ``uint8_output``.
+        """
+        n, height, width, channels = batch.shape
+        # Every pixel of the batch in a row, channels in the output order
+        pixels = batch.reshape(-1, channels)[:, self.channels]
+
+        grid_rows, grid_cols = np.mgrid[:height, :width].astype(np.float32)
+        m = matrices.astype(np.float32)[:, :, :, np.newaxis, np.newaxis]
+        rows = m[:, 0, 0] * grid_rows + m[:, 0, 1] * grid_cols + m[:, 0, 2]
+        cols = m[:, 1, 0] * grid_rows + m[:, 1, 1] * grid_cols + m[:, 1, 2]
+
+        if self.interpolation == 'nearest':
+            values, inside = self._sample(pixels, batch.shape,
+                                          np.floor(rows + 0.5),
+                                          np.floor(cols + 0.5))
+            if self.uint8_output:
+                if inside is not None:
+                    values[~inside] = np.clip(self.cval, 0, 255)
+                return values
+            x = np.subtract(values, self.mean_pixel, dtype=np.float32)
+            if inside is not None:
+                x[~inside] = np.float32(self.cval) - self.mean_pixel
+            return x
+
+        top, left = np.floor(rows), np.floor(cols)
+        dy, dx = (rows - top)[..., np.newaxis], (cols - left)[..., np.newaxis]
+        x = np.zeros((n, height, width, channels), dtype=np.float32)
+        for row_step, col_step, weight in ((0, 0, (1 - dy) * (1 - dx)),
+                                           (0, 1, (1 - dy) * dx),
+                                           (1, 0, dy * (1 - dx)),
+                                           (1, 1, dy * dx)):
+            values, inside = self._sample(pixels, batch.shape,
+                                          top + row_step, left + col_step)
+            if inside is not None:
+                values = np.where(inside[..., np.newaxis], values,
+                                  np.float32(self.cval))
+            x += weight * values
+        if self.uint8_output:
+            return np.clip(np.rint(x), 0, 255).astype(np.uint8)
+        x -= self.mean_pixel
+        return x
+
+    def standardize(self, x):
+        # type: (np.array) -> np.array
+        """ Normalises a float32 batch in place, as ``ImageDataGenerator`` """
+        if self.rescale:
+            x *= self.rescale
+        if self.samplewise_center:
+            x -= np.mean(x, axis=self.channel_axis, keepdims=True)
+        if self.samplewise_std_normalization:
+            x /= np.std(x, axis=self.channel_axis, keepdims=True) + 1e-7
+        if self.featurewise_center:
+            if self.mean is None:
+                warnings.warn('featurewise_center is set but the mean is '
+                              'not, see DataGenerator.configure')
+            else:
+                x -= self.mean
+        if self.featurewise_std_normalization:
+            if self.std is None:
+                warnings.warn('featurewise_std_normalization is set but the '
+                              'std is not, see DataGenerator.configure')
+            else:
+                x /= self.std + 1e-7
+        return x
+
+    def augment(self, batch, rng=np.random):
+        # type: (np.array, np.random.RandomState) -> np.array
+        """ Random transformation and normalisation of a uint8 batch
+
+        :param batch: (n, height, width, 3) RGB uint8 images
+        :param rng: source of the random transformations
+        :return: (n, height, width, 3) float32 batch ready for the model, or
+            the transformed uint8 batch with ``uint8_output``
+        """
+        batch = np.ascontiguousarray(batch, dtype=np.uint8)
+        n, height, width, channels = batch.shape
+        if self.has_transform():
+            x = self.warp(batch,
+                          self.random_matrices(n, height, width, rng))
+        elif self.uint8_output:
+            x = batch
+        else:
+            x = np.subtract(batch[..., self.channels], self.mean_pixel,
+                            dtype=np.float32)
+
+        if self.channel_shift_range:
+            # Shifts clipped to the intensity range of every image
+            raw = x + self.mean_pixel
+            low = raw.min(axis=(1, 2, 3), keepdims=True) - self.mean_pixel
+            high = raw.max(axis=(1, 2, 3), keepdims=True) - self.mean_pixel
+            shifted = np.clip(x + rng.uniform(
+                -self.channel_shift_range, self.channel_shift_range,
+                (n, 1, 1, channels)).astype(np.float32), low, high)
+            x = np.rint(shifted).astype(np.uint8) if self.uint8_output \
+                else shifted
+
+        if self.uint8_output:
+            return x
+        if self.preprocessing_function is not None:
+            for i in range(n):
+                x[i] = self.preprocessing_function(x[i])
+        return self.standardize(x)
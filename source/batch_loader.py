@@ -0,0 +1,191 @@
+import multiprocessing
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import traceback
+
+import numpy as np
+from keras.utils import Sequence
+
+
+def _view(buffer, shape, dtype):
+    # type: (multiprocessing.Array, tuple, type) -> np.array
+    """ Array of the given shape and type over a shared buffer """
+    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return np.frombuffer(buffer, dtype=np.uint8)[:size].view(dtype).reshape(
+        shape)
+
+
+def _shared_array(shape, dtype):
+    # type: (tuple, type) -> (multiprocessing.Array, np.array)
+    """ Zero-filled array in shared memory, and its numpy view """
+    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    buffer = multiprocessing.RawArray('B', max(size, 1))
+    return buffer, _view(buffer, shape, dtype)
+
+
+def _worker(sequence, buffers, shapes, dtypes, tasks, free, ready, stop):
+    """ Fills free slots with the batches of the queued positions """
+    # Nothing left in the queue buffers must hold the process on exit
+    ready.cancel_join_thread()
+    slots = [_view(buffer, shape, dtype)
+             for buffer, shape, dtype in zip(buffers, shapes, dtypes)]
+    epoch = 0
+
+    def _get(source):
+        while not stop.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    while True:
+        slot = _get(free)
+        if slot is None:
+            return
+        position = _get(tasks)
+        if position is None:
+            return
+        try:
+            batch_epoch, index = divmod(position, len(sequence))
+            while epoch < batch_epoch:
+                sequence.on_epoch_end()
+                epoch += 1
+            batch = sequence[index]
+            size = len(batch[0])
+            for array, values in zip(slots, batch):
+                array[slot, :size] = values
+            ready.put((position, slot, size, None))
+        except Exception:
+            # Reported to the consumer, which raises it
+            ready.put((position, slot, 0, traceback.format_exc()))
+
+
+class BatchLoader(object):
+    """ Batches of a Sequence prepared by worker processes in shared memory
+
+    ``workers`` processes read the batches of ``sequence`` (decoding and
+    augmentation) into a ring of ``slots`` batches pre-allocated in shared
+    memory. The loader is an endless generator of the batches, in order and
+    epoch after epoch (as ``flow_from_directory``), whose arrays are views of
+    the slots: nothing is copied or pickled between the processes.
+
+    - Back-pressure: a worker only starts a batch when it has a free slot,
+      so at most ``slots`` batches are prepared ahead of the training.
+    - A batch stays valid until ``hold`` more batches are taken, then its
+      slot is given back to the workers. With ``fit_generator`` it must
+      cover the batches waiting in its queue.
+    - ``close``, or the end of a ``with`` block, stops the workers.
+    """
+
+    def __init__(self, sequence, workers=2, slots=None, hold=1,
+                 timeout=60.):
+        # type: (Sequence, int, int, int, float) -> None
+        """
+        :param sequence: the batches; the shapes of the slots are taken from
+            the first one, no later batch can be bigger
+        :param slots: batches in shared memory, ``hold + 2 * workers`` if
+            None
+        :param timeout: seconds to wait for a batch before giving up
+        """
+        if slots is None:
+            slots = hold + 2 * workers
+        if workers < 1 or hold < 1 or slots <= hold:
+            raise ValueError('At least 1 worker and more slots than held '
+                             'batches are needed')
+        self.sequence = sequence
+        self.n_slots = slots
+        self.hold = hold
+        self.timeout = timeout
+
+        first = sequence[0]
+        shapes = [(slots,) + np.shape(array) for array in first]
+        dtypes = [np.asarray(array).dtype for array in first]
+        buffers, self.slots = zip(*[_shared_array(shape, dtype)
+                                    for shape, dtype in zip(shapes, dtypes)])
+
+        self.tasks = multiprocessing.Queue()
+        self.free = multiprocessing.Queue()
+        self.ready = multiprocessing.Queue()
+        self.stop = multiprocessing.Event()
+        for slot in range(slots):
+            self.free.put(slot)
+
+        self.position = 0
+        self.queued = 0
+        self.pending = dict()
+        self.held = list()
+        self.workers = [multiprocessing.Process(
+            target=_worker, args=(sequence, buffers, shapes, dtypes,
+                                  self.tasks, self.free, self.ready,
+                                  self.stop))
+            for _ in range(workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def __iter__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _wait(self, position):
+        # type: (int) -> (int, int)
+        """ Slot and size of the batch at ``position`` once it is ready """
+        waited = 0.
+        while position not in self.pending:
+            try:
+                ready_position, slot, size, error = self.ready.get(
+                    timeout=1.)
+            except queue.Empty:
+                waited += 1.
+                if not all(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError('A batch loader worker died')
+                if waited >= self.timeout:
+                    raise RuntimeError('No batch in {} secs.'.format(
+                        self.timeout))
+                continue
+            if error is not None:
+                raise RuntimeError('Batch {} failed:\n{}'.format(
+                    ready_position, error))
+            self.pending[ready_position] = slot, size
+        return self.pending.pop(position)
+
+    def next(self):
+        # type: () -> tuple
+        if self.stop.is_set():
+            raise StopIteration()
+        while len(self.held) >= self.hold:
+            self.free.put(self.held.pop(0))
+        # Only the positions that can get a slot are queued
+        while self.queued < self.position + self.n_slots:
+            self.tasks.put(self.queued)
+            self.queued += 1
+
+        slot, size = self._wait(self.position)
+        self.held.append(slot)
+        self.position += 1
+        return tuple(array[slot, :size] for array in self.slots)
+
+    __next__ = next
+
+    def close(self):
+        # type: () -> None
+        """ Stops the workers, the batches are not valid anymore """
+        if self.stop.is_set():
+            return
+        self.stop.set()
+        for worker in self.workers:
+            worker.join(timeout=5.)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        for shared_queue in (self.tasks, self.free, self.ready):
+            shared_queue.cancel_join_thread()
+            shared_queue.close()
@@ -0,0 +1,191 @@
+import copy
+import hashlib
+import os
+import shutil
+import time
+
+import numpy as np
+from keras import backend as K
+from keras.layers import Input
+from keras.models import Model
+from keras.utils import Sequence
+
+from image_sequence import ImageSequence
+from source import CACHE_PATH
+
+# Activations of the frozen trunks of the models
+BOTTLENECK_PATH = os.path.join(CACHE_PATH, 'bottleneck')
+
+
+def split_model(model, layer_name):
+    # type: (Model, str) -> (Model, Model)
+    """ Splits a model in a frozen trunk and the head after it
+
+    The trunk goes from the input to the output of ``layer_name``, the head
+    from there to the output of the model. Both reuse the layers of
+    ``model``, so training the head trains the model. The head must be a
+    chain of layers.
+    """
+    cut = model.get_layer(layer_name)
+    trunk_layers = model.layers[:model.layers.index(cut) + 1]
+    if any(layer.trainable and layer.trainable_weights
+           for layer in trunk_layers):
+        raise ValueError('The layers up to {} must be frozen'.format(
+            layer_name))
+    trunk = Model(inputs=model.input, outputs=cut.output)
+
+    features = Input(shape=cut.output_shape[1:])
+    x = features
+    for layer in model.layers[len(trunk_layers):]:
+        x = layer(x)
+    return trunk, Model(inputs=features, outputs=x)
+
+
+def _key(trunk, sequence, rounds, dtype):
+    # type: (Model, ImageSequence, int, type) -> str
+    """ Identifies the activations: trunk weights, images and augmentation """
+    key = hashlib.sha1()
+    for weights in K.batch_get_value(trunk.weights):
+        key.update(np.ascontiguousarray(weights).tobytes())
+    description = [[(layer.name, type(layer).__name__)
+                    for layer in trunk.layers],
+                   sequence.manifest.key(), sequence.target_size,
+                   sequence.batch_size, sequence.seed, rounds,
+                   np.dtype(dtype).str]
+    if sequence.image_data_generator is not None:
+        description.append(sorted(
+            (name, repr(value)) for name, value in
+            vars(sequence.image_data_generator).items()))
+    key.update(repr(description).encode('utf-8'))
+    return key.hexdigest()
+
+
+class BottleneckCache(object):
+    """ Activations of a frozen trunk for every image of a sequence
+
+    The trunk runs once per image and augmentation round: round ``r`` has
+    the images of the epoch ``r`` of the sequence, so with a
+    ``BatchAugmenter`` every round is a different (seeded) augmentation, and
+    one round is enough for the images without augmentation. The
+    activations are stored in a memory-mapped (rounds, n_images, ...) file,
+    shared by every model with the same trunk and weights (e.g. all the
+    hyper-parameter search trials of a head).
+    """
+
+    def __init__(self, trunk, sequence, rounds=1, dtype=np.float32,
+                 path=BOTTLENECK_PATH):
+        # type: (Model, ImageSequence, int, type, str) -> None
+        """
+        :param sequence: the images, read in the manifest order (no shuffle)
+        :param rounds: augmented passes over the images
+        :param dtype: type of the stored activations (float16 halves them)
+        """
+        if sequence.shuffle:
+            raise ValueError('The images must be read in order, set '
+                             'shuffle=False')
+        self.path = os.path.join(path, _key(trunk, sequence, rounds, dtype))
+        self.num_classes = sequence.num_classes
+        if not os.path.isfile(os.path.join(self.path, 'class_ids.npy')):
+            self._build(trunk, sequence, rounds, dtype)
+        self.features = np.load(os.path.join(self.path, 'features.npy'),
+                                mmap_mode='r')
+        self.class_ids = np.load(os.path.join(self.path, 'class_ids.npy'))
+
+    def _build(self, trunk, sequence, rounds, dtype):
+        # type: (Model, ImageSequence, int, type) -> None
+        print('[bottleneck] Caching {} rounds of {} images...'.format(
+            rounds, sequence.samples))
+        init = time.time()
+        # Written apart and renamed, so an incomplete cache is never read
+        build_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            os.makedirs(build_path)
+        except OSError as expected:
+            pass
+        features = np.lib.format.open_memmap(
+            os.path.join(build_path, 'features.npy'), mode='w+', dtype=dtype,
+            shape=(rounds, sequence.samples) + trunk.output_shape[1:])
+
+        # A copy, the epochs of the given sequence do not change
+        sequence = copy.copy(sequence)
+        for round_index in range(rounds):
+            for batch_index in range(len(sequence)):
+                x, _ = sequence[batch_index]
+                start = batch_index * sequence.batch_size
+                features[round_index, start:start + len(x)] = \
+                    trunk.predict_on_batch(x)
+            sequence.on_epoch_end()
+        del features
+        np.save(os.path.join(build_path, 'class_ids.npy'),
+                sequence.manifest.class_ids)
+
+        try:
+            os.rename(build_path, self.path)
+        except OSError as expected:
+            # Built by another process meanwhile
+            shutil.rmtree(build_path)
+        print('Done in ' + str(time.time() - init) + ' secs.')
+
+    def sequence(self, batch_size=32, shuffle=True, seed=42):
+        # type: (int, bool, int) -> FeatureSequence
+        """ Batches of the cached activations, to train or evaluate a head """
+        return FeatureSequence(self.features, self.class_ids,
+                               self.num_classes, batch_size, shuffle, seed)
+
+
+class FeatureSequence(Sequence):
+    """ Batches of cached activations and one-hot labels
+
+    The epoch ``e`` reads the round ``e % rounds`` of the activations.
+    Without ``shuffle`` the images are in the manifest order (see
+    ``classes``), as ``ImageSequence``.
+    """
+
+    def __init__(self, features, class_ids, num_classes, batch_size=32,
+                 shuffle=True, seed=42):
+        # type: (np.array, np.array, int, int, bool, int) -> None
+        self.features = features
+        self.class_ids = class_ids
+        self.num_classes = num_classes
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+
+        self.epoch = 0
+        self.order = self._order()
+
+    @property
+    def classes(self):
+        # type: () -> np.array
+        """ Class id of every image, in the order of the batches """
+        return self.class_ids[self.order]
+
+    @property
+    def samples(self):
+        # type: () -> int
+        return len(self.class_ids)
+
+    def _order(self):
+        # type: () -> np.array
+        if not self.shuffle:
+            return np.arange(self.samples)
+        return np.random.RandomState(self.seed + self.epoch).permutation(
+            self.samples)
+
+    def __len__(self):
+        return int(np.ceil(self.samples / float(self.batch_size)))
+
+    def __getitem__(self, batch_index):
+        indices = self.order[batch_index * self.batch_size:
+                             (batch_index + 1) * self.batch_size]
+        if self.shuffle:
+            # Sorted, for sequential reads of the memory map
+            indices = np.sort(indices)
+        x = self.features[self.epoch % len(self.features)][indices]
+        y = np.zeros((len(indices), self.num_classes), dtype=np.float32)
+        y[np.arange(len(indices)), self.class_ids[indices]] = 1.
+        return x, y
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        self.order = self._order()
@@ -0,0 +1,155 @@
+import os
+import time
+
+import cv2
+import numpy as np
+from sklearn.calibration import CalibratedClassifierCV
+from sklearn.preprocessing import StandardScaler
+from sklearn.svm import LinearSVC
+from typing import List
+
+from bag_of_visual_words import BoVW
+from descriptor_set import DescriptorSet
+from evaluator import Evaluator
+from feature_extractor import ColourHistogram
+from feature_extractor import VectorisedDenseSIFT
+from sampling import sample_descriptor_set
+from source import TEST_PATH, TRAIN_PATH
+
+
+class CascadeClassifier(object):
+    """ Two stages classifier: cheap colour histograms, then dense SIFT BoVW
+
+    The first stage (``ColourHistogram`` + calibrated linear SVM) answers
+    when the probability of its predicted class reaches ``threshold``. Only
+    the remaining images are described with dense SIFT and classified by the
+    BoVW + SVM second stage.
+    """
+
+    def __init__(self, threshold=0.8, cheap_extractor=None,
+                 expensive_extractor=None, bovw=None, codebook_budget=100000):
+        # type: (float, ColourHistogram, VectorisedDenseSIFT, BoVW, int) -> None
+        """
+        :param codebook_budget: number of descriptors sampled to compute the
+            BoVW codebook
+        """
+        self.threshold = threshold
+        self.cheap_extractor = cheap_extractor or ColourHistogram(bins=32)
+        self.expensive_extractor = expensive_extractor or \
+                                   VectorisedDenseSIFT()
+        self.bovw = bovw or BoVW(k=512, spatial_pyramid=True)
+        self.codebook_budget = codebook_budget
+
+        self.scaler = None
+        self.cheap_classifier = None
+
+    @staticmethod
+    def _read(images_filenames, path):
+        # type: (List, str) -> List
+        return [cv2.imread(os.path.join(path, filename))
+                for filename in images_filenames]
+
+    def _describe(self, images):
+        # type: (List) -> DescriptorSet
+        """ Dense SIFT of a list of decoded images """
+        keypoints, descriptors = self.expensive_extractor.compute_list(images)
+        return DescriptorSet.from_images(descriptors,
+                                         ['no_label'] * len(images),
+                                         keypoints_per_image=keypoints)
+
+    def train(self, train_images_filenames, train_labels, path=TRAIN_PATH):
+        # type: (List, List, str) -> None
+        images = self._read(train_images_filenames, path)
+
+        print('[cascade] Training the colour histogram stage...')
+        init = time.time()
+        histograms = np.vstack(self.cheap_extractor.compute_histograms(images))
+        self.scaler = StandardScaler().fit(histograms)
+        self.cheap_classifier = CalibratedClassifierCV(LinearSVC(C=1.0),
+                                                       method='sigmoid', cv=3)
+        self.cheap_classifier.fit(self.scaler.transform(histograms),
+                                  train_labels)
+        print('Done in ' + str(time.time() - init) + ' secs.')
+
+        print('[cascade] Training the dense SIFT BoVW stage...')
+        init = time.time()
+        train_set = self._describe(images)
+        self.bovw.compute_codebook(
+            sample_descriptor_set(train_set, self.codebook_budget))
+        self.bovw.train_classifier(self.bovw.encode(train_set), train_labels)
+        print('Done in ' + str(time.time() - init) + ' secs.')
+
+    def _cheap_stage(self, images):
+        # type: (List) -> (np.array, np.array, float)
+        """ Predictions, confidences and seconds per image of the 1st stage
+        """
+        init = time.time()
+        histograms = np.vstack(self.cheap_extractor.compute_histograms(images))
+        probabilities = self.cheap_classifier.predict_proba(
+            self.scaler.transform(histograms))
+        predictions = self.cheap_classifier.classes_[
+            np.argmax(probabilities, axis=1)]
+        latency = (time.time() - init) / max(len(images), 1)
+        return predictions, probabilities.max(axis=1), latency
+
+    def _expensive_stage(self, images):
+        # type: (List) -> (np.array, float)
+        """ Predictions and seconds per image of the 2nd stage """
+        if not images:
+            return np.array([]), 0.
+        init = time.time()
+        visual_words = self.bovw.encode(self._describe(images))
+        predictions = self.bovw.clf.predict(
+            self.bovw.stdSlr.transform(visual_words))
+        latency = (time.time() - init) / len(images)
+        return predictions, latency
+
+    def predict(self, test_images_filenames, path=TEST_PATH, threshold=None):
+        # type: (List, str, float) -> np.array
+        """ Predicts the images, escalating only the uncertain ones """
+        threshold = self.threshold if threshold is None else threshold
+        images = self._read(test_images_filenames, path)
+
+        predictions, confidences, _ = self._cheap_stage(images)
+        uncertain = np.flatnonzero(confidences < threshold)
+        print('[cascade] {} of {} images go to the second stage'.format(
+            len(uncertain), len(images)))
+        if len(uncertain):
+            predictions = predictions.astype(object)
+            predictions[uncertain], _ = self._expensive_stage(
+                [images[i] for i in uncertain])
+        return predictions
+
+    def evaluate_thresholds(self, test_images_filenames, test_labels,
+                            thresholds=(0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 1.01),
+                            path=TEST_PATH):
+        # type: (List, List, tuple, str) -> List
+        """ Accuracy / latency trade-off of the cascade at every threshold
+
+        Both stages run once over all the images, then every threshold is
+        assessed by combining their predictions and latencies. A threshold
+        above 1 sends every image to the second stage.
+
+        :return: a dict per threshold with the accuracy, the fraction of
+            images escalated and the mean seconds per image
+        """
+        images = self._read(test_images_filenames, path)
+        cheap, confidences, cheap_latency = self._cheap_stage(images)
+        expensive, expensive_latency = self._expensive_stage(images)
+
+        report = list()
+        for threshold in thresholds:
+            escalated = confidences < threshold
+            predictions = np.where(escalated, expensive, cheap)
+            evaluator = Evaluator(test_labels, list(predictions))
+            report.append(dict(
+                threshold=threshold,
+                accuracy=evaluator.accuracy,
+                escalated=escalated.mean(),
+                latency=cheap_latency + escalated.mean() * expensive_latency))
+
+        print('threshold  accuracy  escalated  secs/image')
+        for row in report:
+            print('{threshold:9.2f}  {accuracy:8.4f}  {escalated:9.2%}  '
+                  '{latency:10.4f}'.format(**row))
+        return report
@@ -1,3 +1,7 @@
+from multiprocessing.pool import ThreadPool
+import hashlib
+import os
+
 import numpy as np
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.naive_bayes import BernoulliNB
@@ -7,6 +11,12 @@ from sklearn.svm import LinearSVC
 from typing import Any
 from typing import List
 
+from descriptor_set import DescriptorSet
+from descriptor_transform import DescriptorTransform
+from nearest_neighbours import ApproximateKNeighborsClassifier
+from nearest_neighbours import BruteForceIndex
+from nearest_neighbours import RandomProjectionForest
+
 
 class ClassifierFactory(object):
     KNN = 'knn'
@@ -15,6 +25,7 @@ class ClassifierFactory(object):
     BERNOULLI_BAYES = 'bernoulli_bayes'
     SVM = 'svm'
     LOGISTIC_REGRESSION = 'logistic_regression'
+    NBNN = 'nbnn'
 
     @staticmethod
     def build(name, **kwargs):
@@ -25,7 +36,8 @@ class ClassifierFactory(object):
             'gaussian_bayes': GaussianBayes,
             'bernoulli_bayes': BernoulliBayes,
             'svm': SVM,
-            'logistic_regression': LogisticRegression
+            'logistic_regression': LogisticRegression,
+            'nbnn': NBNN
         }
         return classifiers.get(name, None)(**kwargs)
 
@@ -37,6 +49,12 @@ class BaseClassifier(object):
         # type: (List, List) -> None
         self.model._fit(descriptors, labels)
 
+    def train_descriptor_set(self, descriptor_set):
+        # type: (DescriptorSet) -> None
+        """ Train with every descriptor labelled as the image it comes from """
+        self.train(descriptor_set.descriptors,
+                   descriptor_set.descriptor_labels())
+
     def predict(self, descriptor):
         # type: (np.array) -> np.array
         predictions = self.model.predict(descriptor)
@@ -52,9 +70,183 @@ class BaseClassifier(object):
 
 
 class KNN(BaseClassifier):
-    def __init__(self, n_neighbors=5):
-        # type: (int) -> None
-        self.model = KNeighborsClassifier(n_neighbors=n_neighbors, n_jobs=-1)
+    def __init__(self, n_neighbors=5, approximate=False, n_trees=8,
+                 leaf_size=64, index_path=None, transform=None):
+        # type: (int, bool, int, int, str, DescriptorTransform) -> None
+        """ k-NN classifier, exact or approximate
+
+        With ``approximate`` the neighbours are searched in a random projection
+        forest (see ``nearest_neighbours.RandomProjectionForest``). Its recall
+        is tuned with ``n_trees`` and ``leaf_size``. If ``index_path`` is
+        given the index is saved there after training, and loaded from there
+        instead of being rebuilt if it was built from the same descriptors,
+        labels and parameters.
+
+        With a ``transform`` (see ``DescriptorTransform``) the neighbours are
+        searched among the reduced descriptors. It is fitted on the training
+        descriptors if it is not fitted yet.
+        """
+        self.approximate = approximate
+        self.index_path = index_path
+        self.transform = transform
+        if approximate:
+            self.model = ApproximateKNeighborsClassifier(
+                n_neighbors=n_neighbors, n_trees=n_trees, leaf_size=leaf_size)
+        else:
+            self.model = KNeighborsClassifier(n_neighbors=n_neighbors,
+                                              n_jobs=-1)
+
+    def _compress(self, descriptors):
+        # type: (np.array) -> np.array
+        if self.transform is None:
+            return descriptors
+        return self.transform.compress(descriptors)
+
+    def train(self, descriptors, labels):
+        # type: (List, List) -> None
+        if self.transform is not None and not self.transform.fitted:
+            print('Fitting the descriptor transform...')
+            self.transform.fit(descriptors)
+        descriptors = self._compress(descriptors)
+        if not self.approximate:
+            return super(KNN, self).train(descriptors, labels)
+
+        key = self._index_key(descriptors, labels)
+        key_path = os.path.join(self.index_path or '', 'key.dat')
+        if self.index_path and os.path.isfile(key_path):
+            with open(key_path) as key_file:
+                if key_file.read() == key:
+                    print('Loading k-NN index from {}'.format(
+                        self.index_path))
+                    self.model = ApproximateKNeighborsClassifier.load(
+                        self.index_path)
+                    return
+            print('Rebuilding the stale k-NN index in {}'.format(
+                self.index_path))
+            os.remove(key_path)
+
+        self.model.fit(descriptors, labels)
+        if self.index_path:
+            self.model.save(self.index_path)
+            # Written last, an index saved halfway is never loaded
+            with open(key_path, 'w') as key_file:
+                key_file.write(key)
+
+    def predict(self, descriptor):
+        # type: (np.array) -> np.array
+        return super(KNN, self).predict(self._compress(descriptor))
+
+    def _index_key(self, descriptors, labels):
+        # type: (np.array, List) -> str
+        """ Identifies an index: training data and parameters """
+        index = self.model.index
+        key = hashlib.sha1()
+        descriptors = np.ascontiguousarray(descriptors)
+        key.update(repr((descriptors.shape, descriptors.dtype.str)).encode(
+            'utf-8'))
+        key.update(descriptors.tobytes())
+        key.update(u'\n'.join(u'{}'.format(label)
+                               for label in labels).encode('utf-8'))
+        key.update(repr((self.model.n_neighbors, index.n_trees,
+                         index.leaf_size, index.batch_size,
+                         index.random_state)).encode('utf-8'))
+        return key.hexdigest()
+
+
+class NBNN(BaseClassifier):
+    # (process id, threads) of the queries, also for the pickled instances
+    _pool = None
+
+    def __init__(self, approximate=False, n_trees=4, leaf_size=64, n_jobs=1):
+        # type: (bool, int, int, int) -> None
+        """ Naive-Bayes nearest-neighbour (image-to-class) classifier
+
+        It builds one nearest-neighbour index per class with the training
+        descriptors of that class. An image is classified as the class that
+        minimises the sum, over all the image descriptors, of the distance to
+        their nearest neighbour in the class. No codebook is needed.
+
+        The indexes are exact unless ``approximate`` is set (see ``KNN``). The
+        classes are queried in ``n_jobs`` threads (the distance computation
+        runs in numpy, which releases the GIL), started on the first query and
+        kept until ``close``.
+        """
+        self.approximate = approximate
+        self.n_trees = n_trees
+        self.leaf_size = leaf_size
+        self.n_jobs = n_jobs
+        self.classes = None
+        self.indexes = list()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return state
+
+    def __del__(self):
+        self.close()
+
+    def _threads(self):
+        # type: () -> ThreadPool
+        """ Threads of the queries of this process, started once """
+        if self._pool is None or self._pool[0] != os.getpid():
+            self._pool = (os.getpid(), ThreadPool(
+                len(self.indexes) if self.n_jobs < 1 else self.n_jobs))
+        return self._pool[1]
+
+    def close(self):
+        # type: () -> None
+        """ Stops the threads of the queries """
+        pool, self._pool = self._pool, None
+        if pool is not None and pool[0] == os.getpid():
+            pool[1].close()
+            pool[1].join()
+
+    def _build_index(self):
+        if self.approximate:
+            return RandomProjectionForest(n_trees=self.n_trees,
+                                          leaf_size=self.leaf_size)
+        return BruteForceIndex()
+
+    def train(self, descriptors, labels):
+        # type: (np.array, List) -> None
+        # The threads are sized for the classes
+        self.close()
+        labels = np.asarray(labels)
+        self.classes = np.unique(labels)
+        self.indexes = [self._build_index().fit(descriptors[labels == label])
+                        for label in self.classes]
+
+    def train_descriptor_set(self, descriptor_set):
+        # type: (DescriptorSet) -> None
+        self.close()
+        class_ids = descriptor_set.descriptor_class_ids()
+        present = np.unique(class_ids)
+        self.classes = descriptor_set.label_table[present]
+        self.indexes = [
+            self._build_index().fit(
+                descriptor_set.descriptors[class_ids == class_id])
+            for class_id in present]
+
+    def image_to_class_distances(self, descriptor):
+        # type: (np.array) -> np.array
+        """ Sum of nearest-neighbour distances of an image to every class """
+        descriptor = np.asarray(descriptor, dtype=np.float32)
+
+        def _distance(index):
+            distances, _ = index.query(descriptor, n_neighbors=1)
+            return distances.sum()
+
+        if self.n_jobs == 1:
+            return np.array([_distance(index) for index in self.indexes])
+
+        return np.array(self._threads().map(_distance, self.indexes))
+
+    def predict(self, descriptor):
+        # type: (np.array) -> np.array
+        """ Predicts the class of one image given all its descriptors """
+        distances = self.image_to_class_distances(descriptor)
+        return self.classes[[np.argmin(distances)]]
 
 
 class RandomForest(BaseClassifier):
@@ -1,74 +1,129 @@
 import glob
+import hashlib
+import os
 
 import numpy as np
-from keras.preprocessing.image import ImageDataGenerator
 from scipy import misc
+from typing import List
+from typing import Tuple
 
+from batch_augmentation import BatchAugmenter
 from data_generator_config import DataGeneratorConfig
+from image_sequence import ImageSequence
+from image_sequence import Manifest
+from source import CACHE_PATH
+
+# Cache of the featurewise statistics of the datasets
+STATISTICS_PATH = os.path.join(CACHE_PATH, 'featurewise_statistics')
+
+
+def featurewise_statistics(paths, cache_path=STATISTICS_PATH):
+    # type: (List, str) -> Tuple[np.array, np.array]
+    """ Mean and std of every channel over all the pixels of the images
+
+    Images are read one at a time: the statistics of each image are merged
+    into float64 accumulators with the parallel update of Chan et al., so the
+    dataset is never held in memory. The result equals ``np.mean`` and
+    ``np.std`` over the stacked images, as ``ImageDataGenerator.fit``.
+
+    The statistics are cached in ``cache_path``, keyed by the list of paths
+    (which includes the dataset path).
+    """
+    key = hashlib.sha1('\n'.join(paths).encode('utf-8')).hexdigest()
+    cache_file = os.path.join(cache_path, '{}.npz'.format(key))
+    if os.path.isfile(cache_file):
+        statistics = np.load(cache_file)
+        return statistics['mean'], statistics['std']
+
+    count, mean, m2 = 0, None, None
+    for path in paths:
+        pixels = misc.imread(path)
+        pixels = pixels.reshape(-1, pixels.shape[-1]).astype(np.float64)
+        image_count = len(pixels)
+        image_mean = pixels.mean(axis=0)
+        image_m2 = ((pixels - image_mean) ** 2).sum(axis=0)
+        if mean is None:
+            count, mean, m2 = image_count, image_mean, image_m2
+            continue
+        delta = image_mean - mean
+        total = count + image_count
+        mean = mean + delta * image_count / total
+        m2 = m2 + image_m2 + delta ** 2 * count * image_count / total
+        count = total
+    std = np.sqrt(m2 / count)
+
+    try:
+        os.makedirs(cache_path)
+    except OSError as expected:
+        pass
+    np.savez(cache_file, mean=mean, std=std, count=count)
+    return mean, std
 
 
 class DataGenerator(object):
-    def __init__(self, img_width, img_height, batch_size, train_path):
-        """ Path used for normalizing the train set afterwards """
+    def __init__(self, img_width, img_height, batch_size, train_path,
+                 cache_images=False, uint8=False):
+        """ Path used for normalizing the train set afterwards
+
+        The datasets are read through an ``ImageSequence`` (listed once in a
+        manifest), ``cache_images`` keeps the decoded images in a cache. The
+        configurations are applied to whole batches by a ``BatchAugmenter``.
+        With ``uint8`` the batches are uint8 images and the normalisation is
+        left to the model (see ``InputNormalisation``).
+        """
         self.img_width = img_width
         self.img_height = img_height
         self.batch_size = batch_size
         self.train_path = train_path
-        self.data_generator = ImageDataGenerator(
-            **DataGeneratorConfig.NORMALISE)
+        self.cache_images = cache_images
+        self.uint8 = uint8
+        self.data_generator = BatchAugmenter(
+            uint8_output=uint8, **DataGeneratorConfig.NORMALISE)
 
     def configure(self, config):  # type: (dict) -> None
         """ Load a DataGeneratorConfig into the DataGenerator.
 
         If not done it uses the DataGeneratorConfig.DEFAULT
         """
-        self.data_generator = ImageDataGenerator(**config)
+        self.data_generator = BatchAugmenter(uint8_output=self.uint8, **config)
         self._fit()
 
     def _fit(self):
-        """ Fits the datagenerator if needed """
-        paths = glob.glob(self.train_path + '/*/*.jpg')
+        """ Sets the featurewise statistics of the generator if needed
+
+        The mean and std of every channel are computed in a single pass over
+        the train images (see ``featurewise_statistics``), and cached, instead
+        of loading the whole dataset for ``ImageDataGenerator.fit``.
+        """
+        generator = self.data_generator
+        if getattr(generator, 'zca_whitening', False):
+            raise ValueError('ZCA whitening needs the whole dataset in '
+                             'memory, it is not supported')
+        if not (generator.featurewise_center or
+                generator.featurewise_std_normalization):
+            return
+
+        paths = sorted(glob.glob(self.train_path + '/*/*.jpg'))
         if not paths:
             raise ValueError('No images found in {}'.format(self.train_path))
-        number_of_images = len(paths)
         print('Got {} images in {} for pre-processing'.format(
-            self.train_path, number_of_images))
-
-        example_image = misc.imread(paths[0])
-        image_size = example_image.shape
-
-        data = np.zeros(
-            (number_of_images, image_size[0], image_size[1], image_size[2]))
-        for (i, path) in enumerate(paths):
-            image = misc.imread(path)
-            data[i, :, :, :] = image
+            len(paths), self.train_path))
 
-        self.data_generator.fit(data)
+        mean, std = featurewise_statistics(paths)
+        # Same broadcast shape as ImageDataGenerator.fit
+        broadcast_shape = [1, 1, 1]
+        broadcast_shape[generator.channel_axis - 1] = len(mean)
+        generator.mean = np.reshape(mean, broadcast_shape).astype(np.float32)
+        generator.std = np.reshape(std, broadcast_shape).astype(np.float32)
 
     def get(self, train_path, test_path, validate_path):
         """ Get datasets generators given a data generator
 
         :return (train, test, validation) generators
         """
-        train_generator = self.data_generator.flow_from_directory(
-            train_path,
-            target_size=(self.img_width, self.img_height),
-            batch_size=self.batch_size,
-            class_mode='categorical')
-
-        test_generator = self.data_generator.flow_from_directory(
-            test_path,
-            target_size=(self.img_width, self.img_height),
-            batch_size=self.batch_size,
-            class_mode='categorical',
-            shuffle=False)
-
-        validation_generator = self.data_generator.flow_from_directory(
-            validate_path,
-            target_size=(self.img_width,
-                         self.img_height),
-            batch_size=self.batch_size,
-            class_mode='categorical')
+        train_generator = self.get_single(train_path)
+        test_generator = self.get_single(test_path, shuffle=False)
+        validation_generator = self.get_single(validate_path)
         return train_generator, test_generator, validation_generator
 
     def get_single(self, path, shuffle=True):
@@ -76,11 +131,9 @@ class DataGenerator(object):
 
         :return single generators
         """
-        generator = self.data_generator.flow_from_directory(
-            path,
-            target_size=(self.img_width, self.img_height),
-            batch_size=self.batch_size,
-            class_mode='categorical',
-            shuffle=shuffle)
-
-        return generator
+        return ImageSequence(Manifest.load(path),
+                             target_size=(self.img_width, self.img_height),
+                             batch_size=self.batch_size,
+                             shuffle=shuffle,
+                             image_data_generator=self.data_generator,
+                             cache=self.cache_images)
@@ -1,9 +1,14 @@
 import cPickle
-import glob
 import os
 
+import numpy as np
 from typing import List
 
+from descriptor_set import DescriptorSet
+from descriptor_transform import DescriptorTransform
+from descriptor_transform import REDUCED_DTYPE
+from feature_extractor import MultiFeatureExtractor
+
 
 class Database(object):
     """ Implements a directory-based database """
@@ -145,6 +150,141 @@ class Database(object):
         return descriptors, labels
 
 
+    def get_descriptor_set_path(self, dataset_name):
+        # type: (str) -> str
+        return os.path.join(self.base_path, dataset_name, 'descriptor_set')
+
+    def save_descriptor_set(self, descriptor_set, dataset_name):
+        # type: (DescriptorSet, str) -> None
+        """ Save a DescriptorSet, keeping the image boundaries """
+        descriptor_set.save(self.get_descriptor_set_path(dataset_name))
+
+    def get_descriptor_set(self, dataset_name, mmap_mode=None):
+        # type: (str, str) -> DescriptorSet
+        return DescriptorSet.load(self.get_descriptor_set_path(dataset_name),
+                                  mmap_mode=mmap_mode)
+
+    def descriptor_set_exists(self, dataset_name):
+        # type: (str) -> bool
+        return DescriptorSet.exists(
+            self.get_descriptor_set_path(dataset_name))
+
+    def load_descriptor_set_in_memory(self, dataset_name, feature_extractor,
+                                      images, labels, mmap_mode=None,
+                                      transform=None, streaming=False,
+                                      prefetch=8):
+        # type: (str, BaseFeatureExtractor, List, List, str, DescriptorTransform, bool, int) -> DescriptorSet
+        """ Loads the DescriptorSet of a dataset, computing it if needed
+
+        With a ``transform`` (see ``DescriptorTransform``) the reduced
+        descriptors are cached as float16 instead of the raw ones, in a
+        dataset named after the transform parameters
+        (``'{dataset_name}_{transform.cache_key()}'``). The transform is
+        fitted on the first computed dataset (if not fitted yet) and saved
+        with it, so the next runs restore it from the cache. A cached set
+        reduced by another fit of the transform is computed again.
+
+        With ``streaming`` the descriptors are computed and written to disk
+        one image at a time (see ``BaseFeatureExtractor.iter_descriptors``)
+        and the set is returned memory-mapped, for datasets that do not fit
+        in memory. A transform must then be already fitted.
+        """
+        if transform is not None:
+            dataset_name = '{}_{}'.format(dataset_name, transform.cache_key())
+        transform_path = os.path.join(
+            self.get_descriptor_set_path(dataset_name), 'transform.dat')
+        saved = None
+        if os.path.isfile(transform_path):
+            with open(transform_path, 'rb') as transform_file:
+                saved = cPickle.load(transform_file)
+
+        cached = self.descriptor_set_exists(dataset_name) and \
+            (saved is None) == (transform is None)
+        if cached and transform is not None:
+            if not transform.fitted:
+                transform.__dict__.update(saved.__dict__)
+            elif not np.array_equal(saved.pca.components_,
+                                    transform.pca.components_):
+                print('Descriptors reduced by another fit of the transform')
+                cached = False
+
+        if cached:
+            print('Loading descriptors: {}'.format(dataset_name))
+            descriptor_set = self.get_descriptor_set(dataset_name, mmap_mode)
+        else:
+            if saved is not None:
+                # Stale: the descriptors computed now replace the reduced ones
+                os.remove(transform_path)
+            print('Computing descriptors: {}'.format(dataset_name))
+            if streaming:
+                descriptor_set = self._save_descriptor_stream(
+                    dataset_name, feature_extractor, images, labels,
+                    transform, prefetch)
+            else:
+                descriptor_set = feature_extractor.extract_descriptor_set(
+                    images, labels)
+                if transform is not None:
+                    if not transform.fitted:
+                        transform.fit(descriptor_set.descriptors)
+                    descriptor_set = transform.transform_set(descriptor_set,
+                                                             REDUCED_DTYPE)
+                self.save_descriptor_set(descriptor_set, dataset_name)
+            if transform is not None:
+                with open(transform_path, 'wb') as transform_file:
+                    cPickle.dump(transform, transform_file,
+                                 cPickle.HIGHEST_PROTOCOL)
+
+        print('Loaded {} descriptors of {} images'.format(
+            len(descriptor_set.descriptors), len(descriptor_set)))
+        return descriptor_set
+
+
+    def _save_descriptor_stream(self, dataset_name, feature_extractor,
+                                images, labels, transform=None, prefetch=8):
+        # type: (str, BaseFeatureExtractor, List, List, DescriptorTransform, int) -> DescriptorSet
+        """ Computes and saves a DescriptorSet one image at a time """
+        items = feature_extractor.iter_descriptors(images, prefetch)
+        if transform is not None:
+            if not transform.fitted:
+                raise ValueError('The transform must be fitted to stream '
+                                 'the descriptors of {}'.format(dataset_name))
+            items = ((image_id, keypoints, None if descriptors is None else
+                      transform.transform(descriptors, REDUCED_DTYPE))
+                     for image_id, keypoints, descriptors in items)
+        return DescriptorSet.save_iter(
+            self.get_descriptor_set_path(dataset_name), items, labels)
+
+    def load_descriptor_sets_in_memory(self, dataset_prefix,
+                                       feature_extractors, images, labels,
+                                       mmap_mode=None):
+        # type: (str, List, List, List, str) -> List[DescriptorSet]
+        """ Loads a DescriptorSet per extractor, computing the missing ones
+        in a single pass over the images
+
+        Every feature is cached in its own dataset, named
+        ``'{dataset_prefix}_{feature_extractor.cache_key()}'``, so it can also
+        be loaded alone with ``load_descriptor_set_in_memory``.
+        """
+        dataset_names = ['{}_{}'.format(dataset_prefix,
+                                        feature_extractor.cache_key())
+                         for feature_extractor in feature_extractors]
+        missing = [i for i, name in enumerate(dataset_names)
+                   if not self.descriptor_set_exists(name)]
+        if missing:
+            print('Computing descriptors: {}'.format(
+                ', '.join(dataset_names[i] for i in missing)))
+            computed = MultiFeatureExtractor(
+                [feature_extractors[i] for i in missing]
+            ).extract_descriptor_sets(images, labels)
+            for i, descriptor_set in zip(missing, computed):
+                self.save_descriptor_set(descriptor_set, dataset_names[i])
+
+        return [self.load_descriptor_set_in_memory(name, feature_extractor,
+                                                   images, labels, mmap_mode)
+                for name, feature_extractor in zip(dataset_names,
+                                                   feature_extractors)]
+
+
 class DatabaseFiles(Database):
     def __init__(self, path):
         # type: (str) -> None
@@ -159,41 +299,79 @@ class DatabaseFiles(Database):
         self.datasets.update({name: Dataset(self.base_path, name)})
 
     def get_dataset(self, name):
+        if name not in self.datasets:
+            self.create_dataset(name)
         return self.datasets.get(name)
 
+    def load_images_in_memory(self, dataset_name, feature_extractor, images,
+                              labels):
+        # type: (str, BaseFeatureExtractor, List, List) -> (List, List)
+        """ Loads in memory the descriptors of each image, one array per image
+
+        The descriptors of the images not in the dataset yet are computed and
+        saved, so both train and test descriptors can be cached and the
+        predictions can still be done by image.
+        """
+        dataset = self.get_dataset(dataset_name)
+        print('Loading descriptors: {}'.format(dataset.path))
+        descriptors = dataset.load_or_compute(feature_extractor, images,
+                                              labels)
+        print('Loaded descriptors of {} images'.format(len(descriptors)))
+        return descriptors, labels
+
 
 class FilesMissing(Exception):
     pass
 
 
 class Dataset(object):
+    """ Implements a folder with the descriptors and label of every image
+
+    An image ``<class>/<name>.jpg`` is saved as ``<class>/<name>.des`` (its
+    descriptors) and ``<class>/<name>.lab`` (its label).
+    """
+
     def __init__(self, basepath, name):
         # type: (str, str) -> None
         self.path = os.path.join(basepath, name)
         if not os.path.exists(self.path):
-            os.mkdir(self.path)
+            os.makedirs(self.path)
 
     def exists(self):
         # type (str) -> bool
         """ True if it contains descriptors, false if it is empty """
-        list_of_descriptors = glob.glob('{}/*.des'.format(self.path))
-        list_of_labels = glob.glob('{}/*.lab'.format(self.path))
-        if list_of_descriptors.__len__() != list_of_labels.__len__():
+        number_of_descriptors, number_of_labels = 0, 0
+        for _, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                if filename.endswith('.des'):
+                    number_of_descriptors += 1
+                elif filename.endswith('.lab'):
+                    number_of_labels += 1
+        if number_of_descriptors != number_of_labels:
             raise FilesMissing(
                 'It should be the same number of descriptors than labels')
-        return bool(list_of_descriptors)
+        return bool(number_of_descriptors)
 
-    def load_descriptor(self, image_relative_path):
-        """ Loads a descriptor and a label from an image in memory """
+    def get_paths(self, image_relative_path):
+        # type: (str) -> (str, str)
+        """ Returns the descriptor and label paths of an image """
         absolute_path = os.path.join(self.path, image_relative_path)
         filename_without_extension = absolute_path.rsplit('.', 1)[0]
-        print filename_without_extension
-        die()
-        descriptor_path = filename_without_extension + '.des'
-        label_path = filename_without_extension + '.lab'
+        return filename_without_extension + '.des', \
+               filename_without_extension + '.lab'
 
-        with open(descriptor_path, 'r') as descriptor_file, \
-            open(label_path, 'r') as label_file:
+    def contains(self, image_relative_path):
+        # type: (str) -> bool
+        """ Checks if the descriptors of an image are saved """
+        descriptor_path, label_path = self.get_paths(image_relative_path)
+        return os.path.isfile(descriptor_path) and os.path.isfile(label_path)
+
+    def load_descriptor(self, image_relative_path):
+        """ Loads a descriptor and a label from an image in memory """
+        descriptor_path, label_path = self.get_paths(image_relative_path)
+
+        with open(descriptor_path, 'rb') as descriptor_file, \
+            open(label_path, 'rb') as label_file:
             descriptor = cPickle.load(descriptor_file)
             label = cPickle.load(label_file)
 
@@ -205,20 +383,33 @@ class Dataset(object):
 
         :param image_relative_path: path of the image (to retrieve the name)
         """
-        absolute_path = os.path.join(self.path, image_relative_path)
-        filename_without_extension = absolute_path.rsplit('.', 1)[0]
-        descriptor_path = filename_without_extension + '.des'
-        label_path = filename_without_extension + '.lab'
+        descriptor_path, label_path = self.get_paths(image_relative_path)
 
         try:
             os.makedirs(os.path.dirname(descriptor_path))
         except OSError as expected:
             pass
 
-        with open(descriptor_path, 'w') as descriptor_file, \
-            open(label_path, 'w') as label_file:
-            cPickle.dump(descriptor, descriptor_file)
-            cPickle.dump(label, label_file)
+        with open(descriptor_path, 'wb') as descriptor_file, \
+            open(label_path, 'wb') as label_file:
+            cPickle.dump(descriptor, descriptor_file, cPickle.HIGHEST_PROTOCOL)
+            cPickle.dump(label, label_file, cPickle.HIGHEST_PROTOCOL)
+
+    def load_or_compute(self, feature_extractor, image_list, label_list):
+        # type: (BaseFeatureExtractor, List, List) -> List
+        """ Loads the descriptors of every image, computing the missing ones
+
+        :return: list of descriptors, one array per image
+        """
+        descriptors = list()
+        for image, label in zip(image_list, label_list):
+            if self.contains(image):
+                descriptor, _ = self.load_descriptor(image)
+            else:
+                descriptor = feature_extractor.extract_pool(image)
+                self.save_descriptor(image, descriptor, label)
+            descriptors.append(descriptor)
+        return descriptors
 
     def load_all(self, image_list):
         """ Loads in memory the available descriptors.
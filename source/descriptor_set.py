@@ -0,0 +1,319 @@
+import os
+
+import numpy as np
+from typing import Iterator
+from typing import List
+from typing import Tuple
+
+
+class DescriptorSet(object):
+    """ Descriptors of a set of images stored in a few compact arrays
+
+    - ``descriptors``: contiguous (n_descriptors, dimension) matrix with the
+      descriptors of all the images, one image after the other.
+    - ``offsets``: int32 array of n_images + 1 elements, the descriptors of
+      the image ``i`` are ``descriptors[offsets[i]:offsets[i + 1]]``.
+    - ``class_ids``: int8 class of every image, an index of ``label_table``.
+    - ``x``, ``y``, ``size``, ``angle``: float32 arrays with the key-point of
+      every descriptor (optional, None if unknown).
+
+    Labels are kept per image, not per descriptor, and key-points are not
+    kept as ``cv2.KeyPoint`` objects. Per image accessors return views, they
+    do not copy.
+    """
+    KEYPOINT_FIELDS = ('x', 'y', 'size', 'angle')
+
+    def __init__(self, descriptors, offsets, class_ids, label_table,
+                 keypoints=None):
+        # type: (np.array, np.array, np.array, np.array, np.array) -> None
+        """
+        :param keypoints: (n_descriptors, 4) array with the x, y, size and
+            angle of every descriptor key-point, or None
+        """
+        self.descriptors = descriptors
+        self.offsets = np.asarray(offsets, dtype=np.int32)
+        self.class_ids = np.asarray(class_ids, dtype=np.int8)
+        self.label_table = np.asarray(label_table)
+        self.x, self.y, self.size, self.angle = None, None, None, None
+        if keypoints is not None:
+            for field, values in zip(self.KEYPOINT_FIELDS,
+                                     np.asarray(keypoints, np.float32).T):
+                setattr(self, field, np.ascontiguousarray(values))
+
+    @classmethod
+    def from_images(cls, descriptors_per_image, labels,
+                    keypoints_per_image=None, label_table=None):
+        # type: (List, List, List, List) -> DescriptorSet
+        """ Builds a set from the descriptors and label of every image
+
+        :param descriptors_per_image: list of arrays, one per image
+        :param labels: list of labels of the given images
+        :param keypoints_per_image: list of key-points (``cv2.KeyPoint`` lists
+            or arrays, see ``keypoints_to_array``), one per image
+        :param label_table: list of all the labels, to keep the same class ids
+            in different sets. Taken from ``labels`` if None
+        """
+        if label_table is None:
+            label_table = np.unique(labels)
+        label_table = np.asarray(label_table)
+        if len(label_table) > np.iinfo(np.int8).max:
+            raise ValueError('Too many classes: {}'.format(len(label_table)))
+
+        sizes = [0 if d is None else len(d) for d in descriptors_per_image]
+        offsets = np.zeros(len(sizes) + 1, dtype=np.int32)
+        np.cumsum(sizes, out=offsets[1:])
+
+        non_empty = [d for d in descriptors_per_image
+                     if d is not None and len(d)]
+        dimension = non_empty[0].shape[1] if non_empty else 0
+        dtype = non_empty[0].dtype if non_empty else np.float32
+        descriptors = np.empty((offsets[-1], dimension), dtype=dtype)
+        for i, image_descriptors in enumerate(descriptors_per_image):
+            if sizes[i]:
+                descriptors[offsets[i]:offsets[i + 1]] = image_descriptors
+
+        keypoints = None
+        if keypoints_per_image is not None:
+            keypoints = np.empty((offsets[-1], 4), dtype=np.float32)
+            for i, image_keypoints in enumerate(keypoints_per_image):
+                if sizes[i]:
+                    keypoints[offsets[i]:offsets[i + 1]] = \
+                        keypoints_to_array(image_keypoints)
+
+        class_ids = _class_ids(labels, label_table)
+        return cls(descriptors, offsets, class_ids, label_table, keypoints)
+
+    def __len__(self):
+        """ Number of images """
+        return len(self.offsets) - 1
+
+    @property
+    def counts(self):
+        # type: () -> np.array
+        """ Number of descriptors of every image """
+        return np.diff(self.offsets)
+
+    @property
+    def labels(self):
+        # type: () -> np.array
+        """ Label of every image """
+        return self.label_table[self.class_ids]
+
+    def image(self, i):
+        # type: (int) -> np.array
+        """ Descriptors of the image ``i`` (a view) """
+        return self.descriptors[self.offsets[i]:self.offsets[i + 1]]
+
+    def keypoints(self, i):
+        # type: (int) -> np.array
+        """ (n, 4) x, y, size and angle of the key-points of the image ``i``
+        """
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return np.stack([getattr(self, field)[start:end]
+                         for field in self.KEYPOINT_FIELDS], axis=1)
+
+    def has_keypoints(self):
+        # type: () -> bool
+        return self.x is not None
+
+    def split(self):
+        # type: () -> List
+        """ Descriptors of every image, as a list of views """
+        return np.split(self.descriptors, self.offsets[1:-1])
+
+    def descriptor_class_ids(self):
+        # type: () -> np.array
+        """ Class id of every descriptor """
+        return np.repeat(self.class_ids, self.counts)
+
+    def descriptor_labels(self):
+        # type: () -> np.array
+        """ Label of every descriptor """
+        return self.label_table[self.descriptor_class_ids()]
+
+    def descriptor_image_ids(self):
+        # type: () -> np.array
+        """ Image index of every descriptor """
+        return np.repeat(np.arange(len(self), dtype=np.int32), self.counts)
+
+    def select(self, image_indices):
+        # type: (List) -> DescriptorSet
+        """ New set with only some images (it copies) """
+        image_indices = np.asarray(image_indices)
+        descriptor_indices = np.concatenate(
+            [np.arange(self.offsets[i], self.offsets[i + 1])
+             for i in image_indices] + [np.zeros(0, dtype=np.int64)])
+        offsets = np.zeros(len(image_indices) + 1, dtype=np.int32)
+        np.cumsum(self.counts[image_indices], out=offsets[1:])
+        keypoints = None
+        if self.has_keypoints():
+            keypoints = np.stack([getattr(self, field)[descriptor_indices]
+                                  for field in self.KEYPOINT_FIELDS], axis=1)
+        return DescriptorSet(self.descriptors[descriptor_indices], offsets,
+                             self.class_ids[image_indices], self.label_table,
+                             keypoints)
+
+    def save(self, path):
+        # type: (str) -> None
+        """ Save the set as a folder of arrays """
+        try:
+            os.makedirs(path)
+        except OSError as expected:
+            pass
+
+        arrays = dict(descriptors=self.descriptors, offsets=self.offsets,
+                      class_ids=self.class_ids, label_table=self.label_table)
+        if self.has_keypoints():
+            arrays.update((field, getattr(self, field))
+                          for field in self.KEYPOINT_FIELDS)
+        for name, array in arrays.items():
+            np.save(os.path.join(path, '{}.npy'.format(name)), array)
+
+    @classmethod
+    def save_iter(cls, path, items, labels, label_table=None,
+                  chunk_size=1 << 20):
+        # type: (str, Iterator, List, List, int) -> DescriptorSet
+        """ Save a set given the descriptors of one image at a time
+
+        Only one image is kept in memory: the descriptors and key-points are
+        appended to raw files, then copied by chunks to the arrays read by
+        ``load``.
+
+        :param items: (image id, key-points, descriptors) of every image in
+            order, see ``BaseFeatureExtractor.iter_descriptors``
+        :param labels: label of every image
+        :param chunk_size: rows copied at once from the raw files
+        :return: the saved set, memory-mapped
+        """
+        try:
+            os.makedirs(path)
+        except OSError as expected:
+            pass
+
+        if label_table is None:
+            label_table = np.unique(labels)
+        label_table = np.asarray(label_table)
+        class_ids = _class_ids(labels, label_table)
+
+        counts = np.zeros(len(labels), dtype=np.int64)
+        dtype, dimension, has_keypoints = np.float32, 0, False
+        raw_descriptors = os.path.join(path, 'descriptors.raw')
+        raw_keypoints = os.path.join(path, 'keypoints.raw')
+        with open(raw_descriptors, 'wb') as descriptors_file, \
+                open(raw_keypoints, 'wb') as keypoints_file:
+            for expected_id, (image_id, keypoints, descriptors) in \
+                    enumerate(items):
+                if image_id != expected_id:
+                    raise ValueError('Images must be given in order, got {} '
+                                     'instead of {}'.format(image_id,
+                                                            expected_id))
+                if descriptors is None or not len(descriptors):
+                    continue
+                if not counts.any():
+                    dtype, dimension = descriptors.dtype, descriptors.shape[1]
+                    has_keypoints = keypoints is not None
+                np.ascontiguousarray(descriptors, dtype).tofile(
+                    descriptors_file)
+                if has_keypoints:
+                    keypoints_to_array(keypoints).tofile(keypoints_file)
+                counts[image_id] = len(descriptors)
+
+        offsets = np.zeros(len(labels) + 1, dtype=np.int32)
+        np.cumsum(counts, out=offsets[1:])
+        n_descriptors = int(offsets[-1])
+
+        def _copy(raw_path, shape, dtype, columns):
+            # type: (str, tuple, type, dict) -> None
+            """ Copies columns of a raw file to .npy files, by chunks """
+            for name, column in columns.items():
+                shape_out = shape if column is None else shape[:1]
+                if not n_descriptors:
+                    # Empty files cannot be memory-mapped
+                    np.save(os.path.join(path, '{}.npy'.format(name)),
+                            np.zeros(shape_out, dtype))
+                    continue
+                source = np.memmap(raw_path, dtype=dtype, mode='r',
+                                   shape=shape)
+                out = np.lib.format.open_memmap(
+                    os.path.join(path, '{}.npy'.format(name)), mode='w+',
+                    dtype=dtype, shape=shape_out)
+                for start in range(0, n_descriptors, chunk_size):
+                    rows = source[start:start + chunk_size]
+                    out[start:start + chunk_size] = \
+                        rows if column is None else rows[:, column]
+                del out, source
+
+        _copy(raw_descriptors, (n_descriptors, dimension), dtype,
+              dict(descriptors=None))
+        if has_keypoints:
+            _copy(raw_keypoints, (n_descriptors, 4), np.float32,
+                  dict(zip(cls.KEYPOINT_FIELDS, range(4))))
+        os.remove(raw_descriptors)
+        os.remove(raw_keypoints)
+
+        np.save(os.path.join(path, 'offsets.npy'), offsets)
+        np.save(os.path.join(path, 'class_ids.npy'),
+                class_ids.astype(np.int8))
+        np.save(os.path.join(path, 'label_table.npy'), label_table)
+        return cls.load(path, mmap_mode='r')
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        # type: (str, str) -> DescriptorSet
+        """ Load a set saved with ``save``
+
+        Use ``mmap_mode='r'`` to memory-map the descriptors instead of
+        reading them.
+        """
+
+        def _load(name, mmap=None):
+            return np.load(os.path.join(path, '{}.npy'.format(name)),
+                           mmap_mode=mmap)
+
+        descriptor_set = cls(_load('descriptors', mmap_mode),
+                             _load('offsets'), _load('class_ids'),
+                             _load('label_table'))
+        if os.path.isfile(os.path.join(path, 'x.npy')):
+            for field in cls.KEYPOINT_FIELDS:
+                setattr(descriptor_set, field, _load(field, mmap_mode))
+        return descriptor_set
+
+    @staticmethod
+    def exists(path):
+        # type: (str) -> bool
+        return os.path.isfile(os.path.join(path, 'descriptors.npy')) and \
+               os.path.isfile(os.path.join(path, 'offsets.npy'))
+
+
+def _class_ids(labels, label_table):
+    # type: (List, np.array) -> np.array
+    """ Index in ``label_table`` of every label
+
+    :raise ValueError: if some labels are not in ``label_table``
+    """
+    labels = np.asarray(labels)
+    known = np.isin(labels, label_table)
+    if not known.all():
+        raise ValueError('Labels not in the label table: {}'.format(
+            ', '.join(str(label) for label in np.unique(labels[~known]))))
+    sorter = np.argsort(label_table)
+    return sorter[np.searchsorted(label_table, labels, sorter=sorter)]
+
+
+def keypoints_to_array(keypoints):
+    # type: (List) -> np.array
+    """ Converts a list of ``cv2.KeyPoint`` to a (n, 4) float32 array
+
+    The columns are x, y, size and angle. Arrays are returned as float32.
+    """
+    if isinstance(keypoints, np.ndarray):
+        return keypoints.astype(np.float32, copy=False)
+    return np.array([(kp.pt[0], kp.pt[1], kp.size, kp.angle)
+                     for kp in keypoints], dtype=np.float32).reshape(-1, 4)
+
+
+def keypoint_coordinates(keypoints):
+    # type: (List) -> Tuple[np.array, np.array]
+    """ x and y coordinates of a list of ``cv2.KeyPoint`` or an array """
+    keypoints = keypoints_to_array(keypoints)
+    return keypoints[:, 0], keypoints[:, 1]
@@ -0,0 +1,118 @@
+import numpy as np
+from sklearn.decomposition import IncrementalPCA
+
+from descriptor_set import DescriptorSet
+
+# Type of the stored transformed descriptors. No extractor gives float16
+# descriptors, so it marks them as already transformed
+REDUCED_DTYPE = np.float16
+
+
+def is_reduced(D):
+    # type: (np.array) -> bool
+    """ Whether the descriptors were already transformed and stored """
+    return np.asarray(D).dtype == REDUCED_DTYPE
+
+
+class DescriptorTransform(object):
+    """ Learned compression of local descriptors: RootSIFT, PCA, whitening
+
+    The PCA is fitted incrementally (``partial_fit``), so it can be learned
+    on batches of descriptors or on a random sample of them (``fit``) without
+    loading all of them at once.
+    """
+
+    def __init__(self, n_components=64, whiten=False, root_sift=False,
+                 sample_size=100000, batch_size=10000, random_state=42):
+        # type: (int, bool, bool, int, int, int) -> None
+        """
+        :param n_components: dimension of the transformed descriptors
+        :param whiten: scale the components to unit variance
+        :param root_sift: L1 normalise and square root the descriptors first
+            (Hellinger kernel), before the PCA
+        :param sample_size: maximum number of descriptors used by ``fit``
+        :param batch_size: descriptors per incremental PCA step
+        """
+        self.n_components = n_components
+        self.whiten = whiten
+        self.root_sift = root_sift
+        self.sample_size = sample_size
+        self.batch_size = batch_size
+        self.random_state = random_state
+        self.pca = IncrementalPCA(n_components=n_components, whiten=whiten,
+                                  batch_size=batch_size)
+        self.fitted = False
+
+    def _root_sift(self, D):
+        # type: (np.array) -> np.array
+        D = np.asarray(D, dtype=np.float32)
+        if not self.root_sift:
+            return D
+        norms = np.abs(D).sum(axis=1, keepdims=True)
+        return np.sqrt(D / np.maximum(norms, 1e-7))
+
+    def partial_fit(self, D):
+        # type: (np.array) -> DescriptorTransform
+        """ Updates the PCA with a batch of descriptors
+
+        Note a batch must have at least ``n_components`` descriptors.
+        """
+        self.pca.partial_fit(self._root_sift(D))
+        self.fitted = True
+        return self
+
+    def fit(self, D):
+        # type: (np.array) -> DescriptorTransform
+        """ Fits the PCA on a random sample of at most ``sample_size`` rows """
+        if len(D) > self.sample_size:
+            rng = np.random.RandomState(self.random_state)
+            D = D[np.sort(rng.choice(len(D), self.sample_size,
+                                     replace=False))]
+        # Equal batches of at least batch_size rows, no tiny last batch
+        for batch in np.array_split(D, max(len(D) // self.batch_size, 1)):
+            self.partial_fit(batch)
+        return self
+
+    def cache_key(self):
+        # type: () -> str
+        """ Name identifying the parameters of the transform
+
+        Used to name the datasets where its descriptors are cached.
+        """
+        return 'pca{}{}{}_sample{}_batch{}_seed{}'.format(
+            self.n_components, '_whiten' if self.whiten else '',
+            '_rootsift' if self.root_sift else '', self.sample_size,
+            self.batch_size, self.random_state)
+
+    def transform(self, D, dtype=np.float32):
+        # type: (np.array, type) -> np.array
+        return self.pca.transform(self._root_sift(D)).astype(dtype)
+
+    def compress(self, D):
+        # type: (np.array) -> np.array
+        """ Float32 transformed descriptors, given raw or reduced ones
+
+        Reduced descriptors (``REDUCED_DTYPE``, e.g. loaded from a cache, see
+        ``Database.load_descriptor_set_in_memory``) are only converted.
+        """
+        if not is_reduced(D):
+            return self.transform(D)
+        if D.shape[1] != self.n_components:
+            raise ValueError('Reduced descriptors of dimension {} given to a '
+                             'transform to {}'.format(D.shape[1],
+                                                      self.n_components))
+        return D.astype(np.float32)
+
+    def transform_set(self, descriptor_set, dtype=REDUCED_DTYPE):
+        # type: (DescriptorSet, type) -> DescriptorSet
+        """ Transformed copy of a DescriptorSet, stored as ``REDUCED_DTYPE``
+        by default
+        """
+        transformed = DescriptorSet(
+            self.transform(descriptor_set.descriptors, dtype),
+            descriptor_set.offsets, descriptor_set.class_ids,
+            descriptor_set.label_table)
+        if descriptor_set.has_keypoints():
+            for field in DescriptorSet.KEYPOINT_FIELDS:
+                setattr(transformed, field, getattr(descriptor_set, field))
+        return transformed
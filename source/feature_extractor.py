@@ -1,32 +1,205 @@
 from __future__ import print_function
 
+import hashlib
 import os
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import threading
 
 import cv2
 import numpy as np
+from typing import Iterator
 from typing import List
-from typing import Type
+from typing import Tuple
 
+from descriptor_set import DescriptorSet
+from descriptor_set import keypoints_to_array
+from sampling import first_images_per_class
 from source import DATA_PATH
 
 
+# Colour spaces the extractors work on, and how to get them from BGR
+BGR = 'bgr'
+GRAY = 'gray'
+LUV = 'luv'
+COLOUR_CONVERSIONS = {GRAY: cv2.COLOR_BGR2GRAY, LUV: cv2.COLOR_BGR2LUV}
+
+
+def read_images(filenames, path=DATA_PATH, prefetch=0):
+    # type: (List, str, int) -> Iterator[np.array]
+    """ Yields the decoded images, in order
+
+    With ``prefetch`` > 0 a background thread reads up to that number of
+    images ahead (``cv2.imread`` releases the GIL), so decoding overlaps
+    with the consumer. At most ``prefetch`` images wait in memory.
+    """
+    paths = [os.path.join(path, filename) for filename in filenames]
+    if prefetch <= 0:
+        for image_path in paths:
+            yield cv2.imread(image_path)
+        return
+
+    images = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def _put(item):
+        # Gives up if the consumer stopped, so the reader never blocks
+        while not stop.is_set():
+            try:
+                images.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _reader():
+        try:
+            for image_path in paths:
+                if not _put((cv2.imread(image_path), None)):
+                    return
+        except Exception as error:
+            _put((None, error))
+            return
+        _put((None, StopIteration()))
+
+    reader = threading.Thread(target=_reader)
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            image, error = images.get()
+            if isinstance(error, StopIteration):
+                break
+            if error is not None:
+                raise error
+            yield image
+    finally:
+        # The consumer may stop early: let the reader finish
+        stop.set()
+        reader.join()
+
+
+def _cache_value(value):
+    # type: (object) -> str
+    """ Text of a parameter in a cache key, arrays by a hash of their data """
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        key = hashlib.sha1(repr((value.shape, value.dtype.str)).encode('utf-8'))
+        key.update(value.tobytes())
+        return 'sha1-' + key.hexdigest()
+    return str(value)
+
+
+def convert_colour(image, colour_space):
+    # type: (np.array, str) -> np.array
+    """ Converts a BGR image to the given colour space """
+    if colour_space == BGR:
+        return image
+    return cv2.cvtColor(image, COLOUR_CONVERSIONS[colour_space])
+
+
 class BaseFeatureExtractor(object):
+    # Attributes holding OpenCV objects. These cannot be pickled, so they are
+    # dropped when pickling and built again by ``_build`` when unpickling.
+    opencv_attributes = ()
+    # Colour space of the images given to ``compute_converted``
+    colour_space = BGR
+    # Attributes the descriptors depend on (not the speed-only ones, e.g.
+    # batch_size), they name the cached descriptors
+    cache_parameters = ()
+
+    def _build(self):
+        """ Builds the OpenCV objects of the extractor """
+        pass
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in self.opencv_attributes:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build()
+
+    def cache_key(self):
+        # type: () -> str
+        """ Name identifying the extractor and its parameters
+
+        Used to name the datasets where its descriptors are cached.
+        """
+        parameters = ['{}={}'.format(name, _cache_value(getattr(self, name)))
+                      for name in sorted(self.cache_parameters)]
+        return '_'.join([type(self).__name__] + parameters).replace(' ', '')
+
+    def iter_descriptors(self, images, prefetch=0, path=DATA_PATH):
+        # type: (List, int, str) -> Iterator[Tuple[int, np.array, np.array]]
+        """ Yields the (image id, key-points, descriptors) of every image
+
+        Images are read and described one at a time, in order, so a dataset
+        bigger than the memory can be consumed by streaming stages (see
+        ``DescriptorSet.save_iter``, ``BoVW.compute_codebook_iter`` and
+        ``BoVW.encode_iter``). The image id is the index of the image in
+        ``images`` and key-points are a (n, 4) array, or None if the
+        extractor has none.
+
+        :param prefetch: number of images read ahead by a background thread
+        """
+        for image_id, image in enumerate(read_images(images, path, prefetch)):
+            keypoints, descriptors = self.compute_converted(
+                convert_colour(image, self.colour_space))
+            yield image_id, keypoints, descriptors
+
+    def extract_descriptor_set(self, images, labels, label_table=None):
+        # type: (List, List, List) -> DescriptorSet
+        """ Compute the descriptors (and key-points) of every image """
+        descriptors_per_image, keypoints_per_image = [], []
+        for _, keypoints, descriptors in self.iter_descriptors(images):
+            descriptors_per_image.append(descriptors)
+            keypoints_per_image.append(keypoints)
+
+        has_keypoints = keypoints_per_image and \
+                        keypoints_per_image[0] is not None
+        return DescriptorSet.from_images(
+            descriptors_per_image, labels,
+            keypoints_per_image=keypoints_per_image if has_keypoints else None,
+            label_table=label_table)
+
+    def compute_converted(self, image):
+        # type: (np.array) -> (np.array, np.array)
+        """ Key-points (None if the extractor has none) and descriptors of an
+        image already converted to ``colour_space``
+
+        Used by ``MultiFeatureExtractor`` to share the decoding and the colour
+        conversions among several extractors.
+        """
+        return None, self._compute(image)
+
     def extract_from_a_list(self, train_images, train_labels=['no_label']):
+        # type: (List, List) -> (np.array, np.array)
         """ Compute descriptors given a list of images and labels """
-        # type: (List, List) -> Type[NotImplementedError]
-        return NotImplementedError
+        raise NotImplementedError
 
     def _compute(self, image):
+        # type: (np.array) -> np.array
         """ Compute an image descriptor """
-        # type: np.array -> Type[NotImplementedError]
-        return NotImplementedError
+        raise NotImplementedError
 
 
 class SIFT(BaseFeatureExtractor):
+    opencv_attributes = ('detector',)
+    colour_space = GRAY
+    cache_parameters = ('number_of_features',)
+
     def __init__(self, number_of_features):
         # type: (int) -> None
         # FIXME: remove number_of_features if they are not explicity needed
         self.number_of_features = number_of_features
+        self._build()
+
+    def _build(self):
         self.detector = cv2.SIFT(nfeatures=self.number_of_features)
 
     def _compute(self, image):
@@ -47,6 +220,11 @@ class SIFT(BaseFeatureExtractor):
         kp, descriptors = self.detector.detectAndCompute(gray, None)
         return kp, descriptors
 
+    def compute_converted(self, gray):
+        # type: (np.array) -> (np.array, np.array)
+        kp, descriptors = self.detector.detectAndCompute(gray, None)
+        return keypoints_to_array(kp), descriptors
+
     def extract(self, filename, label):
         descriptors = list()
         label_per_descriptor = list()
@@ -92,52 +270,159 @@ class SIFT(BaseFeatureExtractor):
         descriptors_list = []
         label_per_descriptor = []
 
-        for filename, train_label in zip(train_images, train_labels):
+        for filename, train_label in zip(*first_images_per_class(
+                train_images, train_labels, 30)):
             filename_path = os.path.join(DATA_PATH, filename)
-            if label_per_descriptor.count(train_label) < 30:
-                # print('Reading image {}'.format(os.path.basename(filename)),
-                #       end=' ')
-                image = cv2.imread(filename_path)
-                descriptor = self._compute(image)
-                descriptors_list.append(descriptor)
-                label_per_descriptor.append(train_label)
-                # print('{} extracted keypoints and descriptors'.format(
-                #     len(descriptor)))
+            # print('Reading image {}'.format(os.path.basename(filename)),
+            #       end=' ')
+            image = cv2.imread(filename_path)
+            descriptor = self._compute(image)
+            descriptors_list.append(descriptor)
+            label_per_descriptor.append(train_label)
+            # print('{} extracted keypoints and descriptors'.format(
+            #     len(descriptor)))
 
         # Transform everything to numpy arrays
-        descriptors = descriptors_list[0]
-        labels = np.array(
-            [label_per_descriptor[0]] * descriptors_list[0].shape[0])
-
-        for i in range(1, len(descriptors_list)):
-            descriptors = np.vstack((descriptors, descriptors_list[i]))
-            labels = np.hstack((labels, np.array(
-                [label_per_descriptor[i]] * descriptors_list[i].shape[0])))
-
-        return descriptors, labels
+        descriptor_set = DescriptorSet.from_images(descriptors_list,
+                                                   label_per_descriptor)
+        return descriptor_set.descriptors, descriptor_set.descriptor_labels()
 
 
 class ColourHistogram(BaseFeatureExtractor):
-    def __init__(self, bins=10, range=None, weights=None):
-        # type: (int) -> None
+    colour_space = LUV
+    cache_parameters = ('bins', 'range', 'weights', 'grid')
+
+    def __init__(self, bins=10, range=None, weights=None, grid=(1, 1),
+                 batch_size=64):
+        # type: (int, List, np.array, tuple, int) -> None
+        """ Histogram of the u and v channels (LUV colour space)
+
+        The channels are quantised with a lookup table and the histograms of a
+        whole batch of images are computed with a single ``np.bincount``.
+        Values are normalised as a density, like ``np.histogram2d`` with
+        ``normed=True``.
+
+        :param bins: number of bins of each channel
+        :param range: [[u_min, u_max], [v_min, v_max]], the whole 8 bits
+            range if None
+        :param weights: weight of every pixel (same shape as the images)
+        :param grid: (rows, columns) of cells with a histogram each, the
+            descriptor is their concatenation
+        :param batch_size: number of images processed at once
+        """
         # FIXME: remove number_of_features if they are not explicity needed
         self.bins = bins
         self.range = range
         self.weights = weights
+        self.grid = tuple(grid)
+        self.batch_size = batch_size
+
+    def _lookup_tables(self):
+        # type: () -> (np.array, np.array, float)
+        """ Bin of every 8 bits value of u and v, and the area of a bin """
+        value_range = self.range if self.range is not None else \
+            [[0, 256], [0, 256]]
+        values = np.arange(256)
+        tables = []
+        widths = []
+        for low, high in value_range:
+            width = (high - low) / float(self.bins)
+            bins = np.floor((values - low) / width).astype(np.int64)
+            # Values out of the range are not counted (bin -1)
+            bins[(values < low) | (values > high)] = -1
+            bins[values == high] = self.bins - 1
+            tables.append(bins)
+            widths.append(width)
+        return tables[0], tables[1], widths[0] * widths[1]
+
+    def _cells(self, shape):
+        # type: (tuple) -> np.array
+        """ Grid cell of every pixel of an image shape (h, w) """
+        h, w = shape[:2]
+        rows = np.arange(h) * self.grid[0] // h
+        columns = np.arange(w) * self.grid[1] // w
+        return (rows[:, np.newaxis] * self.grid[1] + columns).ravel()
+
+    def compute_batch(self, images):
+        # type: (np.array) -> np.array
+        """ Describe a batch of BGR uint8 images of the same size
+
+        :param images: (N, H, W, 3) images
+        :return: (N, cells * bins * bins) descriptors
+        """
+        images = np.asarray(images)
+        n, h, w = images.shape[:3]
+        # The conversion is per pixel: convert the batch as one tall image
+        luv = cv2.cvtColor(images.reshape(n * h, w, 3), cv2.COLOR_BGR2LUV)
+        return self._histograms(luv.reshape(n, h, w, 3))
+
+    def _histograms(self, luv):
+        # type: (np.array) -> np.array
+        """ Descriptors of a batch (N, H, W, 3) of LUV images """
+        n, h, w = luv.shape[:3]
+        luv = luv.reshape(n, h * w, 3)
+
+        u_table, v_table, bin_area = self._lookup_tables()
+        u = u_table[luv[:, :, 1]]
+        v = v_table[luv[:, :, 2]]
+        valid = (u >= 0) & (v >= 0)
+
+        n_cells = self.grid[0] * self.grid[1]
+        n_bins = self.bins * self.bins
+        cells = self._cells((h, w)) + \
+                np.arange(n)[:, np.newaxis] * n_cells
+        indices = (cells * self.bins + u) * self.bins + v
+
+        weights = None
+        if self.weights is not None:
+            weights = np.broadcast_to(
+                np.asarray(self.weights, dtype=np.float64).reshape(1, -1),
+                indices.shape)[valid]
+        counts = np.bincount(indices[valid], weights=weights,
+                             minlength=n * n_cells * n_bins)
+        counts = counts.reshape(n, n_cells, n_bins).astype(np.float64)
+
+        # Density of every cell histogram
+        totals = counts.sum(axis=2, keepdims=True)
+        counts /= np.maximum(totals, 1e-12) * bin_area
+        return counts.reshape(n, -1)
+
+    def compute_histograms(self, images):
+        # type: (List) -> List
+        """ Descriptors (1, n) of a list of images, computed in batches
+
+        Images are grouped by size so every batch is computed at once.
+        """
+        descriptors = [None] * len(images)
+        by_shape = dict()
+        for i, image in enumerate(images):
+            by_shape.setdefault(image.shape, list()).append(i)
+
+        for indices in by_shape.values():
+            for start in range(0, len(indices), self.batch_size):
+                batch = indices[start:start + self.batch_size]
+                histograms = self.compute_batch(
+                    np.stack([images[i] for i in batch]))
+                for i, histogram in zip(batch, histograms):
+                    descriptors[i] = histogram.reshape(1, -1)
+        return descriptors
 
     def _compute(self, image):
         # type: (np.array) -> List
         """ Extract descriptor from an image """
-        luv = cv2.cvtColor(image, cv2.COLOR_BGR2LUV)
-        u = luv[:, :, 1]
-        v = luv[:, :, 2]
-        u = u.flatten()
-        v = v.flatten()
-        hist = np.histogram2d(u, v, bins=self.bins, range=self.range,
-                              normed=True, weights=self.weights)
-        values = hist[0].flatten()
-        descriptors = values.reshape(1, -1)
-        return descriptors
+        return self.compute_batch(image[np.newaxis])
+
+    def compute_converted(self, luv):
+        # type: (np.array) -> (None, np.array)
+        return None, self._histograms(luv[np.newaxis])
+
+    def extract_descriptor_set(self, images, labels, label_table=None):
+        # type: (List, List, List) -> DescriptorSet
+        descriptors = self.compute_histograms(
+            [cv2.imread(os.path.join(DATA_PATH, filename))
+             for filename in images])
+        return DescriptorSet.from_images(descriptors, labels,
+                                         label_table=label_table)
 
     # NOTE: not in use
     def extract(self, filename, label):
@@ -183,30 +468,247 @@ class ColourHistogram(BaseFeatureExtractor):
         :param train_labels: list of labels of the given images
         :return: descriptors and labels
         """
-        descriptors = []
+        images = []
         label_per_descriptor = []
 
-        for filename, train_label in zip(train_images, train_labels):
+        for filename, train_label in zip(*first_images_per_class(
+                train_images, train_labels, 30)):
             filename_path = os.path.join(DATA_PATH, filename)
-            if label_per_descriptor.count(train_label) < 30:
-                # print('Reading image {}'.format(os.path.basename(filename)),
-                #       end=' ')
-                image = cv2.imread(filename_path)
-                descriptor = self._compute(image)
-                descriptors.append(descriptor)
-                label_per_descriptor.append(train_label)
-                # print('{} extracted keypoints and descriptors'.format(
-                #     len(descriptor)))
-        descriptors_array = descriptors[0]
-        labels = np.array(
-            [label_per_descriptor[0]])
+            images.append(cv2.imread(filename_path))
+            label_per_descriptor.append(train_label)
+
+        descriptors = self.compute_histograms(images)
+        descriptor_set = DescriptorSet.from_images(descriptors,
+                                                   label_per_descriptor)
+        return descriptor_set.descriptors, label_per_descriptor
+
+
+class BinaryDescriptor(BaseFeatureExtractor):
+    """ Binary local descriptors: ORB (32 bytes) or BRISK (64 bytes)
+
+    Descriptors are uint8 arrays of packed bits, to be compared with the
+    Hamming distance (see ``bag_of_visual_words.HammingKMajority``).
+    """
+    ORB = 'orb'
+    BRISK = 'brisk'
+    opencv_attributes = ('detector',)
+    colour_space = GRAY
+    cache_parameters = ('method', 'number_of_features')
+
+    def __init__(self, method=ORB, number_of_features=500):
+        # type: (str, int) -> None
+        self.method = method
+        self.number_of_features = number_of_features
+        self._build()
+
+    def _build(self):
+        if self.method == self.ORB:
+            self.detector = cv2.ORB(nfeatures=self.number_of_features)
+        elif self.method == self.BRISK:
+            self.detector = cv2.BRISK()
+        else:
+            raise ValueError('Unknown binary descriptor {}'.format(
+                self.method))
+
+    def detectAndCompute(self, image):
+        # type: (np.array) -> (List, np.array)
+        """ Extract key-points and descriptors from an image """
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        kp, descriptors = self.detector.detectAndCompute(gray, None)
+        if descriptors is None:
+            # No key-points found
+            descriptors = np.zeros((0, self.detector.descriptorSize()),
+                                   dtype=np.uint8)
+        return kp, descriptors
+
+    def compute_converted(self, gray):
+        # type: (np.array) -> (np.array, np.array)
+        kp, descriptors = self.detector.detectAndCompute(gray, None)
+        if descriptors is None:
+            descriptors = np.zeros((0, self.detector.descriptorSize()),
+                                   dtype=np.uint8)
+        return keypoints_to_array(kp), descriptors
+
+    def _compute(self, image):
+        # type: (np.array) -> np.array
+        """ Extract descriptor from an image """
+        _, descriptors = self.detectAndCompute(image)
+        return descriptors
+
+    def extract_pool(self, filename):
+        filename_path = os.path.join(DATA_PATH, filename)
+
+        image = cv2.imread(filename_path)
+        descriptors = self._compute(image)
+
+        return descriptors
+
+    def extract_from_a_list(self, train_images, train_labels=['no_label']):
+        # type: (List, List) -> (np.array, np.array)
+        """ Compute binary descriptors
+
+        Read the just 30 train images per class.
+
+        Note the labels from the input are expanded to the output in a way that
+        each descriptor has its label.
+
+        :param train_images: list of images
+        :param train_labels: list of labels of the given images
+        :return: descriptors and labels
+        """
+        descriptors_list = []
+        label_per_descriptor = []
+
+        for filename, train_label in zip(*first_images_per_class(
+                train_images, train_labels, 30)):
+            filename_path = os.path.join(DATA_PATH, filename)
+            image = cv2.imread(filename_path)
+            descriptors_list.append(self._compute(image))
+            label_per_descriptor.append(train_label)
+
+        descriptor_set = DescriptorSet.from_images(descriptors_list,
+                                                   label_per_descriptor)
+        return descriptor_set.descriptors, descriptor_set.descriptor_labels()
+
+
+class GIST(BaseFeatureExtractor):
+    """ GIST-like global scene descriptor
+
+    Images are converted to gray, resized to ``image_size`` and filtered by a
+    bank of log-Gabor filters (``n_scales`` x ``n_orientations``) in the
+    frequency domain. The energy of every filter response is averaged over a
+    ``grid`` x ``grid`` layout, giving one vector per image (no key-points nor
+    codebook). A batch of images is filtered with a single FFT.
+    """
+    cache_parameters = ('image_size', 'n_scales', 'n_orientations', 'grid')
+    # Filter banks already built, by (image_size, n_scales, n_orientations)
+    _filter_banks = dict()
+
+    def __init__(self, image_size=128, n_scales=4, n_orientations=8, grid=4,
+                 batch_size=16):
+        # type: (int, int, int, int, int) -> None
+        self.image_size = image_size
+        self.n_scales = n_scales
+        self.n_orientations = n_orientations
+        self.grid = grid
+        self.batch_size = batch_size
+
+    def filter_bank(self):
+        # type: () -> np.array
+        """ (n_scales * n_orientations, size, size) log-Gabor transfer
+        functions, in the layout of ``np.fft.fft2`` """
+        key = (self.image_size, self.n_scales, self.n_orientations)
+        if key not in self._filter_banks:
+            frequencies = np.fft.fftfreq(self.image_size)
+            fx, fy = np.meshgrid(frequencies, frequencies)
+            radius = np.sqrt(fx ** 2 + fy ** 2)
+            radius[0, 0] = 1.  # avoid log(0), the DC term is removed below
+            angle = np.arctan2(fy, fx)
+
+            filters = []
+            for scale in range(self.n_scales):
+                centre = 0.25 / 2 ** scale
+                radial = np.exp(-np.log(radius / centre) ** 2 /
+                                (2 * np.log(0.55) ** 2))
+                radial[0, 0] = 0.
+                for orientation in range(self.n_orientations):
+                    theta = orientation * np.pi / self.n_orientations
+                    difference = np.arctan2(np.sin(angle - theta),
+                                            np.cos(angle - theta))
+                    # Filters are even: take both half-planes
+                    difference = np.minimum(np.abs(difference),
+                                            np.pi - np.abs(difference))
+                    angular = np.exp(-difference ** 2 / (
+                        2 * (np.pi / self.n_orientations / 1.2) ** 2))
+                    filters.append(radial * angular)
+            self._filter_banks[key] = np.array(filters)
+        return self._filter_banks[key]
+
+    def _prepare(self, image):
+        # type: (np.array) -> np.array
+        """ Gray, resized and normalised (zero mean, unit std) image
+
+        :param image: BGR or already gray image
+        """
+        gray = image if image.ndim == 2 else \
+            cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        gray = cv2.resize(gray, (self.image_size, self.image_size),
+                          interpolation=cv2.INTER_AREA).astype(np.float64)
+        gray -= gray.mean()
+        return gray / max(gray.std(), 1e-7)
+
+    def compute_batch(self, images):
+        # type: (List) -> np.array
+        """ Describe a list of BGR (or gray) images
+
+        :return: (N, n_scales * n_orientations * grid * grid) descriptors
+        """
+        gray = np.stack([self._prepare(image) for image in images])
+        spectra = np.fft.fft2(gray)
+        cell = self.image_size // self.grid
+        side = cell * self.grid
+
+        descriptors = []
+        for transfer_function in self.filter_bank():
+            energy = np.abs(np.fft.ifft2(spectra * transfer_function))
+            energy = energy[:, :side, :side].reshape(
+                len(images), self.grid, cell, self.grid, cell)
+            descriptors.append(energy.mean(axis=(2, 4)).reshape(
+                len(images), -1))
+        return np.hstack(descriptors).astype(np.float32)
+
+    def compute_descriptors(self, images):
+        # type: (List) -> List
+        """ Descriptors (1, n) of a list of images, computed in batches """
+        descriptors = []
+        for start in range(0, len(images), self.batch_size):
+            batch = self.compute_batch(images[start:start + self.batch_size])
+            descriptors.extend(row.reshape(1, -1) for row in batch)
+        return descriptors
+
+    def _compute(self, image):
+        # type: (np.array) -> np.array
+        """ Extract descriptor from an image """
+        return self.compute_batch([image])
+
+    def extract_pool(self, filename):
+        filename_path = os.path.join(DATA_PATH, filename)
+
+        image = cv2.imread(filename_path)
+        descriptors = self._compute(image)
 
-        for i in range(1, len(descriptors)):
-            descriptors_array = np.vstack((descriptors_array, descriptors[i]))
-            labels = np.hstack((labels, np.array(
-                [label_per_descriptor[i]])))
+        return descriptors
+
+    def extract_descriptor_set(self, images, labels, label_table=None):
+        # type: (List, List, List) -> DescriptorSet
+        descriptors = self.compute_descriptors(
+            [cv2.imread(os.path.join(DATA_PATH, filename))
+             for filename in images])
+        return DescriptorSet.from_images(descriptors, labels,
+                                         label_table=label_table)
+
+    def extract_from_a_list(self, train_images, train_labels=['no_label']):
+        # type: (List, List) -> (np.array, List)
+        """ Compute GIST descriptors
+
+        Read the just 30 train images per class.
+
+        :param train_images: list of images
+        :param train_labels: list of labels of the given images
+        :return: descriptors (one per image) and labels
+        """
+        images = []
+        label_per_descriptor = []
+
+        for filename, train_label in zip(*first_images_per_class(
+                train_images, train_labels, 30)):
+            filename_path = os.path.join(DATA_PATH, filename)
+            images.append(cv2.imread(filename_path))
+            label_per_descriptor.append(train_label)
 
-        return descriptors_array, label_per_descriptor
+        descriptor_set = DescriptorSet.from_images(
+            self.compute_descriptors(images), label_per_descriptor)
+        return descriptor_set.descriptors, label_per_descriptor
 
 
 class SIFT2(SIFT):
@@ -214,7 +716,7 @@ class SIFT2(SIFT):
         # type: (int) -> None
         # FIXME: remove number_of_features atribute if they are not explicity needed
         self.number_of_features = number_of_features
-        self.detector = cv2.SIFT(nfeatures=self.number_of_features)
+        self._build()
 
     def extract(self, data_path, image_filenames, train_labels):
         from database import Dataset
@@ -249,39 +751,74 @@ class SIFT2(SIFT):
 
 
 class denseSIFT(BaseFeatureExtractor):
+    opencv_attributes = ('dense', 'detector')
+    colour_space = GRAY
+    cache_parameters = ('scale_levels', 'scale_mul', 'step_size',
+                        'feature_scale', 'img_bound')
+    # Dense grids already detected, by (parameters, image height, width)
+    _grids = dict()
+
     def __init__(self, scale_levels=1, scale_mul=0.1, step_size=6,
                  feature_scale=1, img_bound=0):
         # type: (int) -> None
         # FIXME: remove number_of_features if they are not explicity needed
+        self.scale_levels = scale_levels
+        self.scale_mul = scale_mul
+        self.step_size = step_size
+        self.feature_scale = feature_scale
+        self.img_bound = img_bound
+        self._build()
+
+    def _build(self):
         self.dense = cv2.FeatureDetector_create("Dense")
         self.detector = cv2.SIFT()
 
         # Initialize the detector with all the required parameters
-        self.dense.setDouble("featureScaleLevels", scale_levels)
-        self.dense.setDouble("featureScaleMul", scale_mul)
-        self.dense.setInt("initXyStep", step_size)
-        self.dense.setInt("initFeatureScale", feature_scale)
-        self.dense.setInt("initImgBound", img_bound)
+        self.dense.setDouble("featureScaleLevels", self.scale_levels)
+        self.dense.setDouble("featureScaleMul", self.scale_mul)
+        self.dense.setInt("initXyStep", self.step_size)
+        self.dense.setInt("initFeatureScale", self.feature_scale)
+        self.dense.setInt("initImgBound", self.img_bound)
+
+    def _grid_key(self, shape):
+        # type: (tuple) -> tuple
+        return (self.scale_levels, self.scale_mul, self.step_size,
+                self.feature_scale, self.img_bound) + tuple(shape[:2])
+
+    def grid(self, shape):
+        # type: (tuple) -> (List, np.array)
+        """ Dense key-points of an image shape, as ``cv2.KeyPoint`` and as a
+        (n, 4) array
+
+        The grid does not depend on the image content, so it is detected
+        once per shape and shared by all the images.
+        """
+        key = self._grid_key(shape)
+        if key not in self._grids:
+            keypoints = self.dense.detect(np.zeros(shape[:2], np.uint8))
+            array = keypoints_to_array(keypoints)
+            array.setflags(write=False)
+            self._grids[key] = keypoints, array
+        return self._grids[key]
 
     def _compute(self, image):
         # type: (np.array) -> List
         """ Extract descriptor from an image """
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
-        # Do not mind descriptor key-points
-        kp = self.dense.detect(gray)
-        _, descriptors = self.detector.compute(gray, kp)
+        _, descriptors = self.detectAndCompute(image)
         return descriptors
 
     def detectAndCompute(self, image):
-        # type: (np.array) -> List
-        """ Extract descriptor from an image """
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        # type: (np.array) -> (np.array, np.array)
+        """ Extract key-points (as a (n, 4) array) and descriptors """
+        return self.compute_converted(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
 
-        # Do not mind descriptor key-points
-        kp = self.dense.detect(gray)
+    def compute_converted(self, gray):
+        # type: (np.array) -> (np.array, np.array)
+        kp, keypoints = self.grid(gray.shape)
         kp, descriptors = self.detector.compute(gray, kp)
-        return kp, descriptors
+        if len(kp) != len(keypoints):
+            keypoints = keypoints_to_array(kp)
+        return keypoints, descriptors
 
     def extract(self, filename, label):
         descriptors = list()
@@ -328,26 +865,332 @@ class denseSIFT(BaseFeatureExtractor):
         descriptors_list = []
         label_per_descriptor = []
 
-        for filename, train_label in zip(train_images, train_labels):
+        for filename, train_label in zip(*first_images_per_class(
+                train_images, train_labels, 30)):
             filename_path = os.path.join(DATA_PATH, filename)
-            if label_per_descriptor.count(train_label) < 30:
-                # print('Reading image {}'.format(os.path.basename(filename)),
-                #       end=' ')
-                image = cv2.imread(filename_path)
-                descriptor = self._compute(image)
-                descriptors_list.append(descriptor)
-                label_per_descriptor.append(train_label)
-                # print('{} extracted keypoints and descriptors'.format(
-                #     len(descriptor)))
+            # print('Reading image {}'.format(os.path.basename(filename)),
+            #       end=' ')
+            image = cv2.imread(filename_path)
+            descriptor = self._compute(image)
+            descriptors_list.append(descriptor)
+            label_per_descriptor.append(train_label)
+            # print('{} extracted keypoints and descriptors'.format(
+            #     len(descriptor)))
 
         # Transform everything to numpy arrays
-        descriptors = descriptors_list[0]
-        labels = np.array(
-            [label_per_descriptor[0]] * descriptors_list[0].shape[0])
+        descriptor_set = DescriptorSet.from_images(descriptors_list,
+                                                   label_per_descriptor)
+        return descriptor_set.descriptors, descriptor_set.descriptor_labels()
+
+
+class VectorisedDenseSIFT(BaseFeatureExtractor):
+    """ Dense SIFT implemented with numpy (no OpenCV 2.x Dense detector)
+
+    The gradient orientation maps of an image are computed once, then their
+    integral images give the 4x4 cell histograms of every grid point with four
+    lookups, for every patch size. A batch of images of the same size is
+    processed at once.
+
+    Unlike OpenCV SIFT, cells are plain boxes (no gaussian window nor
+    trilinear interpolation between cells) and the orientation is not
+    estimated (descriptors are upright, angle 0).
+    """
+    N_ORIENTATIONS = 8
+    N_CELLS = 4
+    colour_space = GRAY
+    cache_parameters = ('step_size', 'patch_sizes', 'img_bound')
+    # Grid geometry already computed, by (parameters, image height, width)
+    _grids = dict()
+    _keypoints = dict()
+
+    def __init__(self, step_size=6, patch_sizes=(16,), img_bound=0,
+                 batch_size=16):
+        # type: (int, tuple, int, int) -> None
+        """
+        :param step_size: pixels between grid points
+        :param patch_sizes: side of the patches described at every grid point
+            (one descriptor per point and patch size)
+        :param img_bound: pixels of the image border without grid points
+        :param batch_size: number of images processed at once
+        """
+        self.step_size = step_size
+        self.patch_sizes = tuple(patch_sizes)
+        self.img_bound = img_bound
+        self.batch_size = batch_size
+
+    @staticmethod
+    def _to_gray(images):
+        # type: (np.array) -> np.array
+        """ Batch of BGR (N, H, W, 3) or gray (N, H, W) images to float gray
+
+        BGR images are converted as ``cv2.cvtColor`` does, so the descriptors
+        are the same given BGR or gray images.
+        """
+        images = np.asarray(images)
+        if images.ndim == 4:
+            n, h, w = images.shape[:3]
+            images = cv2.cvtColor(images.reshape(n * h, w, 3),
+                                  cv2.COLOR_BGR2GRAY).reshape(n, h, w)
+        return images.astype(np.float32)
+
+    def _orientation_integrals(self, gray):
+        # type: (np.array) -> np.array
+        """ Integral images of the orientation maps, (N, O, H + 1, W + 1)
+
+        The gradient magnitude of every pixel is split between its two
+        closest orientation bins.
+        """
+        gy, gx = np.gradient(gray, axis=(1, 2))
+        magnitude = np.sqrt(gx ** 2 + gy ** 2)
+        orientation = np.arctan2(gy, gx) % (2 * np.pi) * \
+                      (self.N_ORIENTATIONS / (2 * np.pi))
+        lower = np.floor(orientation)
+        upper_weight = orientation - lower
+        lower = lower.astype(int) % self.N_ORIENTATIONS
+        upper = (lower + 1) % self.N_ORIENTATIONS
+
+        n, h, w = gray.shape
+        integrals = np.zeros((n, self.N_ORIENTATIONS, h + 1, w + 1))
+        for o in range(self.N_ORIENTATIONS):
+            channel = magnitude * ((lower == o) * (1 - upper_weight) +
+                                   (upper == o) * upper_weight)
+            np.cumsum(np.cumsum(channel, axis=1), axis=2,
+                      out=integrals[:, o, 1:, 1:])
+        return integrals
+
+    def grid(self, shape, patch_size):
+        # type: (tuple, int) -> (np.array, np.array)
+        """ Centres (x, y) of the grid points of an image shape (h, w)
+
+        Computed once per shape, the arrays are shared (read-only).
+        """
+        h, w = int(shape[0]), int(shape[1])
+        key = (self.step_size, self.img_bound, patch_size, h, w)
+        if key not in self._grids:
+            half = patch_size // 2
+            xs = np.arange(self.img_bound + half,
+                           w - self.img_bound - half + 1, self.step_size)
+            ys = np.arange(self.img_bound + half,
+                           h - self.img_bound - half + 1, self.step_size)
+            x, y = (np.ascontiguousarray(a.ravel())
+                    for a in np.meshgrid(xs, ys))
+            x.setflags(write=False)
+            y.setflags(write=False)
+            self._grids[key] = x, y
+        return self._grids[key]
+
+    def keypoints(self, shape):
+        # type: (tuple) -> np.array
+        """ (n, 4) x, y, size and angle of the key-points of an image shape
+
+        Computed once per shape: all the images of a shape share the same
+        (read-only) array.
+        """
+        key = (self.step_size, self.img_bound, self.patch_sizes,
+               int(shape[0]), int(shape[1]))
+        if key not in self._keypoints:
+            keypoints = []
+            for patch_size in self.patch_sizes:
+                x, y = self.grid(shape, patch_size)
+                keypoints.append(np.stack(
+                    [x, y, np.full(len(x), patch_size), np.zeros(len(x))],
+                    axis=1))
+            keypoints = np.vstack(keypoints).astype(np.float32)
+            keypoints.setflags(write=False)
+            self._keypoints[key] = keypoints
+        return self._keypoints[key]
+
+    def _describe(self, integrals, patch_size):
+        # type: (np.array, int) -> np.array
+        """ Descriptors (N, n_points, 128) of every grid point """
+        cell = patch_size // self.N_CELLS
+        x, y = self.grid(np.array(integrals.shape[2:]) - 1, patch_size)
+        cells = np.arange(self.N_CELLS) * cell
+        x0 = (x - patch_size // 2)[:, np.newaxis] + cells  # (n_points, 4)
+        y0 = (y - patch_size // 2)[:, np.newaxis] + cells
+
+        rows0, rows1 = y0[:, :, np.newaxis], (y0 + cell)[:, :, np.newaxis]
+        cols0, cols1 = x0[:, np.newaxis, :], (x0 + cell)[:, np.newaxis, :]
+        # Box sums of every (image, orientation, point, cell row, cell col)
+        histograms = integrals[:, :, rows1, cols1] - \
+                     integrals[:, :, rows0, cols1] - \
+                     integrals[:, :, rows1, cols0] + \
+                     integrals[:, :, rows0, cols0]
+
+        # SIFT layout: cell row, cell column, orientation
+        descriptors = histograms.transpose(0, 2, 3, 4, 1).reshape(
+            histograms.shape[0], len(x), -1)
+        return self._normalise(descriptors)
+
+    @staticmethod
+    def _normalise(descriptors):
+        # type: (np.array) -> np.array
+        """ SIFT normalisation: unit norm, clip at 0.2, unit norm, to bytes """
+        norms = np.linalg.norm(descriptors, axis=-1)[..., np.newaxis]
+        descriptors = np.minimum(descriptors / np.maximum(norms, 1e-7), 0.2)
+        norms = np.linalg.norm(descriptors, axis=-1)[..., np.newaxis]
+        descriptors = descriptors / np.maximum(norms, 1e-7)
+        return np.minimum(np.round(descriptors * 512), 255).astype(np.float32)
+
+    def compute_batch(self, images):
+        # type: (np.array) -> (np.array, np.array)
+        """ Describe a batch of images of the same size
+
+        :param images: (N, H, W, 3) BGR or (N, H, W) gray images
+        :return: the key-points (n, 4) shared by all the images and the
+            descriptors (N, n, 128)
+        """
+        gray = self._to_gray(images)
+        integrals = self._orientation_integrals(gray)
+        descriptors = np.concatenate(
+            [self._describe(integrals, patch_size)
+             for patch_size in self.patch_sizes], axis=1)
+        return self.keypoints(gray.shape[1:]), descriptors
 
-        for i in range(1, len(descriptors_list)):
-            descriptors = np.vstack((descriptors, descriptors_list[i]))
-            labels = np.hstack((labels, np.array(
-                [label_per_descriptor[i]] * descriptors_list[i].shape[0])))
+    def _compute(self, image):
+        # type: (np.array) -> np.array
+        """ Extract descriptor from an image """
+        _, descriptors = self.compute_batch(image[np.newaxis])
+        return descriptors[0]
 
-        return descriptors, labels
+    def detectAndCompute(self, image):
+        # type: (np.array) -> (np.array, np.array)
+        """ Extract key-points (as a (n, 4) array) and descriptors """
+        keypoints, descriptors = self.compute_batch(image[np.newaxis])
+        return keypoints, descriptors[0]
+
+    def compute_converted(self, gray):
+        # type: (np.array) -> (np.array, np.array)
+        return self.detectAndCompute(gray)
+
+    def extract_pool(self, filename):
+        filename_path = os.path.join(DATA_PATH, filename)
+
+        image = cv2.imread(filename_path)
+        descriptors = self._compute(image)
+
+        return descriptors
+
+    def compute_list(self, images):
+        # type: (List) -> (List, List)
+        """ Key-points and descriptors of a list of images, in batches
+
+        Images are grouped by size so every batch is computed at once.
+        """
+        keypoints_per_image = [None] * len(images)
+        descriptors_per_image = [None] * len(images)
+
+        by_shape = dict()
+        for i, image in enumerate(images):
+            by_shape.setdefault(image.shape, list()).append(i)
+
+        for indices in by_shape.values():
+            for start in range(0, len(indices), self.batch_size):
+                batch = indices[start:start + self.batch_size]
+                keypoints, descriptors = self.compute_batch(
+                    np.stack([images[i] for i in batch]))
+                for i, image_descriptors in zip(batch, descriptors):
+                    keypoints_per_image[i] = keypoints
+                    descriptors_per_image[i] = image_descriptors
+        return keypoints_per_image, descriptors_per_image
+
+    def extract_descriptor_set(self, images, labels, label_table=None):
+        # type: (List, List, List) -> DescriptorSet
+        keypoints_per_image, descriptors_per_image = self.compute_list(
+            [cv2.imread(os.path.join(DATA_PATH, filename))
+             for filename in images])
+        return DescriptorSet.from_images(descriptors_per_image, labels,
+                                         keypoints_per_image=keypoints_per_image,
+                                         label_table=label_table)
+
+    def extract_from_a_list(self, train_images, train_labels=['no_label']):
+        # type: (List, List) -> (np.array, np.array)
+        """ Compute dense SIFT descriptors
+
+        Read the just 30 train images per class and describe them in batches.
+
+        Note the labels from the input are expanded to the output in a way that
+        each descriptor has its label.
+
+        :param train_images: list of images
+        :param train_labels: list of labels of the given images
+        :return: descriptors and labels
+        """
+        images = []
+        label_per_image = []
+
+        for filename, train_label in zip(*first_images_per_class(
+                train_images, train_labels, 30)):
+            filename_path = os.path.join(DATA_PATH, filename)
+            images.append(cv2.imread(filename_path))
+            label_per_image.append(train_label)
+
+        _, descriptors_list = self.compute_list(images)
+        descriptor_set = DescriptorSet.from_images(descriptors_list,
+                                                   label_per_image)
+        return descriptor_set.descriptors, descriptor_set.descriptor_labels()
+
+
+class MultiFeatureExtractor(BaseFeatureExtractor):
+    """ Several extractors computed in a single pass over the images
+
+    Every image is read once and converted once to each colour space needed
+    by the extractors (e.g. gray for SIFT and dense SIFT, LUV for colour
+    histograms), then every extractor describes its converted image. Each
+    feature is still returned (and cached, see
+    ``Database.load_descriptor_sets_in_memory``) on its own.
+    """
+
+    def __init__(self, feature_extractors):
+        # type: (List[BaseFeatureExtractor]) -> None
+        self.feature_extractors = list(feature_extractors)
+
+    def cache_key(self):
+        # type: () -> str
+        return '+'.join(feature_extractor.cache_key()
+                        for feature_extractor in self.feature_extractors)
+
+    def compute_all(self, image):
+        # type: (np.array) -> List
+        """ Key-points (or None) and descriptors of every extractor """
+        converted = dict()
+        features = []
+        for feature_extractor in self.feature_extractors:
+            colour_space = feature_extractor.colour_space
+            if colour_space not in converted:
+                converted[colour_space] = convert_colour(image, colour_space)
+            features.append(
+                feature_extractor.compute_converted(converted[colour_space]))
+        return features
+
+    def _compute(self, image):
+        # type: (np.array) -> List
+        """ Descriptors of every extractor """
+        return [descriptors for _, descriptors in self.compute_all(image)]
+
+    def extract_pool(self, filename):
+        filename_path = os.path.join(DATA_PATH, filename)
+
+        image = cv2.imread(filename_path)
+        return self._compute(image)
+
+    def extract_descriptor_sets(self, images, labels, label_table=None):
+        # type: (List, List, List) -> List[DescriptorSet]
+        """ A DescriptorSet per extractor, reading every image once """
+        n_extractors = len(self.feature_extractors)
+        descriptors_per_image = [[] for _ in range(n_extractors)]
+        keypoints_per_image = [[] for _ in range(n_extractors)]
+        for filename in images:
+            image = cv2.imread(os.path.join(DATA_PATH, filename))
+            for i, (keypoints, descriptors) in enumerate(
+                    self.compute_all(image)):
+                descriptors_per_image[i].append(descriptors)
+                keypoints_per_image[i].append(keypoints)
+
+        return [DescriptorSet.from_images(
+            descriptors, labels,
+            keypoints_per_image=keypoints if keypoints and
+            keypoints[0] is not None else None,
+            label_table=label_table)
+            for descriptors, keypoints in zip(descriptors_per_image,
+                                              keypoints_per_image)]
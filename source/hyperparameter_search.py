@@ -0,0 +1,608 @@
+import ctypes
+import json
+import logging
+import multiprocessing
+import os
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import time
+import traceback
+
+import numpy as np
+from GPyOpt import Design_space
+from GPyOpt.experiment_design import initial_design
+from GPyOpt.methods import BayesianOptimization
+from keras.callbacks import Callback
+from typing import Callable
+from typing import Dict
+from typing import List
+
+
+class MedianStoppingRule(object):
+    """ Stops a trial whose best validation accuracy so far is below the
+    median of the other trials at the same epoch """
+
+    def __init__(self, grace_epochs=3, min_trials=3):
+        # type: (int, int) -> None
+        """
+        :param grace_epochs: epochs every trial runs
+        :param min_trials: other trials needed at the epoch to compare with
+        """
+        self.grace_epochs = grace_epochs
+        self.min_trials = min_trials
+
+    def should_stop(self, trial_id, curves):
+        # type: (int, Dict) -> bool
+        """
+        :param curves: validation accuracy after every epoch of every trial
+        """
+        curve = curves[trial_id]
+        epoch = len(curve)
+        if epoch < self.grace_epochs:
+            return False
+        others = [max(other[:epoch]) for other_id, other in curves.items()
+                  if other_id != trial_id and len(other) >= epoch]
+        if len(others) < self.min_trials:
+            return False
+        return max(curve) < np.median(others)
+
+
+class SuccessiveHalving(object):
+    """ Asynchronous successive halving of the trials
+
+    At every rung (``min_epochs`` times a power of ``eta`` epochs) a trial
+    only goes on if its best validation accuracy so far is in the top
+    ``1 / eta`` of the trials that reached the rung. Trials are never
+    paused: until ``eta`` trials reached a rung, all of them go on.
+    """
+
+    def __init__(self, min_epochs=1, eta=3):
+        # type: (int, int) -> None
+        self.min_epochs = min_epochs
+        self.eta = eta
+
+    def should_stop(self, trial_id, curves):
+        # type: (int, Dict) -> bool
+        curve = curves[trial_id]
+        epoch = len(curve)
+        rung = self.min_epochs
+        while rung < epoch:
+            rung *= self.eta
+        if epoch != rung:
+            return False
+        values = [max(other[:epoch]) for other in curves.values()
+                  if len(other) >= epoch]
+        if len(values) < self.eta:
+            return False
+        promoted = max(len(values) // self.eta, 1)
+        return max(curve) < sorted(values, reverse=True)[promoted - 1]
+
+
+class EarlyStoppingCallback(Callback):
+    """ Shares the learning curve of a trial and stops it if the rule says so
+    """
+
+    def __init__(self, trial_id, curves, rule, monitor='val_acc'):
+        # type: (int, Dict, MedianStoppingRule, str) -> None
+        """
+        :param curves: dict shared by all the trials (``Manager().dict()``)
+        """
+        super(EarlyStoppingCallback, self).__init__()
+        self.trial_id = trial_id
+        self.curves = curves
+        self.rule = rule
+        self.monitor = monitor
+        self.stopped_epoch = None
+
+    def on_epoch_end(self, epoch, logs=None):
+        value = (logs or {}).get(self.monitor)
+        if value is None:
+            return
+        # Proxy dicts only see assignments
+        self.curves[self.trial_id] = self.curves[self.trial_id] + [value]
+        if self.rule is not None and \
+                self.rule.should_stop(self.trial_id, dict(self.curves)):
+            self.stopped_epoch = epoch + 1
+            self.model.stop_training = True
+
+
+class TrialJournal(object):
+    """ Append-only file of the ended trials of a search
+
+    One JSON line per trial: parameters, fidelity (keyword arguments of the
+    objective), status ('done' or 'failed'), value, epochs run, early stop,
+    seconds, the details returned by the objective (e.g. metrics and model
+    path) and the time it ended. A line is written and synced as soon as its
+    trial ends, so a crash or a pre-emption only loses the running trials.
+    Only the process running the search writes to it.
+    """
+
+    def __init__(self, path):
+        # type: (str) -> None
+        self.path = path
+        self.records = list()
+        self._done = dict()
+        if os.path.isfile(path):
+            line = '\n'
+            with open(path) as journal_file:
+                for line in journal_file:
+                    try:
+                        self._add(json.loads(line))
+                    except ValueError:
+                        # Last line cut by a crash
+                        pass
+            if not line.endswith('\n'):
+                with open(path, 'a') as journal_file:
+                    journal_file.write('\n')
+        else:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(path)))
+            except OSError as expected:
+                # Expected when the folder already exists
+                pass
+
+    @staticmethod
+    def key(x, fidelity=None):
+        # type: (np.array, dict) -> tuple
+        """ Identifies a trial: its parameters and fidelity """
+        return (tuple(float(value) for value in np.ravel(x)),
+                tuple(sorted((fidelity or {}).items())))
+
+    def _add(self, record):
+        # type: (dict) -> None
+        self.records.append(record)
+        if record['status'] == 'done':
+            self._done[self.key(record['parameters'],
+                                record['fidelity'])] = record
+
+    def lookup(self, x, fidelity=None):
+        # type: (np.array, dict) -> dict
+        """ Record of the trial if it is done, None otherwise """
+        return self._done.get(self.key(x, fidelity))
+
+    def done(self, fidelity=None):
+        # type: (dict) -> List
+        """ Records of the trials done at a fidelity """
+        fidelity = self.key((), fidelity)[1]
+        return [record for key, record in self._done.items()
+                if key[1] == fidelity]
+
+    def append(self, x, fidelity, outcome, error=None):
+        # type: (np.array, dict, tuple, str) -> dict
+        """ Writes a trial ended with ``outcome`` (see ``_run_trial``) """
+        record = dict(parameters=list(self.key(x)[0]),
+                      fidelity=fidelity or {},
+                      status='failed' if outcome is None else 'done',
+                      time=time.time())
+        if outcome is None:
+            record.update(error=error)
+        else:
+            value, epochs, stopped, seconds, details = outcome
+            record.update(value=value, epochs=epochs, stopped=stopped,
+                          seconds=seconds, details=details)
+        with open(self.path, 'a') as journal_file:
+            journal_file.write(json.dumps(record) + '\n')
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        self._add(record)
+        return record
+
+
+# Functions setting the threads of the BLAS and OpenMP runtimes, by the
+# name of their libraries
+_THREAD_SETTERS = (
+    ('openblas', ('openblas_set_num_threads', 'openblas_set_num_threads64_',
+                  'scipy_openblas_set_num_threads64_')),
+    ('mkl_rt', ('MKL_Set_Num_Threads',)),
+    ('gomp', ('omp_set_num_threads',)),
+    ('iomp', ('omp_set_num_threads',)),
+)
+
+
+def _loaded_libraries():
+    # type: () -> List
+    """ Paths of the shared libraries loaded by this process (Linux only) """
+    try:
+        with open('/proc/self/maps') as maps:
+            return sorted(set(line.split()[-1] for line in maps
+                              if '.so' in line))
+    except IOError as expected:
+        return []
+
+
+def _limit_threads(threads):
+    # type: (int) -> None
+    """ Limits the threads of the trial run by this process
+
+    The trial process is forked with numpy, and its BLAS, already loaded, so
+    the thread variables are read too late: the runtimes loaded are set
+    through their own API. The variables are still set for the libraries
+    loaded by the trial.
+    """
+    for variable in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS',
+                     'OPENBLAS_NUM_THREADS'):
+        os.environ[variable] = str(threads)
+    for path in _loaded_libraries():
+        for library, setters in _THREAD_SETTERS:
+            if library not in os.path.basename(path):
+                continue
+            try:
+                runtime = ctypes.CDLL(path)
+            except OSError as expected:
+                continue
+            for setter in setters:
+                if hasattr(runtime, setter):
+                    getattr(runtime, setter)(ctypes.c_int(threads))
+                    break
+
+    import tensorflow as tf
+    from keras import backend as K
+    config = tf.ConfigProto(intra_op_parallelism_threads=threads,
+                            inter_op_parallelism_threads=threads)
+    # Several trials can share a GPU
+    config.gpu_options.allow_growth = True
+    K.set_session(tf.Session(config=config))
+
+
+def _run_trial(objective, x, kwargs, trial_id, curves, rule, threads,
+               results):
+    # type: (Callable, np.array, dict, int, Dict, MedianStoppingRule, int, multiprocessing.Queue) -> None
+    """ Runs a trial in its own process
+
+    The objective returns the value, or the value and a dict of details
+    (JSON types). Puts (trial id, (value, epochs run, stopped early,
+    seconds, details), error) in ``results``.
+    """
+    try:
+        _limit_threads(threads)
+        curves[trial_id] = []
+        callback = EarlyStoppingCallback(trial_id, curves, rule)
+        init = time.time()
+        value = objective(np.atleast_2d(x), callbacks=[callback], **kwargs)
+        seconds = time.time() - init
+        details = dict()
+        if isinstance(value, tuple):
+            value, details = value
+        results.put((trial_id, (float(np.asarray(value).ravel()[0]),
+                                len(curves[trial_id]),
+                                callback.stopped_epoch is not None, seconds,
+                                details), None))
+    except Exception:
+        results.put((trial_id, None, traceback.format_exc()))
+
+
+class _TrialProcesses(object):
+    """ Trials running at once, every one in a new process
+
+    The processes are not daemons, a trial can start the processes of a
+    ``BatchLoader``. The trials share their validation accuracy after every
+    epoch, so ``rule`` can stop the hopeless ones. The ended trials are
+    written to ``journal``.
+    """
+
+    def __init__(self, objective, rule, threads, logger, journal=None):
+        # type: (Callable, MedianStoppingRule, int, logging.Logger, TrialJournal) -> None
+        self.objective = objective
+        self.rule = rule
+        self.threads = threads
+        self.logger = logger
+        self.journal = journal
+        self.manager = multiprocessing.Manager()
+        self.curves = self.manager.dict()
+        self.results = multiprocessing.Queue()
+        self.running = dict()
+        self.launched = 0
+
+    def __len__(self):
+        return len(self.running)
+
+    def pending(self):
+        # type: () -> List
+        """ Parameters of the running trials """
+        return [x for x, _, _ in self.running.values()]
+
+    def start(self, x, **kwargs):
+        # type: (np.array) -> int
+        """ Starts a trial of ``objective(x, callbacks=[...], **kwargs)`` """
+        trial_id = self.launched
+        self.launched += 1
+        self.logger.info('Trial {}: {} {}'.format(trial_id, x, kwargs))
+        process = multiprocessing.Process(
+            target=_run_trial,
+            args=(self.objective, x, kwargs, trial_id, self.curves, self.rule,
+                  self.threads, self.results))
+        process.start()
+        self.running[trial_id] = x, kwargs, process
+        return trial_id
+
+    def wait(self):
+        # type: () -> (int, np.array, tuple)
+        """ Waits for a trial to end
+
+        :return: its id, parameters and (value, epochs run, stopped early,
+            seconds, details), None if it failed
+        """
+        while True:
+            try:
+                trial_id, outcome, error = self.results.get(timeout=1.)
+            except queue.Empty:
+                for trial_id, (x, kwargs, process) in \
+                        list(self.running.items()):
+                    if process.exitcode is not None and self.results.empty():
+                        return self._end(trial_id, None,
+                                         'The process died')
+                continue
+            self.running[trial_id][2].join()
+            return self._end(trial_id, outcome, error)
+
+    def _end(self, trial_id, outcome, error):
+        # type: (int, tuple, str) -> (int, np.array, tuple)
+        x, kwargs, _ = self.running.pop(trial_id)
+        if outcome is None:
+            self.logger.error('Trial {} failed:\n{}'.format(trial_id, error))
+        else:
+            value, epochs, stopped, seconds, _ = outcome
+            self.logger.info(
+                'Trial {}: {} after {} epochs{} in {} secs.'.format(
+                    trial_id, value, epochs,
+                    ' (stopped early)' if stopped else '', seconds))
+        if self.journal is not None:
+            self.journal.append(x, kwargs, outcome, error)
+        return trial_id, x, outcome
+
+    def close(self):
+        # type: () -> None
+        """ Stops the running trials """
+        for _, _, process in self.running.values():
+            process.terminate()
+            process.join()
+        self.running.clear()
+        self.manager.shutdown()
+
+
+class SearchRunner(object):
+    """ Parallel Bayesian optimisation of a model with early stopping
+
+    Up to ``workers`` trials are trained at once, every one in a new process
+    with at most ``threads_per_trial`` threads. A new point is suggested as
+    soon as a trial ends (asynchronous batches: GPyOpt is given the points
+    of the running trials as pending). Trials share their validation
+    accuracy after every epoch, so the hopeless ones are stopped early by
+    ``rule`` (``MedianStoppingRule`` or ``SuccessiveHalving``).
+
+    The objective is called as ``objective(x, callbacks=[...])`` with a
+    (1, n_parameters) array, as GPyOpt does, and must pass the callbacks to
+    ``fit_generator``. It returns the value to maximise (the accuracy), or
+    the value and a dict of details to write to the journal.
+
+    With a journal the search can be resumed: the trials done are read back
+    as the first observations of the optimisation and count in
+    ``max_trials``, and a point is never trained twice.
+    """
+
+    def __init__(self, objective, domain, max_trials=10, workers=2,
+                 threads_per_trial=2, rule=None, initial_trials=None,
+                 logger=None, journal_path=None):
+        # type: (Callable, List, int, int, int, MedianStoppingRule, int, logging.Logger, str) -> None
+        """
+        :param domain: GPyOpt domain of the parameters
+        :param rule: early stopping rule, a ``MedianStoppingRule`` if None
+        :param initial_trials: random trials before the Bayesian
+            optimisation, ``workers`` if None
+        :param journal_path: file of the ``TrialJournal``, no journal if None
+        """
+        self.objective = objective
+        self.domain = domain
+        self.space = Design_space(domain)
+        self.max_trials = max_trials
+        self.workers = workers
+        self.threads_per_trial = threads_per_trial
+        self.rule = MedianStoppingRule() if rule is None else rule
+        self.initial_trials = workers if initial_trials is None \
+            else initial_trials
+        self.logger = logger or logging.getLogger(__name__)
+
+        # Finished trials: parameters, value, epochs run and early stops
+        self.X = list()
+        self.Y = list()
+        self.epochs = list()
+        self.stopped = list()
+
+        self.journal = None
+        if journal_path is not None:
+            self.journal = TrialJournal(journal_path)
+            for record in self.journal.done():
+                self.X.append(np.array(record['parameters']))
+                self.Y.append(record['value'])
+                self.epochs.append(record['epochs'])
+                self.stopped.append(record['stopped'])
+            if self.Y:
+                self.logger.info('Resuming from {} trials of {}'.format(
+                    len(self.Y), journal_path))
+
+    def _known(self, x, pending):
+        # type: (np.array, List) -> bool
+        """ Whether the point is trained (see the journal) or running """
+        if self.journal is not None and self.journal.lookup(x) is not None:
+            return True
+        return TrialJournal.key(x) in set(
+            TrialJournal.key(other) for other in self.X + pending)
+
+    def suggest(self, pending):
+        # type: (List) -> np.array
+        """ Next point to try given the running ones """
+        if len(self.Y) < self.initial_trials:
+            for _ in range(10):
+                x = initial_design('random', self.space, 1)[0]
+                if not self._known(x, pending):
+                    break
+            return x
+        # GPyOpt minimises
+        optimizer = BayesianOptimization(
+            f=None, domain=self.domain, X=np.vstack(self.X),
+            Y=-np.array(self.Y).reshape(-1, 1), de_duplication=True)
+        return optimizer.suggest_next_locations(
+            pending_X=np.vstack(pending) if pending else None)[0]
+
+    def run(self):
+        # type: () -> (np.array, float)
+        """ Runs the search, returns the best parameters and value """
+        trials = _TrialProcesses(self.objective, self.rule,
+                                 self.threads_per_trial, self.logger,
+                                 self.journal)
+        remaining = self.max_trials - len(self.Y)
+        try:
+            while remaining > 0 or len(trials):
+                while len(trials) < self.workers and remaining > 0:
+                    remaining -= 1
+                    x = self.suggest(trials.pending())
+                    if self._known(x, trials.pending()):
+                        self.logger.info('{} already trained'.format(x))
+                        continue
+                    trials.start(x)
+                if not len(trials):
+                    continue
+                _, x, outcome = trials.wait()
+                if outcome is None:
+                    continue
+                value, epochs, stopped, _, _ = outcome
+                self.X.append(x)
+                self.Y.append(value)
+                self.epochs.append(epochs)
+                self.stopped.append(stopped)
+        finally:
+            trials.close()
+
+        if not self.Y:
+            raise RuntimeError('All the trials failed')
+        best = int(np.argmax(self.Y))
+        return self.X[best], self.Y[best]
+
+
+class Hyperband(object):
+    """ Multi-fidelity search of the parameters of a model (Hyperband)
+
+    ``fidelities`` are the keyword arguments of the objective from the
+    cheapest to the most expensive training, e.g. more images and epochs::
+
+        [dict(train_path=TOY_TRAIN_PATH, epochs=5),
+         dict(train_path=SMALL_TRAIN_PATH, epochs=15),
+         dict(train_path=TRAIN_PATH, epochs=50)]
+
+    Every bracket trains random points at one fidelity and promotes the top
+    ``1 / eta`` of them to the next one (successive halving), up to the last
+    fidelity. The first bracket starts ``eta ** (len(fidelities) - 1)``
+    points at the cheapest fidelity, the last one starts a few at the last
+    fidelity, in case the cheap trainings mislead. The trials of a rung are
+    run at once as in ``SearchRunner``, and a point already trained at a
+    fidelity is not trained again.
+
+    The objective is called as ``objective(x, callbacks=[...], **fidelity)``
+    and returns the value to maximise (the accuracy), or the value and a dict
+    of details to write to the journal.
+
+    The points are drawn with ``seed``, so a search resumed from its journal
+    draws the same points and only trains the ones not done yet.
+    """
+
+    def __init__(self, objective, domain, fidelities, eta=3, brackets=None,
+                 workers=2, threads_per_trial=2, logger=None,
+                 journal_path=None, seed=42):
+        # type: (Callable, List, List, int, int, int, int, logging.Logger, str, int) -> None
+        """
+        :param domain: GPyOpt domain of the parameters
+        :param brackets: brackets to run, from the most aggressive one, all
+            (``len(fidelities)``) if None
+        :param journal_path: file of the ``TrialJournal``, no journal if None
+        """
+        self.objective = objective
+        self.space = Design_space(domain)
+        self.fidelities = fidelities
+        self.eta = eta
+        self.brackets = len(fidelities) if brackets is None else brackets
+        self.workers = workers
+        self.threads_per_trial = threads_per_trial
+        self.logger = logger or logging.getLogger(__name__)
+        self.seed = seed
+
+        # Value of every trained point at every fidelity index
+        self.values = dict()
+        self.journal = None
+        if journal_path is not None:
+            self.journal = TrialJournal(journal_path)
+            done = sum(len(self.journal.done(fidelity))
+                       for fidelity in fidelities)
+            if done:
+                self.logger.info('Resuming from {} trials of {}'.format(
+                    done, journal_path))
+
+    def _sample(self, n):
+        # type: (int) -> List
+        """ ``n`` random points, different if the domain has enough """
+        points = dict()
+        for _ in range(10):
+            for x in initial_design('random', self.space, n):
+                points.setdefault(TrialJournal.key(x)[0], x)
+            if len(points) >= n:
+                break
+        return list(points.values())[:n]
+
+    def _train(self, trials, points, level):
+        # type: (_TrialProcesses, List, int) -> List
+        """ Values of the points at a fidelity, -inf for failed trials """
+        fidelity = self.fidelities[level]
+        keys = [TrialJournal.key(x)[0] for x in points]
+        queued = list()
+        for x, key in zip(points, keys):
+            if (key, level) in self.values:
+                continue
+            # Trained before the search was resumed
+            record = None if self.journal is None \
+                else self.journal.lookup(x, fidelity)
+            if record is not None:
+                self.values[(key, level)] = record['value']
+            else:
+                queued.append(x)
+        while queued or len(trials):
+            while queued and len(trials) < self.workers:
+                trials.start(queued.pop(0), **fidelity)
+            _, x, outcome = trials.wait()
+            self.values[(TrialJournal.key(x)[0], level)] = \
+                -np.inf if outcome is None else outcome[0]
+        return [self.values[(key, level)] for key in keys]
+
+    def run(self):
+        # type: () -> (np.array, float)
+        """ Runs the search, returns the best parameters and value at the
+        last fidelity """
+        last = len(self.fidelities) - 1
+        trials = _TrialProcesses(self.objective, None,
+                                 self.threads_per_trial, self.logger,
+                                 self.journal)
+        np.random.seed(self.seed)
+        best_x, best_value = None, -np.inf
+        try:
+            for bracket in range(last, last - self.brackets, -1):
+                n = int(np.ceil(
+                    (last + 1) * self.eta ** bracket / float(bracket + 1)))
+                points = self._sample(n)
+                self.logger.info('Bracket {}: {} points from fidelity '
+                                 '{}'.format(bracket, len(points),
+                                             last - bracket))
+                for level in range(last - bracket, last + 1):
+                    values = self._train(trials, points, level)
+                    if level < last:
+                        keep = max(len(points) // self.eta, 1)
+                        order = np.argsort(values)[::-1][:keep]
+                        points = [points[i] for i in order]
+                for x, value in zip(points, values):
+                    if value > best_value:
+                        best_x, best_value = x, value
+        finally:
+            trials.close()
+
+        if best_x is None:
+            raise RuntimeError('All the trials failed')
+        return best_x, best_value
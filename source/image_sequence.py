@@ -0,0 +1,336 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+from keras.preprocessing.image import img_to_array, load_img
+from keras.utils import Sequence
+from typing import List
+
+from batch_augmentation import BatchAugmenter
+from source import CACHE_PATH
+
+# Manifests and decoded images of the datasets
+MANIFESTS_PATH = os.path.join(CACHE_PATH, 'manifests')
+DECODED_PATH = os.path.join(CACHE_PATH, 'decoded')
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.ppm')
+
+# Held while the global np.random is seeded and used
+_global_random_lock = threading.Lock()
+
+
+def _key(*values):
+    # type: (*object) -> str
+    return hashlib.sha1(json.dumps(values).encode('utf-8')).hexdigest()
+
+
+class Manifest(object):
+    """ Images of a dataset: relative path, class id and file size
+
+    Built by scanning the ``root/<class>/<image>`` tree (the same layout and
+    class order as ``flow_from_directory``) and saved with the modification
+    times of the folders, so the next runs only scan the directory again
+    when images or classes were added, removed or renamed. Images are
+    sorted by class and name.
+    """
+
+    def __init__(self, root, classes, paths, class_ids, sizes, mtimes=None):
+        # type: (str, List, List, np.array, np.array, List) -> None
+        """
+        :param mtimes: modification times of ``root`` and the class folders
+            when they were scanned
+        """
+        self.root = root
+        self.classes = list(classes)
+        self.paths = list(paths)
+        self.class_ids = np.asarray(class_ids, dtype=np.int32)
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        self.mtimes = mtimes
+
+    def __len__(self):
+        return len(self.paths)
+
+    @staticmethod
+    def _mtimes(root, classes):
+        # type: (str, List) -> List
+        """ Modification times of ``root`` and its class folders """
+        return [os.path.getmtime(os.path.join(root, name))
+                for name in [''] + list(classes)]
+
+    @classmethod
+    def scan(cls, root, classes=None):
+        # type: (str, List) -> Manifest
+        """ Lists the images of every class folder of ``root``
+
+        :param classes: the class folders, in order. All the sub-folders of
+            ``root``, sorted, if None
+        """
+        if classes is None:
+            classes = sorted(name for name in os.listdir(root)
+                             if os.path.isdir(os.path.join(root, name)))
+        mtimes = cls._mtimes(root, classes)
+        paths, class_ids, sizes = [], [], []
+        for class_id, class_name in enumerate(classes):
+            class_path = os.path.join(root, class_name)
+            for filename in sorted(os.listdir(class_path)):
+                if not filename.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                paths.append(os.path.join(class_name, filename))
+                class_ids.append(class_id)
+                sizes.append(os.path.getsize(os.path.join(class_path,
+                                                          filename)))
+        return cls(root, classes, paths, class_ids, sizes, mtimes)
+
+    @classmethod
+    def load(cls, root, classes=None, rescan=False):
+        # type: (str, List, bool) -> Manifest
+        """ Loads the saved manifest of ``root``, scanning it if needed
+
+        The saved manifest is used while the folders of ``root`` and its
+        classes keep their modification times. Images edited in place do
+        not change them, use ``rescan`` then.
+        """
+        root = os.path.abspath(root)
+        manifest_path = os.path.join(MANIFESTS_PATH, '{}.json'.format(
+            _key(root, classes)))
+        if not rescan and os.path.isfile(manifest_path):
+            with open(manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+            try:
+                current = cls._mtimes(root, manifest['classes'])
+            except OSError as expected:
+                # A class folder was removed
+                current = None
+            if current == manifest.get('mtimes'):
+                return cls(root, manifest['classes'], manifest['paths'],
+                           manifest['class_ids'], manifest['sizes'],
+                           manifest['mtimes'])
+            print('[image_sequence] {} changed, scanning it again'.format(
+                root))
+
+        manifest = cls.scan(root, classes)
+        manifest.save(manifest_path)
+        return manifest
+
+    def save(self, path):
+        # type: (str) -> None
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as expected:
+            pass
+        with open(path, 'w') as manifest_file:
+            json.dump(dict(classes=self.classes, paths=self.paths,
+                           class_ids=self.class_ids.tolist(),
+                           sizes=self.sizes.tolist(), mtimes=self.mtimes),
+                      manifest_file)
+
+    def key(self):
+        # type: () -> str
+        """ Identifies the images of the manifest (paths and file sizes) """
+        return _key(self.root, self.paths, self.sizes.tolist())
+
+
+class DecodedImageCache(object):
+    """ Decoded and resized images of a manifest in a uint8 memory map
+
+    Images are decoded the first time they are requested and stored in
+    their slot of ``images.npy``, a flag in ``decoded.npy`` marks them as
+    done. Slots are independent, so several threads or processes can fill
+    the cache at once (a race only writes the same bytes twice). The memory
+    maps are opened again in every process.
+    """
+
+    def __init__(self, manifest, target_size, path=DECODED_PATH):
+        # type: (Manifest, tuple, str) -> None
+        self.manifest = manifest
+        self.target_size = tuple(target_size)
+        self.path = os.path.join(path, _key(manifest.key(), self.target_size))
+        self._maps = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_maps'] = None
+        return state
+
+    def _open(self):
+        # type: () -> (np.array, np.array)
+        if self._maps is not None and self._maps[0] == os.getpid():
+            return self._maps[1:]
+
+        images_path = os.path.join(self.path, 'images.npy')
+        decoded_path = os.path.join(self.path, 'decoded.npy')
+        if not os.path.isdir(self.path):
+            self._build()
+        self._maps = (os.getpid(),
+                      np.load(images_path, mmap_mode='r+'),
+                      np.load(decoded_path, mmap_mode='r+'))
+        return self._maps[1:]
+
+    def _build(self):
+        # type: () -> None
+        # The images and their flags are written to a folder of this thread
+        # and renamed at once, so the flags always belong to the images
+        build_path = '{}.{}.{}.tmp'.format(self.path, os.getpid(),
+                                           threading.current_thread().ident)
+        try:
+            os.makedirs(build_path)
+        except OSError as expected:
+            pass
+        shape = (len(self.manifest),) + self.target_size + (3,)
+        images = np.lib.format.open_memmap(
+            os.path.join(build_path, 'images.npy'), mode='w+',
+            dtype=np.uint8, shape=shape)
+        del images
+        np.save(os.path.join(build_path, 'decoded.npy'),
+                np.zeros(len(self.manifest), np.uint8))
+        try:
+            os.rename(build_path, self.path)
+        except OSError as expected:
+            # Created by another thread or process meanwhile
+            shutil.rmtree(build_path)
+
+    def get(self, index):
+        # type: (int) -> np.array
+        """ Decoded (height, width, 3) RGB uint8 image """
+        images, decoded = self._open()
+        if not decoded[index]:
+            images[index] = decode_image(
+                os.path.join(self.manifest.root, self.manifest.paths[index]),
+                self.target_size)
+            decoded[index] = 1
+        return images[index]
+
+
+def decode_image(path, target_size):
+    # type: (str, tuple) -> np.array
+    """ RGB uint8 image resized as ``flow_from_directory`` does """
+    return img_to_array(load_img(path, target_size=target_size)).astype(
+        np.uint8)
+
+
+class ImageSequence(Sequence):
+    """ Batches of images and one-hot labels of a Manifest
+
+    A ``keras.utils.Sequence``, a replacement for ``flow_from_directory``
+    that can be used with ``workers > 1`` and ``use_multiprocessing``: every
+    batch only depends on its index and the epoch. Without ``shuffle`` the
+    images are always in the manifest order (see ``classes`` for the labels
+    of the predictions).
+
+    With a ``BatchAugmenter`` the whole uint8 batch is transformed at once.
+    With an ``ImageDataGenerator`` every image is transformed apart. Either
+    way the random transformations are seeded by the seed, epoch and batch
+    index.
+    """
+
+    def __init__(self, manifest, target_size=(256, 256), batch_size=32,
+                 shuffle=True, seed=42, image_data_generator=None,
+                 cache=False):
+        # type: (Manifest, tuple, int, bool, int, BatchAugmenter, bool) -> None
+        """
+        :param image_data_generator: random transformations and
+            normalisation of the batches, a ``BatchAugmenter`` or an
+            ``ImageDataGenerator`` (applied to every image, as
+            ``flow_from_directory`` does)
+        :param cache: read the images from a ``DecodedImageCache``
+        """
+        self.manifest = manifest
+        self.target_size = tuple(target_size)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.image_data_generator = image_data_generator
+        self.cache = DecodedImageCache(manifest, self.target_size) \
+            if cache else None
+
+        self.epoch = 0
+        self.order = self._order()
+
+    @property
+    def classes(self):
+        # type: () -> np.array
+        """ Class id of every image, in the order of the batches """
+        return self.manifest.class_ids[self.order]
+
+    @property
+    def num_classes(self):
+        # type: () -> int
+        return len(self.manifest.classes)
+
+    @property
+    def samples(self):
+        # type: () -> int
+        return len(self.manifest)
+
+    def _order(self):
+        # type: () -> np.array
+        if not self.shuffle:
+            return np.arange(len(self.manifest))
+        return np.random.RandomState(self.seed + self.epoch).permutation(
+            len(self.manifest))
+
+    def __len__(self):
+        return int(np.ceil(len(self.manifest) / float(self.batch_size)))
+
+    def _image(self, index):
+        # type: (int) -> np.array
+        if self.cache is not None:
+            return self.cache.get(index)
+        return decode_image(
+            os.path.join(self.manifest.root, self.manifest.paths[index]),
+            self.target_size)
+
+    def __getitem__(self, batch_index):
+        indices = self.order[batch_index * self.batch_size:
+                             (batch_index + 1) * self.batch_size]
+        if isinstance(self.image_data_generator, BatchAugmenter):
+            images = np.empty((len(indices),) + self.target_size + (3,),
+                              dtype=np.uint8)
+            for i, index in enumerate(indices):
+                images[i] = self._image(index)
+            rng = np.random.RandomState([self.seed, self.epoch, batch_index])
+            return (self.image_data_generator.augment(images, rng),
+                    self._labels(indices))
+
+        x = np.empty((len(indices),) + self.target_size + (3,),
+                     dtype=np.float32)
+        seeds = np.random.RandomState(
+            [self.seed, self.epoch, batch_index]).randint(
+            np.iinfo(np.int32).max, size=len(indices))
+        for i, index in enumerate(indices):
+            image = self._image(index).astype(np.float32)
+            if self.image_data_generator is not None:
+                image = self._random_transform(image, seeds[i])
+                image = self.image_data_generator.standardize(image)
+            x[i] = image
+        return x, self._labels(indices)
+
+    def _random_transform(self, image, seed):
+        # type: (np.array, int) -> np.array
+        """ ``ImageDataGenerator.random_transform`` with a given seed
+
+        It draws from the global ``np.random``, seeded here and restored
+        afterwards, under a lock so the threads of the workers do not mix
+        their draws.
+        """
+        with _global_random_lock:
+            state = np.random.get_state()
+            try:
+                return self.image_data_generator.random_transform(image,
+                                                                  seed=seed)
+            finally:
+                np.random.set_state(state)
+
+    def _labels(self, indices):
+        # type: (np.array) -> np.array
+        """ One-hot labels of some images """
+        y = np.zeros((len(indices), self.num_classes), dtype=np.float32)
+        y[np.arange(len(indices)), self.manifest.class_ids[indices]] = 1.
+        return y
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        self.order = self._order()
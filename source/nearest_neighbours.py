@@ -0,0 +1,339 @@
+import cPickle
+import os
+
+import numpy as np
+from typing import Tuple
+
+
+class BruteForceIndex(object):
+    """ Exact nearest-neighbour index with batched queries
+
+    Distances are squared euclidean and computed as
+    ``|x|^2 - 2 x.y + |y|^2`` in chunks of ``batch_size`` queries, so the
+    full query-by-data distance matrix is never materialised.
+    """
+
+    def __init__(self, batch_size=32):
+        # type: (int) -> None
+        self.batch_size = batch_size
+        self.data = None
+        self.norms = None
+
+    def fit(self, X):
+        # type: (np.array) -> BruteForceIndex
+        self.data = np.ascontiguousarray(X, dtype=np.float32)
+        self.norms = np.einsum('ij,ij->i', self.data, self.data)
+        return self
+
+    def query(self, X, n_neighbors=1):
+        # type: (np.array, int) -> Tuple[np.array, np.array]
+        """ Get the distances and indices of the nearest neighbours of X """
+        X = np.atleast_2d(np.asarray(X, dtype=np.float32))
+        n_neighbors = min(n_neighbors, self.data.shape[0])
+        distances = np.empty((X.shape[0], n_neighbors), dtype=np.float32)
+        indices = np.empty((X.shape[0], n_neighbors), dtype=np.int64)
+
+        for start in range(0, X.shape[0], self.batch_size):
+            batch = X[start:start + self.batch_size]
+            d = np.dot(batch, self.data.T)
+            d *= -2
+            d += self.norms
+            d += np.einsum('ij,ij->i', batch, batch)[:, np.newaxis]
+            distances[start:start + len(batch)], \
+                indices[start:start + len(batch)] = _top_k(d, n_neighbors)
+
+        np.maximum(distances, 0, out=distances)
+        return distances, indices
+
+
+class RandomProjectionForest(object):
+    """ Approximate nearest-neighbour index based on random projection trees
+
+    Each tree splits recursively the data by the hyperplane equidistant to two
+    random points until a leaf holds at most ``leaf_size`` points. A query
+    visits one leaf per tree and the union of the candidates is re-ranked with
+    exact distances.
+
+    The recall is tuned with ``n_trees`` and ``leaf_size``: more trees or
+    larger leaves give more candidates per query, so better recall at a higher
+    query cost. See ``recall`` to measure it against an exact search.
+
+    All the trees are stored as flat arrays, so the index can be saved to
+    disk and loaded back memory-mapped (see ``save`` and ``load``).
+    """
+    ARRAYS = ('data', 'norms', 'normals', 'offsets', 'children',
+              'leaf_bounds', 'leaf_indices', 'roots')
+
+    def __init__(self, n_trees=8, leaf_size=64, batch_size=64,
+                 random_state=42):
+        # type: (int, int, int, int) -> None
+        self.n_trees = n_trees
+        self.leaf_size = leaf_size
+        self.batch_size = batch_size
+        self.random_state = random_state
+
+        self.data = None
+        self.norms = None
+        self.normals = None
+        self.offsets = None
+        self.children = None
+        self.leaf_bounds = None
+        self.leaf_indices = None
+        self.roots = None
+
+    def fit(self, X):
+        # type: (np.array) -> RandomProjectionForest
+        """ Build the forest over the rows of X """
+        self.data = np.ascontiguousarray(X, dtype=np.float32)
+        self.norms = np.einsum('ij,ij->i', self.data, self.data)
+        rng = np.random.RandomState(self.random_state)
+
+        normals, offsets, children, leaf_bounds = [], [], [], []
+        leaf_indices, roots = [], []
+        n_leaf_indices = 0
+
+        for _ in range(self.n_trees):
+            roots.append(len(offsets))
+            stack = [(len(offsets), np.arange(self.data.shape[0]))]
+            normals.append(None)
+            offsets.append(0.)
+            children.append((-1, -1))
+            leaf_bounds.append((0, 0))
+
+            while stack:
+                node, indices = stack.pop()
+                if len(indices) <= self.leaf_size:
+                    leaf_bounds[node] = (n_leaf_indices,
+                                         n_leaf_indices + len(indices))
+                    leaf_indices.append(indices)
+                    n_leaf_indices += len(indices)
+                    continue
+
+                normal, offset, right = self._split(indices, rng)
+                normals[node] = normal
+                offsets[node] = offset
+
+                node_children = []
+                for subset in (indices[~right], indices[right]):
+                    node_children.append(len(offsets))
+                    stack.append((len(offsets), subset))
+                    normals.append(None)
+                    offsets.append(0.)
+                    children.append((-1, -1))
+                    leaf_bounds.append((0, 0))
+                children[node] = tuple(node_children)
+
+        zeros = np.zeros(self.data.shape[1], dtype=np.float32)
+        self.normals = np.array(
+            [zeros if normal is None else normal for normal in normals],
+            dtype=np.float32)
+        self.offsets = np.array(offsets, dtype=np.float32)
+        self.children = np.array(children, dtype=np.int32)
+        self.leaf_bounds = np.array(leaf_bounds, dtype=np.int64)
+        self.leaf_indices = np.concatenate(leaf_indices).astype(np.int64)
+        self.roots = np.array(roots, dtype=np.int32)
+        return self
+
+    def _split(self, indices, rng):
+        """ Split by the hyperplane between two random points """
+        a, b = self.data[rng.choice(indices, 2, replace=False)]
+        normal = a - b
+        offset = np.dot(normal, (a + b) / 2)
+        right = np.dot(self.data[indices], normal) > offset
+
+        # Degenerated split (e.g. duplicated points): halve it at random.
+        # Queries get a null projection there, the offset sends all of them
+        # to the same child, drawn once (-1: right, 0: left)
+        if right.all() or not right.any():
+            right = np.zeros(len(indices), dtype=bool)
+            right[rng.permutation(len(indices))[:len(indices) // 2]] = True
+            normal = np.zeros_like(normal)
+            offset = -float(rng.randint(2))
+        return normal, offset, right
+
+    def _leaves(self, X):
+        # type: (np.array) -> np.array
+        """ Get the leaf reached by every query in every tree """
+        leaves = np.empty((X.shape[0], self.n_trees), dtype=np.int32)
+        for tree, root in enumerate(self.roots):
+            nodes = np.full(X.shape[0], root, dtype=np.int32)
+            inner = np.flatnonzero(self.children[nodes, 0] >= 0)
+            while len(inner):
+                inner_nodes = nodes[inner]
+                projections = np.einsum('ij,ij->i', X[inner],
+                                        self.normals[inner_nodes])
+                right = projections > self.offsets[inner_nodes]
+                nodes[inner] = self.children[inner_nodes, right.astype(int)]
+                inner = inner[self.children[nodes[inner], 0] >= 0]
+            leaves[:, tree] = nodes
+        return leaves
+
+    def _candidates(self, X):
+        # type: (np.array) -> np.array
+        """ Get the de-duplicated candidates of every query (-1 padded) """
+        leaves = self._leaves(X)
+        starts = self.leaf_bounds[leaves, 0]
+        sizes = self.leaf_bounds[leaves, 1] - starts
+
+        positions = np.arange(self.leaf_size)
+        offsets = starts[:, :, np.newaxis] + positions
+        valid = positions < sizes[:, :, np.newaxis]
+        candidates = np.where(
+            valid, self.leaf_indices[np.where(valid, offsets, 0)], -1)
+        candidates = np.sort(candidates.reshape(X.shape[0], -1), axis=1)
+        candidates[:, 1:][candidates[:, 1:] == candidates[:, :-1]] = -1
+        return candidates
+
+    def query(self, X, n_neighbors=1):
+        # type: (np.array, int) -> Tuple[np.array, np.array]
+        """ Get the (approximate) distances and indices of the neighbours of X
+
+        Queries run in batches of ``batch_size``. If fewer than
+        ``n_neighbors`` candidates are found the missing neighbours get an
+        infinite distance and a -1 index.
+        """
+        X = np.atleast_2d(np.asarray(X, dtype=np.float32))
+        distances = np.empty((X.shape[0], n_neighbors), dtype=np.float32)
+        indices = np.empty((X.shape[0], n_neighbors), dtype=np.int64)
+
+        for start in range(0, X.shape[0], self.batch_size):
+            batch = X[start:start + self.batch_size]
+            candidates = self._candidates(batch)
+            valid = candidates >= 0
+            safe_candidates = np.where(valid, candidates, 0)
+
+            d = np.einsum('ijk,ik->ij', self.data[safe_candidates], batch)
+            d *= -2
+            d += self.norms[safe_candidates]
+            d += np.einsum('ij,ij->i', batch, batch)[:, np.newaxis]
+            d[~valid] = np.inf
+
+            if d.shape[1] < n_neighbors:
+                padding = np.full((d.shape[0], n_neighbors - d.shape[1]),
+                                  np.inf, dtype=d.dtype)
+                d = np.hstack((d, padding))
+                safe_candidates = np.hstack(
+                    (safe_candidates, np.zeros(padding.shape, dtype=int)))
+
+            batch_distances, positions = _top_k(d, n_neighbors)
+            batch_indices = safe_candidates[
+                np.arange(len(batch))[:, np.newaxis], positions]
+            batch_indices[np.isinf(batch_distances)] = -1
+
+            distances[start:start + len(batch)] = batch_distances
+            indices[start:start + len(batch)] = batch_indices
+
+        np.maximum(distances, 0, out=distances)
+        return distances, indices
+
+    def recall(self, X, n_neighbors=1):
+        # type: (np.array, int) -> float
+        """ Fraction of the exact nearest neighbours of X that are retrieved
+
+        Use a small sample of queries, the exact search is expensive.
+        """
+        _, approximate = self.query(X, n_neighbors)
+        _, exact = BruteForceIndex().fit(self.data).query(X, n_neighbors)
+        hits = sum(len(np.intersect1d(a, e))
+                   for a, e in zip(approximate, exact))
+        return hits / float(exact.size)
+
+    def save(self, path):
+        # type: (str) -> None
+        """ Save the index as a folder of arrays """
+        try:
+            os.makedirs(path)
+        except OSError as expected:
+            pass
+
+        for name in self.ARRAYS:
+            np.save(os.path.join(path, '{}.npy'.format(name)),
+                    getattr(self, name))
+        with open(os.path.join(path, 'params.dat'), 'wb') as params_file:
+            cPickle.dump(dict(n_trees=self.n_trees,
+                              leaf_size=self.leaf_size,
+                              batch_size=self.batch_size,
+                              random_state=self.random_state), params_file)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        # type: (str, str) -> RandomProjectionForest
+        """ Load an index saved with ``save``
+
+        By default the arrays are memory-mapped read-only, so several
+        processes loading the same index share its pages.
+        """
+        with open(os.path.join(path, 'params.dat'), 'rb') as params_file:
+            index = cls(**cPickle.load(params_file))
+        for name in cls.ARRAYS:
+            setattr(index, name, np.load(
+                os.path.join(path, '{}.npy'.format(name)),
+                mmap_mode=mmap_mode))
+        return index
+
+
+class ApproximateKNeighborsClassifier(object):
+    """ k-NN classifier (majority vote) over a RandomProjectionForest """
+
+    def __init__(self, n_neighbors=5, n_trees=8, leaf_size=64,
+                 batch_size=64, random_state=42):
+        # type: (int, int, int, int, int) -> None
+        self.n_neighbors = n_neighbors
+        self.index = RandomProjectionForest(n_trees=n_trees,
+                                            leaf_size=leaf_size,
+                                            batch_size=batch_size,
+                                            random_state=random_state)
+        self.classes_ = None
+        self.labels = None
+
+    def fit(self, X, y):
+        # type: (np.array, np.array) -> ApproximateKNeighborsClassifier
+        self.classes_, self.labels = np.unique(y, return_inverse=True)
+        self.index.fit(X)
+        return self
+
+    def predict(self, X):
+        # type: (np.array) -> np.array
+        _, indices = self.index.query(X, self.n_neighbors)
+        votes = np.where(indices >= 0, self.labels[indices], -1)
+
+        # Count the votes of every query at once with a single bincount
+        n_classes = len(self.classes_)
+        rows = np.arange(votes.shape[0])[:, np.newaxis] * n_classes
+        counts = np.bincount((rows + votes)[votes >= 0],
+                             minlength=votes.shape[0] * n_classes)
+        counts = counts.reshape(votes.shape[0], n_classes)
+        return self.classes_[np.argmax(counts, axis=1)]
+
+    def save(self, path):
+        # type: (str) -> None
+        self.index.save(path)
+        np.save(os.path.join(path, 'labels.npy'), self.labels)
+        with open(os.path.join(path, 'classes.dat'), 'wb') as classes_file:
+            cPickle.dump((self.n_neighbors, self.classes_), classes_file)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        # type: (str, str) -> ApproximateKNeighborsClassifier
+        with open(os.path.join(path, 'classes.dat'), 'rb') as classes_file:
+            n_neighbors, classes = cPickle.load(classes_file)
+        model = cls(n_neighbors=n_neighbors)
+        model.index = RandomProjectionForest.load(path, mmap_mode=mmap_mode)
+        model.labels = np.load(os.path.join(path, 'labels.npy'),
+                               mmap_mode=mmap_mode)
+        model.classes_ = classes
+        return model
+
+
+def _top_k(distances, k):
+    # type: (np.array, int) -> Tuple[np.array, np.array]
+    """ Sorted k smallest values (and their columns) of every row """
+    rows = np.arange(distances.shape[0])[:, np.newaxis]
+    if k < distances.shape[1]:
+        columns = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    else:
+        columns = np.tile(np.arange(distances.shape[1]),
+                          (distances.shape[0], 1))
+    order = np.argsort(distances[rows, columns], axis=1)
+    columns = columns[rows, order]
+    return distances[rows, columns], columns
@@ -0,0 +1,153 @@
+import numpy as np
+from keras import backend as K
+from keras.engine.topology import Layer
+from keras.models import Model
+from typing import List
+
+from batch_augmentation import BatchAugmenter
+from data_generator_config import DataGeneratorConfig
+from preprocess import VGG16_MEAN_BGR
+from preprocess import preprocess_input
+
+# Options of InputNormalisation, named as the attributes of BatchAugmenter
+NORMALISATION_OPTIONS = ('vgg_preprocessing', 'rescale', 'samplewise_center',
+                         'samplewise_std_normalization', 'featurewise_center',
+                         'featurewise_std_normalization')
+
+
+class InputNormalisation(Layer):
+    """ Normalisation of uint8 RGB images as the first layer of a model
+
+    Does in the graph what ``BatchAugmenter`` does on the host for the same
+    options and in the same order: ``preprocess_input`` (channel swap and
+    VGG16 mean subtraction), rescale, samplewise centre and std
+    normalisation, featurewise centre and std normalisation. The generators
+    only move uint8 images (see ``DataGenerator(uint8=True)``).
+
+    The featurewise mean and std are non-trainable weights (set with
+    ``set_statistics``), so they are saved with the weights of the model.
+    """
+
+    def __init__(self, vgg_preprocessing=False, rescale=None,
+                 samplewise_center=False, samplewise_std_normalization=False,
+                 featurewise_center=False, featurewise_std_normalization=False,
+                 **kwargs):
+        super(InputNormalisation, self).__init__(**kwargs)
+        self.vgg_preprocessing = vgg_preprocessing
+        self.rescale = rescale
+        self.samplewise_center = samplewise_center
+        self.samplewise_std_normalization = samplewise_std_normalization
+        self.featurewise_center = featurewise_center
+        self.featurewise_std_normalization = featurewise_std_normalization
+        self.mean = None
+        self.std = None
+
+    def build(self, input_shape):
+        channels = input_shape[-1]
+        self.mean = self.add_weight(name='mean', shape=(channels,),
+                                    initializer='zeros', trainable=False)
+        self.std = self.add_weight(name='std', shape=(channels,),
+                                   initializer='ones', trainable=False)
+        super(InputNormalisation, self).build(input_shape)
+
+    def call(self, inputs):
+        x = K.cast(inputs, 'float32')
+        if self.vgg_preprocessing:
+            x = K.reverse(x, axes=-1) - K.constant(VGG16_MEAN_BGR)
+        if self.rescale:
+            x *= self.rescale
+        if self.samplewise_center:
+            x -= K.mean(x, axis=-1, keepdims=True)
+        if self.samplewise_std_normalization:
+            x /= K.std(x, axis=-1, keepdims=True) + 1e-7
+        if self.featurewise_center:
+            x -= self.mean
+        if self.featurewise_std_normalization:
+            x /= self.std + 1e-7
+        return x
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
+    def options(self):
+        # type: () -> dict
+        """ The normalisation options, see ``NORMALISATION_OPTIONS`` """
+        return {name: getattr(self, name) for name in NORMALISATION_OPTIONS}
+
+    def get_config(self):
+        config = self.options()
+        config.update(super(InputNormalisation, self).get_config())
+        return config
+
+    def set_statistics(self, mean=None, std=None):
+        # type: (np.array, np.array) -> None
+        """ Featurewise mean and std of every channel (None to not change) """
+        if mean is not None:
+            K.set_value(self.mean, np.reshape(mean, -1))
+        if std is not None:
+            K.set_value(self.std, np.reshape(std, -1))
+
+
+def input_normalisation(config=DataGeneratorConfig.NORMALISE,
+                        name='input_normalisation'):
+    # type: (dict, str) -> InputNormalisation
+    """ Layer normalising as the given DataGeneratorConfig
+
+    Build it with the configuration given to ``DataGenerator.configure``,
+    ``check_input_normalisation`` raises if they differ.
+    """
+    return InputNormalisation(
+        vgg_preprocessing=config.get(
+            'preprocessing_function') is preprocess_input,
+        rescale=config.get('rescale'),
+        samplewise_center=config.get('samplewise_center', False),
+        samplewise_std_normalization=config.get(
+            'samplewise_std_normalization', False),
+        featurewise_center=config.get('featurewise_center', False),
+        featurewise_std_normalization=config.get(
+            'featurewise_std_normalization', False),
+        name=name)
+
+
+def input_normalisation_layers(model):
+    # type: (Model) -> List
+    """ InputNormalisation layers of a model (empty for float inputs) """
+    return [layer for layer in model.layers
+            if isinstance(layer, InputNormalisation)]
+
+
+def check_input_normalisation(model, augmenter):
+    # type: (Model, BatchAugmenter) -> None
+    """ Raises ValueError if ``augmenter`` does not fit the input of a model
+
+    A ``BatchAugmenter`` with ``uint8_output`` drops its normalisation
+    options, the InputNormalisation layers of the model must have the same
+    ones. Models without these layers take float images.
+    """
+    layers = input_normalisation_layers(model)
+    if bool(layers) != augmenter.uint8_output:
+        raise ValueError('The model takes {} images but the generator gives '
+                         '{} ones'.format('uint8' if layers else 'float',
+                                          'uint8' if augmenter.uint8_output
+                                          else 'float'))
+    for layer in layers:
+        differences = ['{}: {} in {}, {} in the generator'.format(
+            name, value, layer.name, getattr(augmenter, name))
+            for name, value in sorted(layer.options().items())
+            if value != getattr(augmenter, name)]
+        if differences:
+            raise ValueError('The model does not normalise its input as the '
+                             'generator configuration: {}'.format(
+                                 '; '.join(differences)))
+
+
+def set_input_statistics(model, augmenter):
+    # type: (Model, BatchAugmenter) -> None
+    """ Copies the featurewise statistics fitted by a DataGenerator
+
+    The normalisation of the model is checked first, see
+    ``check_input_normalisation``.
+    """
+    check_input_normalisation(model, augmenter)
+    for layer in input_normalisation_layers(model):
+        layer.set_statistics(augmenter.mean, augmenter.std)
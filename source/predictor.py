@@ -0,0 +1,239 @@
+import copy
+import cPickle
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from typing import Iterator
+from typing import List
+from typing import Tuple
+
+from classifier import BaseClassifier
+from feature_extractor import BaseFeatureExtractor
+
+# State of a worker process, set once by ``_init_worker``
+_worker = dict()
+
+
+def majority_vote(predictions_per_descriptor):
+    # type: (np.array) -> str
+    """ Most voted class among the predictions of the descriptors of an image
+    """
+    values, counts = np.unique(predictions_per_descriptor, return_counts=True)
+    return values[np.argmax(counts)]
+
+
+def save_classifier(classifier, path):
+    # type: (BaseClassifier, str) -> None
+    """ Save a trained classifier in a folder so workers can load it
+
+    Models that know how to save themselves as arrays (e.g. the approximate
+    k-NN index) are saved apart, so ``load_classifier`` can memory-map them
+    and all the workers share the same read-only pages.
+    """
+    model = getattr(classifier, 'model', None)
+    model_class = None
+    if hasattr(model, 'save') and hasattr(model, 'load'):
+        model.save(os.path.join(path, 'model'))
+        model_class = type(model)
+        classifier = copy.copy(classifier)
+        classifier.model = None
+
+    with open(os.path.join(path, 'classifier.dat'), 'wb') as classifier_file:
+        cPickle.dump((classifier, model_class), classifier_file,
+                     cPickle.HIGHEST_PROTOCOL)
+
+
+def load_classifier(path):
+    # type: (str) -> BaseClassifier
+    """ Load a classifier saved with ``save_classifier`` """
+    with open(os.path.join(path, 'classifier.dat'), 'rb') as classifier_file:
+        classifier, model_class = cPickle.load(classifier_file)
+
+    if model_class is not None:
+        classifier.model = model_class.load(os.path.join(path, 'model'),
+                                            mmap_mode='r')
+    return classifier
+
+
+def _init_worker(feature_extractor, model_path):
+    # type: (BaseFeatureExtractor, str) -> None
+    """ Load the feature extractor and the trained model once per worker """
+    _worker['feature_extractor'] = feature_extractor
+    _worker['classifier'] = load_classifier(model_path)
+
+
+def _predict_image(image):
+    # type: (str) -> Tuple[str, float]
+    """ Predict the class of an image in a worker
+
+    :return: the predicted class and the time spent on it
+    """
+    init = time.time()
+    descriptors = _worker['feature_extractor'].extract_pool(image)
+    predictions = _worker['classifier'].predict(descriptors)
+    return majority_vote(predictions), time.time() - init
+
+
+def _predict_descriptors(descriptors):
+    # type: (np.array) -> Tuple[str, float]
+    """ Predict the class of an image from its (cached) descriptors """
+    init = time.time()
+    predictions = _worker['classifier'].predict(descriptors)
+    return majority_vote(predictions), time.time() - init
+
+
+class PredictorMetrics(object):
+    """ Throughput and latency of the predictions done by a Predictor """
+
+    def __init__(self):
+        self.latencies = list()
+        self.elapsed = 0.
+
+    def add(self, latency):
+        # type: (float) -> None
+        self.latencies.append(latency)
+
+    @property
+    def images(self):
+        # type: () -> int
+        return len(self.latencies)
+
+    @property
+    def throughput(self):
+        # type: () -> float
+        """ Images per second (wall time) """
+        return self.images / self.elapsed if self.elapsed else 0.
+
+    def latency(self, percentile=50):
+        # type: (float) -> float
+        """ Seconds spent per image at the given percentile """
+        if not self.latencies:
+            return 0.
+        return float(np.percentile(self.latencies, percentile))
+
+    def __str__(self):
+        return '{} images in {:.2f} secs: {:.2f} images/sec, latency ' \
+               'p50 {:.3f} secs, p95 {:.3f} secs'.format(
+                   self.images, self.elapsed, self.throughput,
+                   self.latency(50), self.latency(95))
+
+
+class Predictor(object):
+    """ Predicts the class of images in a pool of worker processes
+
+    The feature extractor and the trained classifier are sent to each worker
+    only once, through the pool initializer, so nothing relies on globals
+    inherited by ``fork``. The pool is created once and reused until
+    ``close`` is called. Use it as a context manager::
+
+        with Predictor(feature_extractor, classifier, n_workers=4) as predictor:
+            predicted_class = predictor.predict(test_images)
+        print(predictor.metrics)
+
+    With ``n_workers=1`` everything runs in the current process.
+    """
+
+    def __init__(self, feature_extractor, classifier, n_workers=0,
+                 chunksize=8, start_method=None):
+        # type: (BaseFeatureExtractor, BaseClassifier, int, int, str) -> None
+        """
+        :param n_workers: number of processes, zero to use one per CPU
+        :param chunksize: number of images sent to a worker at once
+        :param start_method: multiprocessing start method (python 3 only),
+            the default of the platform if None
+        """
+        if n_workers == 0:
+            n_workers = multiprocessing.cpu_count()
+            print('Detected {0} number of CPUs, running {0} number of '
+                  'processes'.format(n_workers))
+        self.feature_extractor = feature_extractor
+        self.classifier = classifier
+        self.n_workers = n_workers
+        self.chunksize = chunksize
+        self.start_method = start_method
+        self.metrics = PredictorMetrics()
+
+        self.pool = None
+        self.model_path = None
+
+    def start(self):
+        # type: () -> Predictor
+        """ Starts the worker processes (if not started yet) """
+        if self.n_workers == 1 or self.pool is not None:
+            return self
+
+        self.model_path = tempfile.mkdtemp(prefix='predictor_')
+        save_classifier(self.classifier, self.model_path)
+
+        context = multiprocessing if self.start_method is None else \
+            multiprocessing.get_context(self.start_method)
+        self.pool = context.Pool(processes=self.n_workers,
+                                 initializer=_init_worker,
+                                 initargs=(self.feature_extractor,
+                                           self.model_path))
+        return self
+
+    def close(self):
+        # type: () -> None
+        """ Stops the worker processes and removes the saved model """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.model_path is not None:
+            shutil.rmtree(self.model_path, ignore_errors=True)
+            self.model_path = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.close()
+
+    def predict_iter(self, images):
+        # type: (List) -> Iterator[str]
+        """ Yields the predicted class of every image, in order """
+        return self._predict_iter(_predict_image, images)
+
+    def predict_descriptors_iter(self, descriptors_per_image):
+        # type: (List) -> Iterator[str]
+        """ Yields the predicted class of every image given its descriptors
+
+        Use it with cached descriptors (see
+        ``DatabaseFiles.load_images_in_memory``), only the classifier runs.
+        """
+        return self._predict_iter(_predict_descriptors, descriptors_per_image)
+
+    def _predict_iter(self, function, items):
+        self.start()
+        if self.pool is None:
+            _worker.update(feature_extractor=self.feature_extractor,
+                           classifier=self.classifier)
+            results = (function(item) for item in items)
+        else:
+            results = self.pool.imap(function, items,
+                                     chunksize=self.chunksize)
+
+        init = time.time() - self.metrics.elapsed
+        for predicted_class, latency in results:
+            self.metrics.add(latency)
+            self.metrics.elapsed = time.time() - init
+            yield predicted_class
+
+    def predict(self, images):
+        # type: (List) -> List
+        """ Predicts the class of every image """
+        return list(self.predict_iter(images))
+
+    def predict_descriptors(self, descriptors_per_image):
+        # type: (List) -> List
+        """ Predicts the class of every image given its descriptors """
+        return list(self.predict_descriptors_iter(descriptors_per_image))
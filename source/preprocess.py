@@ -1,5 +1,8 @@
 from keras import backend as K
 
+# Mean pixel of the VGG16 training images, in BGR order
+VGG16_MEAN_BGR = (103.939, 116.779, 123.68)
+
 
 def colour_channel_swapping(x, dim_ordering):
     """ Colour channel swapping from RGB to BGR """
@@ -20,14 +23,14 @@ def mean_subtraction(x, dim_ordering):
     """
     if dim_ordering == 'th':
         # Zero-center by mean pixel
-        x[0, :, :] -= 103.939
-        x[1, :, :] -= 116.779
-        x[2, :, :] -= 123.68
+        x[0, :, :] -= VGG16_MEAN_BGR[0]
+        x[1, :, :] -= VGG16_MEAN_BGR[1]
+        x[2, :, :] -= VGG16_MEAN_BGR[2]
     elif dim_ordering == 'tf':
         # Zero-center by mean pixel
-        x[:, :, 0] -= 103.939
-        x[:, :, 1] -= 116.779
-        x[:, :, 2] -= 123.68
+        x[:, :, 0] -= VGG16_MEAN_BGR[0]
+        x[:, :, 1] -= VGG16_MEAN_BGR[1]
+        x[:, :, 2] -= VGG16_MEAN_BGR[2]
     else:
         raise Exception("Ordering not allowed. Use one of these: 'tf' or 'th'")
     return x
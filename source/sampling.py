@@ -0,0 +1,122 @@
+from collections import defaultdict
+
+import numpy as np
+from typing import List
+
+from descriptor_set import DescriptorSet
+
+
+def first_images_per_class(images, labels, n_images):
+    # type: (List, List, int) -> (List, List)
+    """ Keeps the first ``n_images`` images of every class """
+    selected_images, selected_labels = list(), list()
+    images_per_class = defaultdict(int)
+    for image, label in zip(images, labels):
+        if images_per_class[label] < n_images:
+            images_per_class[label] += 1
+            selected_images.append(image)
+            selected_labels.append(label)
+    return selected_images, selected_labels
+
+
+class StratifiedReservoirSampler(object):
+    """ Fixed budget sample of descriptors, stratified by class and image
+
+    Descriptors are added image by image (``add``) in a single pass and only
+    the sample is kept in memory:
+
+    - the budget is split equally among the classes, each class has its own
+      reservoir (algorithm R) of ``budget / n_classes`` descriptors;
+    - every image contributes at most ``per_image`` random descriptors to its
+      class reservoir, so images with many key-points do not dominate.
+
+    The sample only depends on ``random_state`` and the order of the images.
+    """
+
+    def __init__(self, labels, budget=100000, per_image=None,
+                 random_state=42):
+        # type: (List, int, int, int) -> None
+        """
+        :param labels: label of every image that will be added, to know the
+            classes and their number of images beforehand
+        :param budget: maximum number of descriptors of the sample
+        :param per_image: maximum number of descriptors taken from an image.
+            If None, the budget of the class over its number of images
+        """
+        self.classes, images_per_class = np.unique(labels, return_counts=True)
+        self.class_budget = max(budget // len(self.classes), 1)
+        if per_image is None:
+            per_image = -(-self.class_budget // images_per_class)
+        self.per_image = np.broadcast_to(per_image, self.classes.shape)
+        self.rng = np.random.RandomState(random_state)
+
+        self.reservoirs = [None] * len(self.classes)
+        self.seen = np.zeros(len(self.classes), dtype=np.int64)
+
+    def _class_id(self, label):
+        # type: (str) -> int
+        class_id = np.searchsorted(self.classes, label)
+        if class_id == len(self.classes) or self.classes[class_id] != label:
+            raise ValueError('Unknown label: {}'.format(label))
+        return class_id
+
+    def add(self, descriptors, label):
+        # type: (np.array, str) -> None
+        """ Adds the descriptors of an image of the given class """
+        if descriptors is None or not len(descriptors):
+            return
+        class_id = self._class_id(label)
+        per_image = self.per_image[class_id]
+        if len(descriptors) > per_image:
+            descriptors = descriptors[np.sort(self.rng.choice(
+                len(descriptors), per_image, replace=False))]
+
+        reservoir = self.reservoirs[class_id]
+        if reservoir is None:
+            reservoir = np.empty((self.class_budget, descriptors.shape[1]),
+                                 dtype=descriptors.dtype)
+            self.reservoirs[class_id] = reservoir
+
+        # Algorithm R over the whole batch: item t goes to slot t while the
+        # reservoir is not full, then replaces a random slot with probability
+        # capacity / (t + 1). Later items win repeated slots, as in sequence.
+        seen = self.seen[class_id]
+        positions = seen + np.arange(len(descriptors))
+        slots = np.where(positions < self.class_budget, positions,
+                         (self.rng.random_sample(len(descriptors)) *
+                          (positions + 1)).astype(np.int64))
+        kept = slots < self.class_budget
+        reservoir[slots[kept]] = descriptors[kept]
+        self.seen[class_id] = seen + len(descriptors)
+
+    def sizes(self):
+        # type: () -> np.array
+        """ Number of sampled descriptors of every class """
+        return np.minimum(self.seen, self.class_budget)
+
+    def descriptors(self):
+        # type: () -> np.array
+        """ The sampled descriptors, class after class """
+        return np.concatenate([reservoir[:size] for reservoir, size in
+                               zip(self.reservoirs, self.sizes()) if size])
+
+    def labels(self):
+        # type: () -> np.array
+        """ Label of every sampled descriptor """
+        return np.repeat(self.classes, self.sizes())
+
+
+def sample_descriptor_set(descriptor_set, budget=100000, per_image=None,
+                          random_state=42):
+    # type: (DescriptorSet, int, int, int) -> np.array
+    """ Stratified sample of the descriptors of a DescriptorSet
+
+    Images are visited one at a time, so a memory-mapped set is never read
+    entirely into memory.
+    """
+    labels = descriptor_set.labels
+    sampler = StratifiedReservoirSampler(labels, budget, per_image,
+                                         random_state)
+    for i in xrange(len(descriptor_set)):
+        sampler.add(descriptor_set.image(i), labels[i])
+    return sampler.descriptors()
@@ -1,14 +1,15 @@
-import multiprocessing
-from multiprocessing import Pool
 import time
 
 from matplotlib import pyplot as plt
 import numpy as np
 
 from classifier import ClassifierFactory
-from database import Database
+from database import DatabaseFiles
+from descriptor_set import DescriptorSet
 from evaluator import Evaluator
-from feature_extractor import ColourHistogram, SIFT
+from feature_extractor import ColourHistogram, GIST, SIFT
+from predictor import Predictor
+from sampling import first_images_per_class
 from source import DATA_PATH
 
 
@@ -16,36 +17,34 @@ def main(feature_extractor, classifier, n_threads=1):
     do_plotting = False
 
     # Read the train and test files
-    database = Database(DATA_PATH)
+    database = DatabaseFiles(DATA_PATH)
     train_images, test_images, train_labels, test_labels = database.get_data()
 
-    # Load or compute descriptors for training
-    descriptors, labels = database.load_in_memory('train', feature_extractor,
-                                                  train_images, train_labels)
+    # Load or compute descriptors (one file per image) for training, using
+    # the first 30 images per class
+    train_images, train_labels = first_images_per_class(train_images,
+                                                        train_labels, 30)
+    train_descriptors, train_labels = database.load_images_in_memory(
+        'train_{}'.format(feature_extractor.cache_key()), feature_extractor,
+        train_images, train_labels)
+    train_set = DescriptorSet.from_images(train_descriptors, train_labels)
+
     # Train a classifier with train dataset
     print('Trainning model...')
-    classifier.train(descriptors, labels)
-
-    # BUG: the test descriptors cannot be saved the same way as the train ones
-    # cause these have to be checked by-image not by-blob. A try is using the
-    # function predict_images_pool_2 but is not finished and needs a change in
-    # the Database implenentation. Idea: always saving one descriptor file per
-    # image and then group them in the case of training and keep them
-    # separated for prediction
+    classifier.train_descriptor_set(train_set)
 
-    # Load or compute descriptors for testing
-    # descriptors, labels = load_in_memory(database, 'test',
-    #                                      test_images, test_labels)
+    # Load or compute descriptors for testing. These are kept by-image, so
+    # every evaluated classifier reuses them
+    test_descriptors, test_labels = database.load_images_in_memory(
+        'test_{}'.format(feature_extractor.cache_key()), feature_extractor,
+        test_images, test_labels)
 
-    # FIXME: do something with descriptors and labels
     # Assess classifier with test dataset
     print('Testing classifier...')
-    if n_threads == 1:
-        predicted_class = predict_images(test_images, test_labels)
-    else:
-        print('Predicting test images')
-        predicted_class = predict_images_pool(test_images, n_threads)
-        # predicted_class = predict_images_pool_2(descriptors.tolist(), n_threads)
+    with Predictor(feature_extractor, classifier,
+                   n_workers=n_threads) as predictor:
+        predicted_class = predictor.predict_descriptors(test_descriptors)
+    print(predictor.metrics)
 
     # Evaluate performance metrics
     evaluator = Evaluator(test_labels, predicted_class)
@@ -68,96 +67,17 @@ def main(feature_extractor, classifier, n_threads=1):
         plt.show()
 
 
-def predict_images_pool(test_images, n_threads=0):
-    """ Predict images using a pool of threads
-
-    Use the number of threads specified in ``n_threads`` in case it is not
-    zero. Otherwise detect how many cores are and set it to this number.
-    """
-    if n_threads == 0:
-        n_threads = multiprocessing.cpu_count()
-        print('Detected {0} number of CPUs, running {0} number of threads'.
-              format(n_threads))
-    pool = Pool(processes=n_threads)
-    predicted_class = pool.map(predict_image, test_images)
-    return predicted_class
-
-
-# NOTE: not in use
-def predict_images_pool_2(test_descriptors, n_threads=0):
-    """ Predict images using a pool of threads
-
-    Use the number of threads specified in ``n_threads`` in case it is not
-    zero. Otherwise detect how many cores are and set it to this number.
-    """
-    if n_threads == 0:
-        n_threads = multiprocessing.cpu_count()
-        print('Detected {0} number of CPUs, running {0} number of threads'.
-              format(n_threads))
-    pool = Pool(processes=n_threads)
-    predicted_class = pool.map(predict_image_2, test_descriptors)
-    return predicted_class
-
-
-# NOTE: not in use
-def predict_image_2(test_descriptor):
-    # FIXME: remove this globals
-    global feature_extractor
-    global classifier
-    predictions = classifier.predict(test_descriptor)
-    values, counts = np.unique(predictions, return_counts=True)
-    predicted_class = values[np.argmax(counts)]
-    return predicted_class
-
-
-# FIXME: remove this method and use ``predict_image_2`` instead
-def predict_image(image):
-    global feature_extractor
-    global classifier
-    test_descriptor = feature_extractor.extract_pool(image)
-    # print('{} extracted keypoints and descriptors'.format(
-    #     len(test_descriptor)))
-    predictions = classifier.predict(test_descriptor)
-    values, counts = np.unique(predictions, return_counts=True)
-    predicted_class = values[np.argmax(counts)]
-    return predicted_class
-
-
-def predict_images(test_images, test_labels):
-    # FIXME: remove this globals
-    global feature_extractor
-    global classifier
-
-    prediction_list = list()
-    for i in range(len(test_images)):
-        test_descriptor, _ = \
-            feature_extractor.extract(test_images[i], test_labels[i])
-        predictions = classifier.predict(test_descriptor)
-
-        is_a_match, predicted_class = \
-            assess_a_prediction(predictions, test_images[i], test_labels[i])
-        prediction_list.append(predicted_class)
-    return prediction_list
-
-
-def assess_a_prediction(predictions_per_descriptor, test_image, test_label):
-    # FIXME: test_image is only for printing, remove it
-    values, counts = np.unique(predictions_per_descriptor, return_counts=True)
-    predicted_class = values[np.argmax(counts)]
-    return predicted_class == test_label, predicted_class
-
-
 if __name__ == '__main__':
-    # FIXME: remove this globals when well implemented
-    global feature_extractor
-    global classifier
-
     # Create the SIFT detector object
     feature_extractor = SIFT(number_of_features=200)
     feature_extractor = ColourHistogram(bins=32)
+    # feature_extractor = GIST()
 
     # Select classification model
     # classifier = ClassifierFactory.build(ClassifierFactory.KNN, n_neighbors=5)
+    # classifier = ClassifierFactory.build(ClassifierFactory.KNN, n_neighbors=5,
+    #                                      approximate=True, n_trees=8)
+    # classifier = ClassifierFactory.build(ClassifierFactory.NBNN, n_jobs=0)
     # classifier = ClassifierFactory.build(ClassifierFactory.RANDOM_FOREST)
     # classifier = ClassifierFactory.build(ClassifierFactory.GAUSSIAN_BAYES)
     # classifier = ClassifierFactory.build(ClassifierFactory.BERNOULLI_BAYES)
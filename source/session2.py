@@ -1,14 +1,23 @@
 import time
 
 from bag_of_visual_words import BoVW, ExtendedBoVW
+from cascade import CascadeClassifier
 from database import Database
 from database import DatabaseFiles
+from descriptor_transform import DescriptorTransform
+from feature_extractor import VectorisedDenseSIFT
 from feature_extractor import denseSIFT
-from source import DATA_PATH
+from sampling import sample_descriptor_set
+from source import DATA_PATH, TEST_PATH, TRAIN_PATH
 
 
 def main(feature_extractor, spatial_pyramid=False,
-         histogram_intersection=False):
+         histogram_intersection=False, codebook_budget=100000,
+         transform=None):
+    """
+    :param transform: optional DescriptorTransform (PCA) of the descriptors,
+        fitted with the codebook
+    """
     do_plotting = True
 
     start = time.time()
@@ -26,18 +35,19 @@ def main(feature_extractor, spatial_pyramid=False,
     # Create BoVW classifier with GMM's
     BoVW_classifier = ExtendedBoVW(k=64,
                                    spatial_pyramid=spatial_pyramid,
-                                   histogram_intersection=histogram_intersection)
+                                   histogram_intersection=histogram_intersection,
+                                   transform=transform)
 
     # Extract image descriptors
-    D, Train_descriptors, Keypoints = BoVW_classifier.extract_descriptors(
+    train_set = BoVW_classifier.extract_descriptor_set(
         feature_extractor, train_images_filenames, train_labels)
 
-    # Compute Codebook
-    BoVW_classifier.compute_codebook(D)
+    # Compute Codebook on a stratified sample of the descriptors
+    BoVW_classifier.compute_codebook(
+        sample_descriptor_set(train_set, codebook_budget))
 
     # get train visual word encoding
-    visual_words = BoVW_classifier.get_train_encoding(Train_descriptors,
-                                                      Keypoints)
+    visual_words = BoVW_classifier.encode(train_set)
 
     # Train an SVM classifier
     train_data = BoVW_classifier.train_classifier(visual_words, train_labels)
@@ -56,7 +66,7 @@ def main(feature_extractor, spatial_pyramid=False,
 
 
 def cross_validate(feature_extractor, spatial_pyramid=False,
-                   histogram_intersection=False):
+                   histogram_intersection=False, codebook_budget=100000):
     # Read the train and test files
     database = Database(DATA_PATH)
     train_images_filenames, test_images_filenames, train_labels, test_labels = \
@@ -67,21 +77,68 @@ def cross_validate(feature_extractor, spatial_pyramid=False,
                            histogram_intersection=histogram_intersection)
 
     # Extract image descriptors
-    D, Train_descriptors, Keypoints = BoVW_classifier.extract_descriptors(
+    train_set = BoVW_classifier.extract_descriptor_set(
         feature_extractor, train_images_filenames, train_labels)
 
-    # Compute Codebook
-    BoVW_classifier.compute_codebook(D)
+    # Compute Codebook on a stratified sample of the descriptors
+    BoVW_classifier.compute_codebook(
+        sample_descriptor_set(train_set, codebook_budget))
 
     # get train visual word encoding
-    visual_words = BoVW_classifier.get_train_encoding(Train_descriptors,
-                                                      Keypoints)
+    visual_words = BoVW_classifier.encode(train_set)
 
     # Cross validate classifier
     BoVW_classifier.cross_validate(visual_words, train_labels)
 
 
+def out_of_core(feature_extractor, spatial_pyramid=False,
+                codebook_budget=100000, prefetch=8):
+    """ Like main, but only the descriptors of one image are in memory """
+    # Read the train and test files
+    database = Database(DATA_PATH)
+    train_images_filenames, test_images_filenames, train_labels, test_labels = \
+        database.get_data()
+
+    BoVW_classifier = BoVW(spatial_pyramid=spatial_pyramid)
+
+    # Compute Codebook on a stratified sample, in a first pass
+    BoVW_classifier.compute_codebook(BoVW_classifier.sample_descriptors(
+        feature_extractor, train_images_filenames, train_labels,
+        codebook_budget))
+
+    # Encode the train images in a second pass
+    visual_words = BoVW_classifier.encode_iter(
+        feature_extractor.iter_descriptors(train_images_filenames, prefetch,
+                                           TRAIN_PATH),
+        len(train_images_filenames))
+    train_data = BoVW_classifier.train_classifier(visual_words, train_labels)
+
+    visual_words_test = BoVW_classifier.encode_iter(
+        feature_extractor.iter_descriptors(test_images_filenames, prefetch,
+                                           TEST_PATH),
+        len(test_images_filenames))
+    BoVW_classifier.evaluate_performance(visual_words_test, test_labels,
+                                         False, train_data)
+
+
+def cascade(threshold=0.8):
+    """ Colour histograms first, dense SIFT BoVW only for uncertain images """
+    # Read the train and test files
+    database = Database(DATA_PATH)
+    train_images_filenames, test_images_filenames, train_labels, test_labels = \
+        database.get_data()
+
+    cascade_classifier = CascadeClassifier(threshold=threshold)
+    cascade_classifier.train(train_images_filenames, train_labels)
+
+    # Accuracy / latency trade-off at each threshold
+    cascade_classifier.evaluate_thresholds(test_images_filenames, test_labels)
+
+
 if __name__ == "__main__":
     # FIXME: use 300 n features
-    feature_extractor = denseSIFT()
-    main(feature_extractor, spatial_pyramid=True, histogram_intersection=True)
+    # feature_extractor = denseSIFT()
+    feature_extractor = VectorisedDenseSIFT()
+    # The diagonal GMM of the codebook fits better decorrelated descriptors
+    main(feature_extractor, spatial_pyramid=True, histogram_intersection=True,
+         transform=DescriptorTransform(n_components=64))
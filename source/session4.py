@@ -6,24 +6,38 @@ import time
 
 import matplotlib.pyplot as plt
 import numpy as np
-from GPyOpt.methods import BayesianOptimization
 from keras import optimizers
 from keras.applications.vgg16 import VGG16
 from keras.layers import Dense
 from keras.layers import Dropout
 from keras.layers import Flatten
+from keras.layers import Input
 from keras.layers import MaxPooling2D
 from keras.models import Model
 from keras.utils.vis_utils import plot_model as plot
 
+from bottleneck import BottleneckCache
+from bottleneck import split_model
 from data_generator import DataGenerator
 from data_generator_config import DataGeneratorConfig
+from normalisation import check_input_normalisation
+from normalisation import input_normalisation
+from normalisation import input_normalisation_layers
+from normalisation import set_input_statistics
+from weight_cache import set_weights
+from weight_cache import vgg16_weights
 
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
+from source import RESULTS_PATH
 from source import TEST_PATH
 from source import SMALL_TRAIN_PATH
+from source import TOY_TRAIN_PATH
+from source import TRAIN_PATH
 from evaluator import Evaluator
+from hyperparameter_search import Hyperband
+from hyperparameter_search import SearchRunner
+from hyperparameter_search import SuccessiveHalving
 
 # Config to run on one GPU
 os.environ["CUDA_VISIBLE_DEVICES"] = getpass.getuser()[-1]
@@ -46,18 +60,49 @@ logger.addHandler(console_handler)
 VALIDATION_PATH = TEST_PATH
 img_width, img_height = 224, 224
 plot_history = False
+# Render the models with plot_model (slow, VGG16 has many layers)
+plot_models = False
+# Feed uint8 images, normalised by the first layer of the models
+uint8_input = False
+# Train the heads on cached activations of the frozen VGG16 layers, with
+# this number of augmented rounds (0 to run VGG16 on the images every epoch)
+bottleneck_rounds = 5
 
 batch_size = 32
 number_of_epoch = 20
+# Screen the heads on the toy and small train sets before training on the
+# whole one (Hyperband), instead of training every trial on the small one
+multi_fidelity = True
+fidelities = [dict(train_path=TOY_TRAIN_PATH, epochs=number_of_epoch // 4),
+              dict(train_path=SMALL_TRAIN_PATH, epochs=number_of_epoch // 2),
+              dict(train_path=TRAIN_PATH, epochs=number_of_epoch)]
+# Append-only record of the hyper-parameter search trials
+JOURNAL_PATH = os.path.join(RESULTS_PATH, 'session4', 'trials.jsonl')
 
 
-def get_base_model():
-    """ create the base pre-trained model """
-    base_model = VGG16(weights='imagenet')
-    plot(base_model,
-         to_file='../results/session4/modelVGG16a.png',
-         show_shapes=True,
-         show_layer_names=True)
+def get_base_model(uint8_input=False):
+    """ create the base pre-trained model
+
+    With ``uint8_input`` VGG16 is built on top of an ``InputNormalisation``
+    layer and takes uint8 images.
+
+    Every call builds a new graph, given the ImageNet weights read once per
+    process (see ``weight_cache``): the trials get fresh heads without
+    loading the weight file again.
+    """
+    input_tensor = None
+    if uint8_input:
+        input_tensor = input_normalisation()(
+            Input(shape=(img_width, img_height, 3), dtype='uint8'))
+    base_model = VGG16(weights=None, input_tensor=input_tensor)
+    set_weights(base_model, vgg16_weights(),
+                ignore=[layer.name for layer in
+                        input_normalisation_layers(base_model)])
+    if plot_models:
+        plot(base_model,
+             to_file='../results/session4/modelVGG16a.png',
+             show_shapes=True,
+             show_layer_names=True)
     return base_model
 
 
@@ -75,10 +120,11 @@ def modify_last_fc_to_classify_eight_classes(base_model):
         layer.trainable = False
 
     model = Model(inputs=base_model.input, outputs=x)
-    plot(model,
-         to_file='../results/session4/modelVGG16b.png',
-         show_shapes=True,
-         show_layer_names=True)
+    if plot_models:
+        plot(model,
+             to_file='../results/session4/modelVGG16b.png',
+             show_shapes=True,
+             show_layer_names=True)
 
     model.compile(loss='categorical_crossentropy',
                   optimizer='adadelta',
@@ -106,10 +152,11 @@ def modify_model_before_block4(base_model, dropout=False):
     x = Dense(8, activation='softmax', name='predictions')(x)
 
     model = Model(inputs=base_model.input, outputs=x)
-    plot(model,
-         to_file='../results/session4/modelVGG16e.png',
-         show_shapes=True,
-         show_layer_names=True)
+    if plot_models:
+        plot(model,
+             to_file='../results/session4/modelVGG16e.png',
+             show_shapes=True,
+             show_layer_names=True)
 
     model.compile(loss='categorical_crossentropy',
                   optimizer='adadelta',
@@ -137,10 +184,11 @@ def modify_model_before_block3(base_model, dropout=False):
     x = Dense(8, activation='softmax', name='predictions')(x)
 
     model = Model(inputs=base_model.input, outputs=x)
-    plot(model,
-         to_file='../results/session4/modelVGG16f.png',
-         show_shapes=True,
-         show_layer_names=True)
+    if plot_models:
+        plot(model,
+             to_file='../results/session4/modelVGG16f.png',
+             show_shapes=True,
+             show_layer_names=True)
 
     model.compile(loss='categorical_crossentropy',
                   optimizer='adadelta',
@@ -148,6 +196,42 @@ def modify_model_before_block3(base_model, dropout=False):
     return model
 
 
+def get_bottleneck_generators(model, config, batch_size,
+                              train_path=SMALL_TRAIN_PATH):
+    """ Head of a model and generators of the activations of its trunk
+
+    The frozen layers up to the 'pool' layer run once per image (and per
+    augmentation round of ``config``) and are cached, see
+    ``BottleneckCache``. Training the head trains the model. Validation and
+    test images are not augmented.
+
+    :return: (head, train, test, validation) generators
+    """
+    trunk, head = split_model(model, 'pool')
+    head.compile(loss='categorical_crossentropy',
+                 optimizer='adadelta',
+                 metrics=['accuracy'])
+
+    # Same batches for every batch size, the caches are shared by the trials
+    train_gen = DataGenerator(img_width, img_height, 32, train_path,
+                              uint8=uint8_input)
+    train_gen.configure(config)
+    test_gen = DataGenerator(img_width, img_height, 32, train_path,
+                             uint8=uint8_input)
+    test_gen.configure(DataGeneratorConfig.NORMALISE)
+    check_input_normalisation(model, train_gen.data_generator)
+    check_input_normalisation(model, test_gen.data_generator)
+
+    rounds = bottleneck_rounds \
+        if train_gen.data_generator.has_transform() else 1
+    train = BottleneckCache(
+        trunk, train_gen.get_single(train_path, shuffle=False), rounds)
+    test = BottleneckCache(trunk,
+                           test_gen.get_single(TEST_PATH, shuffle=False))
+    return head, train.sequence(batch_size), \
+        test.sequence(batch_size, shuffle=False), test.sequence(batch_size)
+
+
 def unlock_layers(base_model):
     """ Task 1
 
@@ -223,7 +307,7 @@ def do_plotting(history, history2, cm=None):
 
 
 def main():
-    base_model = get_base_model()
+    base_model = get_base_model(uint8_input)
     logger.debug('Trainability of the layers:')
     model = modify_model_before_block4(base_model, dropout=False)
     # model = modify_model_before_block3(base_model, dropout=False)
@@ -236,21 +320,30 @@ def main():
     # data_generator = ImageDataGenerator(**DataGeneratorConfig.CONFIG1)
 
     data_gen = DataGenerator(img_width, img_height, batch_size,
-                             SMALL_TRAIN_PATH)
+                             SMALL_TRAIN_PATH, uint8=uint8_input)
     data_gen.configure(DataGeneratorConfig.NORMALISE)
+    set_input_statistics(model, data_gen.data_generator)
 
     train_generator, test_generator, validation_generator = data_gen.get(
         train_path=SMALL_TRAIN_PATH,
         test_path=TEST_PATH,
         validate_path=TEST_PATH)
 
+    # The head is trained first, on the cached VGG16 activations if enabled
+    head, head_train_generator, head_validation_generator = \
+        model, train_generator, validation_generator
+    if bottleneck_rounds:
+        head, head_train_generator, _, head_validation_generator = \
+            get_bottleneck_generators(model, DataGeneratorConfig.NORMALISE,
+                                      batch_size)
+
     init = time.time()
-    history = model.fit_generator(train_generator,
-                                  steps_per_epoch=(int(
-                                      400 * 1881 / 1881 // batch_size) + 1),
-                                  epochs=number_of_epoch,
-                                  validation_data=validation_generator,
-                                  validation_steps=807 // 64)
+    history = head.fit_generator(head_train_generator,
+                                 steps_per_epoch=(int(
+                                     400 * 1881 / 1881 // batch_size) + 1),
+                                 epochs=number_of_epoch,
+                                 validation_data=head_validation_generator,
+                                 validation_steps=807 // 64)
 
     # unlock all layers and train
     model = unlock_layers(model)
@@ -319,11 +412,12 @@ def modify(base_model, fc1_size, fc2_size, dropout=False):
     x = Dense(8, activation='softmax', name='predictions')(x)
 
     model = Model(inputs=base_model.input, outputs=x)
-    plot(model,
-         to_file='../results/session4/modelVGG16g_{}_{}.png'.format(
-             fc1_size, fc2_size),
-         show_shapes=True,
-         show_layer_names=True)
+    if plot_models:
+        plot(model,
+             to_file='../results/session4/modelVGG16g_{}_{}.png'.format(
+                 fc1_size, fc2_size),
+             show_shapes=True,
+             show_layer_names=True)
 
     model.compile(loss='categorical_crossentropy',
                   optimizer='adadelta',
@@ -331,12 +425,14 @@ def modify(base_model, fc1_size, fc2_size, dropout=False):
     return model
 
 
-def function_to_optimize(bounds):  # type: (ndarray) -> int
+def function_to_optimize(bounds, callbacks=None, train_path=SMALL_TRAIN_PATH,
+                         epochs=number_of_epoch):
+    # type: (ndarray, list, str, int) -> (float, dict)
     b = bounds.astype(np.int64)
     batch_size, fc1_size, fc2_size = b[:, 0][0], b[:, 1][0], b[:, 2][0]
     logger.info('Bounds in action {}'.format(bounds))
 
-    base_model = get_base_model()
+    base_model = get_base_model(uint8_input)
     logger.debug('Trainability of the layers:')
     model = modify(base_model, fc1_size, fc2_size, dropout=False)
 
@@ -344,21 +440,29 @@ def function_to_optimize(bounds):  # type: (ndarray) -> int
         logger.debug([layer.name, layer.trainable])
 
     data_gen = DataGenerator(img_width, img_height, batch_size,
-                             SMALL_TRAIN_PATH)
+                             train_path, uint8=uint8_input)
     data_gen.configure(DataGeneratorConfig.NORM_AND_TRANSFORM)
+    set_input_statistics(model, data_gen.data_generator)
 
     train_generator, test_generator, validation_generator = data_gen.get(
-        train_path=SMALL_TRAIN_PATH,
+        train_path=train_path,
         test_path=TEST_PATH,
         validate_path=TEST_PATH)
-
+    # Only the head is trained: it can be fed the cached VGG16 activations
+    if bottleneck_rounds:
+        model, train_generator, test_generator, validation_generator = \
+            get_bottleneck_generators(
+                model, DataGeneratorConfig.NORM_AND_TRANSFORM, batch_size,
+                train_path)
+
+    steps_per_epoch = int(train_generator.samples // batch_size) + 1
     init = time.time()
     history = model.fit_generator(train_generator,
-                                  steps_per_epoch=(int(
-                                      400 * 1881 / 1881 // batch_size) + 1),
-                                  epochs=number_of_epoch,
+                                  steps_per_epoch=steps_per_epoch,
+                                  epochs=epochs,
                                   validation_data=validation_generator,
-                                  validation_steps=807 // batch_size)
+                                  validation_steps=807 // batch_size,
+                                  callbacks=callbacks)
 
     end = time.time()
     logger.info('[Training] Done in ' + str(end - init) + ' secs.\n')
@@ -404,7 +508,11 @@ def function_to_optimize(bounds):  # type: (ndarray) -> int
 
     logger.info(
         'Param to optimize [Accuracy] is: {}'.format(evaluator.accuracy))
-    return evaluator.accuracy
+    # Written to the trial journal
+    details = dict(loss=float(scores[0]), precision=float(evaluator.precision),
+                   recall=float(evaluator.recall),
+                   fscore=float(evaluator.fscore))
+    return evaluator.accuracy, details
 
 
 def main_with_random_search():
@@ -416,10 +524,33 @@ def main_with_random_search():
         {'name': 'fc2_size', 'type': 'discrete',
          'domain': (128, 256, 512, 1024)}]
 
-    optimizer = BayesianOptimization(f=function_to_optimize, domain=bounds)
-    optimizer.run_optimization(max_iter=10)
-    logger.info('optimized parameters: {}'.format(optimizer.x_opt))
-    logger.info('optimized accuracy: {}'.format(optimizer.fx_opt))
+    # Read in this process only, the trials share them
+    vgg16_weights()
+
+    # The ended trials are kept, a search started again resumes from them
+    if multi_fidelity:
+        # Most of the heads are rejected after training on few images
+        runner = Hyperband(function_to_optimize,
+                           domain=bounds,
+                           fidelities=fidelities,
+                           eta=3,
+                           workers=3,
+                           threads_per_trial=2,
+                           logger=logger,
+                           journal_path=JOURNAL_PATH)
+    else:
+        # Trials at once on the cached activations, halving the worst ones
+        runner = SearchRunner(function_to_optimize,
+                              domain=bounds,
+                              max_trials=15,
+                              workers=3,
+                              threads_per_trial=2,
+                              rule=SuccessiveHalving(min_epochs=2, eta=3),
+                              logger=logger,
+                              journal_path=JOURNAL_PATH)
+    x_opt, fx_opt = runner.run()
+    logger.info('optimized parameters: {}'.format(x_opt))
+    logger.info('optimized accuracy: {}'.format(fx_opt))
 
 
 if __name__ == '__main__':
@@ -12,7 +12,6 @@ sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 os.environ["CUDA_VISIBLE_DEVICES"] = getpass.getuser()[-1]
 #os.environ["CUDA_VISIBLE_DEVICES"] = '9'
 
-from GPyOpt.methods import BayesianOptimization
 from keras import Input, optimizers
 from keras.layers import Dropout
 from keras.layers import Dense
@@ -30,8 +29,14 @@ matplotlib.use('Agg')
 from source import TEST_PATH, RESULTS_PATH
 from source import VALIDATION_PATH
 from source import TRAIN_PATH
+from source import SMALL_TRAIN_PATH
+from source import TOY_TRAIN_PATH
 
 from CNN import CNN
+from hyperparameter_search import Hyperband
+from hyperparameter_search import MedianStoppingRule
+from hyperparameter_search import SearchRunner
+from normalisation import input_normalisation
 
 # Create a file logger
 logger = logging.getLogger('session5')
@@ -53,24 +58,45 @@ cross_validate = True
 load_model = False
 # select number of epochs
 n_epochs = 50
+# Screen the parameters on the toy and small train sets before training on
+# the whole one (Hyperband), instead of training every trial on it
+multi_fidelity = True
+fidelities = [dict(train_path=TOY_TRAIN_PATH, epochs=n_epochs // 9),
+              dict(train_path=SMALL_TRAIN_PATH, epochs=n_epochs // 3),
+              dict(train_path=TRAIN_PATH, epochs=n_epochs)]
+# Feed uint8 images, normalised by the first layer of the models
+uint8_input = False
 RESULTS_DIR = os.path.join(RESULTS_PATH, 'session5')
+# Append-only record of the hyper-parameter search trials
+JOURNAL_PATH = os.path.join(RESULTS_DIR, 'trials.jsonl')
 
 
-def get_model(model_id, image_size):  # type: (int, int) -> Model
+def get_model(model_id, image_size,
+              uint8_input=False):  # type: (int, int, bool) -> Model
     """ Gets a model by its id.
 
      Args:
          model_id: model id
          image_size: dimension of the image in pixels in width or height
             (squared images are expected)
+         uint8_input: the model takes uint8 images and normalises them
      """
 
-    def _model1():
+    def _input():
+        """ Input of the models and the tensor fed to their first layer """
+        if not uint8_input:
+            main_input = Input(shape=(image_size, image_size, 3),
+                               dtype='float32',
+                               name='main_input')
+            return main_input, main_input
         main_input = Input(shape=(image_size, image_size, 3),
-                           dtype='float32',
+                           dtype='uint8',
                            name='main_input')
+        return main_input, input_normalisation()(main_input)
 
-        x = Conv2D(32, (3, 3), activation='relu', name='conv1')(main_input)
+    def _model1():
+        main_input, x = _input()
+        x = Conv2D(32, (3, 3), activation='relu', name='conv1')(x)
         x = Conv2D(32, (3, 3), activation='relu', name='conv2')(x)
         x = MaxPooling2D(pool_size=(4, 4), padding='valid', name='pool')(x)
         x = Flatten()(x)
@@ -85,10 +111,8 @@ def get_model(model_id, image_size):  # type: (int, int) -> Model
         return Model(inputs=main_input, outputs=main_output, name='model1')
 
     def _model2():
-        main_input = Input(shape=(image_size, image_size, 3),
-                           dtype='float32',
-                           name='main_input')
-        x = Conv2D(32, (3, 3), activation='relu', name='conv1')(main_input)
+        main_input, x = _input()
+        x = Conv2D(32, (3, 3), activation='relu', name='conv1')(x)
         x = MaxPooling2D(pool_size=(2, 2), padding='valid', name='pool1')(x)
         x = Conv2D(16, (3, 3), activation='relu', name='conv2')(x)
         x = MaxPooling2D(pool_size=(2, 2), padding='valid', name='pool2')(x)
@@ -104,10 +128,8 @@ def get_model(model_id, image_size):  # type: (int, int) -> Model
         return Model(inputs=main_input, outputs=main_output, name='model2')
 
     def _model3():
-        main_input = Input(shape=(image_size, image_size, 3),
-                           dtype='float32',
-                           name='main_input')
-        x = Conv2D(64, (3, 3), activation='relu', name='conv1')(main_input)
+        main_input, x = _input()
+        x = Conv2D(64, (3, 3), activation='relu', name='conv1')(x)
         x = MaxPooling2D(pool_size=(2, 2), padding='valid', name='pool1')(x)
         x = Conv2D(32, (3, 3), activation='relu', name='conv2')(x)
         x = MaxPooling2D(pool_size=(2, 2), padding='valid', name='pool2')(x)
@@ -155,23 +177,11 @@ def do_cross_validation():
     # Note the batch size is going to be multiplied cause of data-augmentation
     bounds = [
         {'name': 'model_id', 'type': 'discrete',
-         'domain': (1,23,)},
+         'domain': (1, 2, 3)},
         {'name': 'image_size', 'type': 'discrete',
-<<<<<<< HEAD
-<<<<<<< HEAD
          'domain': (64, 128, 256)},
         {'name': 'batch_size', 'type': 'discrete',
-         'domain': (32,64,)},
-=======
-         'domain': (64,)},
-        {'name': 'batch_size', 'type': 'discrete',
-         'domain': (128,)},
->>>>>>> d9b10da... Add server results
-=======
-         'domain': (64,)},
-        {'name': 'batch_size', 'type': 'discrete',
-         'domain': (128,)},
->>>>>>> d9b10da... Add server results
+         'domain': (32, 64)},
         # {'name': 'batch_size', 'type': 'discrete',
         #  'domain': (16, 32, 64)},
         {'name': 'optimizer_id', 'type': 'discrete',
@@ -182,26 +192,44 @@ def do_cross_validation():
          # 'domain': (1, 0.1, 0.01, 0.001, 0.0001)}]
          'domain': (1,)}]
 
-    optimizer = BayesianOptimization(f=train_and_validate,
-                                     domain=bounds,
-                                     verbosity=True)
-    optimizer.run_optimization(max_iter=5,
-                               verbosity=True,
-                               report_file='optimizer_results.txt')
-    logger.info('optimized parameters: {}'.format(optimizer.x_opt))
-    logger.info('optimized accuracy: {}'.format(optimizer.fx_opt))
-
-
-def train_and_validate(bounds):
+    # The ended trials are kept, a search started again resumes from them
+    if multi_fidelity:
+        # Most of the trials are rejected after training on few images
+        runner = Hyperband(train_and_validate,
+                           domain=bounds,
+                           fidelities=fidelities,
+                           eta=3,
+                           workers=2,
+                           threads_per_trial=4,
+                           logger=logger,
+                           journal_path=JOURNAL_PATH)
+    else:
+        # Two trials at once, the hopeless ones are stopped early
+        runner = SearchRunner(train_and_validate,
+                              domain=bounds,
+                              max_trials=10,
+                              workers=2,
+                              threads_per_trial=4,
+                              rule=MedianStoppingRule(grace_epochs=5),
+                              logger=logger,
+                              journal_path=JOURNAL_PATH)
+    x_opt, fx_opt = runner.run()
+    logger.info('optimized parameters: {}'.format(x_opt))
+    logger.info('optimized accuracy: {}'.format(fx_opt))
+
+
+def train_and_validate(bounds, callbacks=None, train_path=TRAIN_PATH,
+                       epochs=n_epochs):
     b = bounds.astype(np.int64)
     model_id, image_size, batch_size, optimizer_id, lr = \
         b[:, 0][0], b[:, 1][0], b[:, 2][0], b[:, 3][0], b[:, 4][0]
     logger.info('Bounds in action {}'.format(bounds))
-    timestamp = int(time.time())
+    # Trials run at once in several processes
+    timestamp = '{}_{}'.format(int(time.time()), os.getpid())
     MODEL_PATH = os.path.join(RESULTS_DIR,
                               'CNN_{}_{}.h5'.format(model_id, timestamp))
     neural_network = CNN(logger,
-                         train_path=TRAIN_PATH,
+                         train_path=train_path,
                          validation_path=VALIDATION_PATH,
                          test_path=TEST_PATH,
                          model_fname=MODEL_PATH)
@@ -209,7 +237,8 @@ def train_and_validate(bounds):
     # Hyper-parameters selection
     neural_network.set_batch_size(batch_size)
     neural_network.set_model(
-        model=get_model(model_id=model_id, image_size=image_size))
+        model=get_model(model_id=model_id, image_size=image_size,
+                        uint8_input=uint8_input))
     neural_network.set_optimizer(get_optimizer(optimizer_id, lr))
     neural_network.set_loss_function('categorical_crossentropy')
     neural_network.set_metrics(['accuracy'])
@@ -219,9 +248,10 @@ def train_and_validate(bounds):
     neural_network.build()
 
     # Train
-    neural_network.train_CNN_model(n_epochs=n_epochs,
+    neural_network.train_CNN_model(n_epochs=epochs,
                                    steps_per_epoch_multiplier=10,
-                                   validation_steps_multiplier=1)
+                                   validation_steps_multiplier=1,
+                                   callbacks=callbacks)
 
     neural_network.plot_history(
         os.path.join(RESULTS_DIR, 'CNN_{}_{}'.format(model_id, timestamp)))
@@ -229,7 +259,12 @@ def train_and_validate(bounds):
         os.path.join(RESULTS_DIR, 'CNN_{}_{}'.format(model_id, timestamp)))
 
     score, evaluator = neural_network.get_results()
-    return np.array(evaluator.accuracy, dtype=np.float64)
+    # Written to the trial journal
+    details = dict(model_path=MODEL_PATH, loss=float(score[0]),
+                   precision=float(evaluator.precision),
+                   recall=float(evaluator.recall),
+                   fscore=float(evaluator.fscore))
+    return np.array(evaluator.accuracy, dtype=np.float64), details
 
 
 if __name__ == "__main__":
@@ -254,7 +289,8 @@ if __name__ == "__main__":
             # Hyper-parameters selection
             neural_network.set_batch_size(16)
             neural_network.set_model(
-                model=get_model(model_id=2, image_size=64))
+                model=get_model(model_id=2, image_size=64,
+                                uint8_input=uint8_input))
             neural_network.set_optimizer(optimizers.Adadelta(lr=0.1))
             neural_network.set_loss_function('categorical_crossentropy')
             neural_network.set_metrics(['accuracy'])
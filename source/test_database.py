@@ -1,12 +1,13 @@
 from database import DatabaseFiles as DB
 
 db = DB('/home/jon/repos/mcv/m3/scene-classificator/data')
+dataset = db.get_dataset('train')
 
-print('exist? {}'.format(db.dataset_exists('train')))
-print('empty? {}'.format(db.dataset_is_empty('train')))
+print('exist? {}'.format(dataset.exists()))
 image_relative_path = 'train/tallbuilding/test1.jpg'
 
 descriptor = [10, 30]
 label = ['tall', 'verytall']
-db.save_descriptor(image_relative_path, descriptor, label)
-print(db.load_descriptor(image_relative_path))
+dataset.save_descriptor(image_relative_path, descriptor, label)
+print('contains? {}'.format(dataset.contains(image_relative_path)))
+print(dataset.load_descriptor(image_relative_path))
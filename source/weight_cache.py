@@ -0,0 +1,77 @@
+import time
+
+import h5py
+import numpy as np
+from keras import backend as K
+from keras.applications.vgg16 import WEIGHTS_PATH
+from keras.models import Model
+from keras.utils.data_utils import get_file
+from typing import Dict
+from typing import List
+
+# Weights read by this process, by file
+_weights = dict()  # type: Dict[str, Dict]
+
+
+def load_weights(path):
+    # type: (str) -> Dict
+    """ Weights of a Keras weight file, by layer name
+
+    The file is read once per process. Only h5py and numpy are used (no
+    backend session), so the weights can be loaded before forking the
+    processes of the trials, which share them.
+    """
+    if path not in _weights:
+        print('[weight_cache] Loading {}...'.format(path))
+        init = time.time()
+        weights = dict()
+        with h5py.File(path, mode='r') as weights_file:
+            for layer_name in weights_file.attrs['layer_names']:
+                group = weights_file[layer_name]
+                weights[layer_name.decode('utf8')] = [
+                    np.asarray(group[weight_name])
+                    for weight_name in group.attrs['weight_names']]
+        _weights[path] = weights
+        print('Done in ' + str(time.time() - init) + ' secs.')
+    return _weights[path]
+
+
+def vgg16_weights():
+    # type: () -> Dict
+    """ ImageNet weights of VGG16 (with the top), downloaded if needed """
+    return load_weights(get_file(
+        'vgg16_weights_tf_dim_ordering_tf_kernels.h5', WEIGHTS_PATH,
+        cache_subdir='models', file_hash='64373286793e3c8b2b4e3219cbf3544b'))
+
+
+def set_weights(model, weights, ignore=()):
+    # type: (Model, Dict, List) -> None
+    """ Sets the weights of the layers of a model, by layer name
+
+    :param ignore: names of the layers with weights not in ``weights``
+        (e.g. layers added to the model), left as they are
+    :raise ValueError: if another layer with weights is not in ``weights``,
+        or if a layer has another number of weights or shapes
+    """
+    missing = [layer.name for layer in model.layers
+               if layer.weights and layer.name not in weights and
+               layer.name not in ignore]
+    if missing:
+        raise ValueError('No weights for the layers: {}'.format(
+            ', '.join(missing)))
+    values = list()
+    for layer in model.layers:
+        if layer.name not in weights or layer.name in ignore:
+            continue
+        layer_weights = weights[layer.name]
+        if len(layer.weights) != len(layer_weights):
+            raise ValueError('Layer {} has {} weights, {} given'.format(
+                layer.name, len(layer.weights), len(layer_weights)))
+        for variable, value in zip(layer.weights, layer_weights):
+            if K.int_shape(variable) != value.shape:
+                raise ValueError('Weight {} of layer {} has shape {}, {} '
+                                 'given'.format(variable.name, layer.name,
+                                                K.int_shape(variable),
+                                                value.shape))
+            values.append((variable, value))
+    K.batch_set_value(values)